@@ -0,0 +1,55 @@
+import threading
+import time
+from typing import Any, Callable, Optional
+
+# Defers construction of heavy objects (ChainManager pulls in torch, mlx_vlm and
+# LangChain) to a background thread so the HTTP layer can start serving
+# /api/health immediately. Attribute access blocks until the object is built.
+
+
+class BackgroundLoader:
+    def __init__(self, factory: Callable[[], Any], name: str = "chain_manager"):
+        self._factory = factory
+        self._name = name
+        self._ready = threading.Event()
+        self._instance: Optional[Any] = None
+        self._error: Optional[BaseException] = None
+        self._thread: Optional[threading.Thread] = None
+        self.load_seconds: Optional[float] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._build, name=f"load-{self._name}", daemon=True)
+            self._thread.start()
+
+    def _build(self):
+        start = time.perf_counter()
+        try:
+            self._instance = self._factory()
+        except BaseException as e:
+            self._error = e
+        finally:
+            self.load_seconds = round(time.perf_counter() - start, 3)
+            self._ready.set()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set() and self._error is None
+
+    @property
+    def status(self) -> str:
+        if not self._ready.is_set():
+            return "loading" if self._thread else "not started"
+        return f"failed: {self._error}" if self._error is not None else "ready"
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        # Callers that arrive before start() (e.g. scripts) trigger the load themselves.
+        self.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError(f"{self._name} is still loading")
+        if self._error is not None:
+            raise RuntimeError(f"{self._name} failed to load: {self._error}") from self._error
+        return self._instance
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
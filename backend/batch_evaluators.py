@@ -0,0 +1,105 @@
+import json
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from keyword_matching import LEAK_MATCHER, get_matcher
+
+# Batch heuristic evaluators for auditing large numbers of traces.
+# Keyword sets are compiled once into a single regex (keyword_matching.py) and
+# each response is scanned in one pass, instead of one substring search per
+# keyword per example.
+
+# --- Column scorers ---
+
+def entity_recall_scores(responses: Sequence[str], expected: Sequence[Sequence[str]]) -> List[float]:
+    scores = []
+    for response, entities in zip(responses, expected):
+        if not entities:
+            scores.append(1.0)
+            continue
+        found = get_matcher(tuple(entities)).found(response)
+        scores.append(sum(1 for e in entities if e.lower() in found) / len(entities))
+    return scores
+
+
+def reasoning_leak_scores(responses: Sequence[str]) -> List[float]:
+    return [0.0 if LEAK_MATCHER.found(r) else 1.0 for r in responses]
+
+
+def forbidden_keyword_hits(responses: Sequence[str], forbidden: Sequence[str]) -> List[List[str]]:
+    matcher = get_matcher(tuple(forbidden))
+    hits = []
+    for response in responses:
+        found = matcher.found_not_negated(response)
+        hits.append([kw for kw in forbidden if kw.lower() in found])
+    return hits
+
+
+# --- Streaming ---
+
+class BatchStats:
+    def __init__(self):
+        self.examples = 0
+        self.seconds = 0.0
+
+    @property
+    def examples_per_second(self) -> float:
+        return self.examples / self.seconds if self.seconds else 0.0
+
+
+def stream_evaluate(
+    records: Iterable[Dict[str, Any]],
+    chunk_size: int = 1000,
+    forbidden: Optional[Sequence[str]] = None,
+    stats: Optional[BatchStats] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Scores records of the form {"result": str, "entities": [...]} chunk by chunk,
+    yielding one score dict per record so arbitrarily large inputs stay in constant memory.
+    """
+    stats = stats if stats is not None else BatchStats()
+    chunk: List[Dict[str, Any]] = []
+
+    def flush():
+        start = time.perf_counter()
+        responses = [r.get("result", "") for r in chunk]
+        recall = entity_recall_scores(responses, [r.get("entities", []) for r in chunk])
+        leaks = reasoning_leak_scores(responses)
+        hits = forbidden_keyword_hits(responses, forbidden) if forbidden else [[] for _ in chunk]
+        stats.seconds += time.perf_counter() - start
+        stats.examples += len(chunk)
+        for record, r, l, h in zip(chunk, recall, leaks, hits):
+            yield {
+                "id": record.get("id"),
+                "medical_entity_recall": r,
+                "no_reasoning_leak": l,
+                "forbidden_keywords": h,
+            }
+
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield from flush()
+            chunk = []
+    if chunk:
+        yield from flush()
+
+
+if __name__ == "__main__":
+    # Usage: python backend/batch_evaluators.py traces.jsonl [forbidden,keywords]
+    if len(sys.argv) < 2:
+        print("Usage: python batch_evaluators.py <records.jsonl> [comma,separated,forbidden]")
+        sys.exit(1)
+    forbidden = sys.argv[2].split(",") if len(sys.argv) > 2 else None
+    stats = BatchStats()
+    totals = {"medical_entity_recall": 0.0, "no_reasoning_leak": 0.0}
+    with open(sys.argv[1]) as f:
+        records = (json.loads(line) for line in f if line.strip())
+        for result in stream_evaluate(records, forbidden=forbidden, stats=stats):
+            for key in totals:
+                totals[key] += result[key]
+    n = max(stats.examples, 1)
+    print(f"Scored {stats.examples} examples at {stats.examples_per_second:,.0f} examples/sec")
+    for key, total in totals.items():
+        print(f"{key}: {total / n:.3f}")
@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+# Import-time benchmark for the HTTP layer.
+# Runs `python -X importtime -c "import main"` in a fresh interpreter and fails
+# when importing main exceeds the time budget or eagerly pulls in any of the
+# heavy inference modules (those must load in the background thread).
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUDGET_SECONDS = float(os.getenv("MEDSUPPORT_IMPORT_BUDGET", "1.0"))
+HEAVY_MODULES = ["torch", "numpy", "mlx", "mlx_vlm", "transformers", "langchain_core", "chain_manager", "model_adapter"]
+
+
+def measure_import(module: str = "main") -> Tuple[float, Dict[str, float]]:
+    """Returns (cumulative seconds for module, {direct import of module: cumulative seconds})."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+
+    packages: Dict[str, float] = {}
+    total = 0.0
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(parts[1].strip()) / 1e6
+        except ValueError:
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        if depth == 1:
+            packages[name] = packages.get(name, 0.0) + cumulative
+        elif depth == 0 and name == module:
+            total = cumulative
+    return total, packages
+
+
+def check(budget: float = DEFAULT_BUDGET_SECONDS, module: str = "main") -> List[str]:
+    """Returns a list of problems; empty when startup is within budget."""
+    total, packages = measure_import(module)
+    problems = []
+    if total > budget:
+        problems.append(f"import {module} took {total:.3f}s (budget {budget:.3f}s)")
+    loaded = _imported_modules(module)
+    eager = [m for m in HEAVY_MODULES if m in loaded]
+    if eager:
+        problems.append(f"heavy modules imported eagerly: {', '.join(eager)}")
+    return problems
+
+
+def _imported_modules(module: str) -> set:
+    proc = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print('\\n'.join(sys.modules))"],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True,
+    )
+    return {name.split(".")[0] for name in proc.stdout.split()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fail when importing the API layer regresses.")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET_SECONDS, help="Maximum seconds for `import main`.")
+    parser.add_argument("--module", default="main")
+    args = parser.parse_args()
+
+    total, packages = measure_import(args.module)
+    print(f"import {args.module}: {total:.3f}s")
+    for name, seconds in sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:15]:
+        print(f"  {seconds:8.3f}s  {name}")
+
+    problems = check(args.budget, args.module)
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    sys.exit(1 if problems else 0)
@@ -3,12 +3,72 @@ from dotenv import load_dotenv
 from model_adapter import MLXVLMAdapter
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.messages import HumanMessage
+from langchain_core.messages import AIMessage, HumanMessage
 from PIL import Image
+from profiler import profiled, profile_section
+from grounding import DEFAULT_LABEL, annotations_from_boxes, annotations_per_image, extract_boxes, normalize_box
+from tiling import describe_region, needs_tiling, plan_tiles, regions_from_boxes, to_global_box
+from sessions import SessionStore
+from metrics import metrics
+from prompts import build_prompt, prompt_report
 import io
+import json
 
 load_dotenv()
 
+# Schema for structured entity extraction (decoding is constrained to it).
+# Boxes are [ymin, xmin, ymax, xmax] on a 0-100 scale, as in free-text answers.
+ENTITY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "summary": {"type": "string"},
+        "conditions": {"type": "array", "items": {"type": "string"}},
+        "medications": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "dose": {"type": "string"}, "frequency": {"type": "string"}},
+                "required": ["name", "dose", "frequency"],
+            },
+        },
+        "vitals": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"name": {"type": "string"}, "value": {"type": "string"}},
+                "required": ["name", "value"],
+            },
+        },
+        "boxes": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "label": {"type": "string"},
+                    "box": {"type": "array", "items": {"type": "number"}, "minItems": 4, "maxItems": 4},
+                },
+                "required": ["label", "box"],
+            },
+        },
+    },
+    "required": ["summary", "conditions", "medications", "vitals"],
+}
+STRUCTURED_MAX_TOKENS = 1024
+
+ENTITY_INSTRUCTIONS = """Extract the clinical entities and answer with a single JSON object with these keys:
+- "summary": a short plain-English summary
+- "conditions": list of diagnoses / conditions
+- "medications": list of {"name", "dose", "frequency"} (use "" when not stated)
+- "vitals": list of {"name", "value"}
+- "boxes": only for images, list of {"label", "box": [ymin, xmin, ymax, xmax]} (0-100) for visible abnormalities
+Output ONLY the JSON."""
+
+def load_image(image_data) -> Image.Image:
+    """Accepts raw upload bytes or an already decoded PIL image (e.g. from the model server's shared memory)."""
+    if isinstance(image_data, Image.Image):
+        return image_data if image_data.mode == "RGB" else image_data.convert("RGB")
+    return Image.open(io.BytesIO(image_data)).convert("RGB")
+
 class ChainManager:
     def __init__(self, model_path="Rafath1/medgemma-medsupport-4bit"):
         # Detect if we are running from root or backend
@@ -16,9 +76,11 @@ class ChainManager:
             model_path = os.path.join("backend", model_path)
         
         self.model = MLXVLMAdapter(model_path=model_path)
+        self.sessions = SessionStore()
 
+    @profiled("chain.analyze_text")
     def analyze_text(self, text: str):
-        prompt = ChatPromptTemplate.from_template("""
+        prompt = build_prompt("""
         You are a helpful medical assistant.
         
         Instructions:
@@ -28,10 +90,10 @@ class ChainManager:
 
         Input Text:
         {text}
-        """)
-        chain = prompt | self.model | StrOutputParser()
-        return chain.invoke({"text": text})
+        """, text=text)
+        return self.model.invoke(prompt).content
 
+    @profiled("chain.simplify_report")
     def simplify_report(self, text: str):
         prompt = ChatPromptTemplate.from_template(
             "Please rewrite the following medical report in plain English so a patient can understand it. Explain any technical terms:\n\n{text}"
@@ -39,11 +101,10 @@ class ChainManager:
         chain = prompt | self.model | StrOutputParser()
         return chain.invoke({"text": text})
 
-    def analyze_image(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image."):
+    def _image_prompt(self, user_prompt: str) -> str:
         if not user_prompt or not user_prompt.strip():
-            full_prompt = "Describe the medical findings in this image. List key structures and any abnormalities seen. If you see an abnormality, provide its bounding box as [ymin, xmin, ymax, xmax] (0-100)."
-        else:
-            full_prompt = f"""
+            return "Describe the medical findings in this image. List key structures and any abnormalities seen. If you see an abnormality, provide its bounding box as [ymin, xmin, ymax, xmax] (0-100)."
+        return build_prompt("""
             You are an expert Radiologist. 
             User Request: "{user_prompt}"
             
@@ -56,28 +117,196 @@ class ChainManager:
             "There is a fracture in the distal radius. [10, 20, 30, 40]"
             
             Answer the user's specific question: "{user_prompt}"
-            """
+            """, user_prompt=user_prompt)
+
+    @profiled("chain.analyze_image")
+    def analyze_image(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image."):
+        full_prompt = self._image_prompt(user_prompt)
 
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        with profile_section("image.decode"):
+            image = load_image(image_bytes)
         
         # We invoke the model with the prompt and pass the image object via kwargs
         # since our MLXVLMAdapter handles the image from kwargs
         response = self.model.invoke(full_prompt, image=image)
         return response.content
 
+    @profiled("chain.analyze_image_tiled")
+    def analyze_image_tiled(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image.", mode: str = "full"):
+        """
+        High-resolution variant of analyze_image. Runs the usual low-resolution pass, then
+        re-examines full-resolution tiles ("full") or only crops around boxes flagged by
+        the first pass ("coarse_to_fine"), and returns the combined text plus annotations
+        in global coordinates.
+        """
+        full_prompt = self._image_prompt(user_prompt)
+        with profile_section("image.decode"):
+            image = load_image(image_bytes)
+        overview = self.model.invoke(full_prompt, image=image).content
+        boxes = extract_boxes(overview)
+
+        width, height = image.size
+        regions = []
+        if needs_tiling(image):
+            regions = regions_from_boxes(boxes, width, height) if mode == "coarse_to_fine" else plan_tiles(width, height)
+
+        findings = []
+        for region in regions:
+            where = describe_region(region, width, height)
+            tile_prompt = f"This is a zoomed-in {where} region of a larger image. Coordinates are relative to this region.\n{full_prompt}"
+            with profile_section("tiling.tile"):
+                tile_text = self.model.invoke(tile_prompt, image=image.crop(region)).content
+            for found in extract_boxes(tile_text):
+                box = to_global_box(found["box"], region, width, height)
+                boxes.append({"box": box, "label": found["label"]})
+                findings.append(f"- **{where}**: {found['label']} [{', '.join(str(round(v)) for v in box)}]")
+
+        result = overview
+        if findings:
+            result += "\n\n**High-resolution findings**\n" + "\n".join(findings)
+        return {"result": result, "annotations": annotations_from_boxes(boxes)}
+
+    @profiled("chain.compare_images")
+    def compare_images(self, images: list, user_prompt: str = "", labels: list = None):
+        """
+        One comparative answer for several images (e.g. a prior and a current study). All images
+        go into a single generation, so the vision encoder runs once over the batch; boxes are
+        returned per image, in upload order.
+        """
+        with profile_section("image.decode"):
+            decoded = [load_image(image) for image in images]
+        labels = list(labels or [])
+        names = "\n".join(
+            f"- Image {i}" + (f": {labels[i - 1]}" if i <= len(labels) and labels[i - 1] else "")
+            for i in range(1, len(decoded) + 1)
+        )
+        question = user_prompt.strip() if user_prompt and user_prompt.strip() else "Compare these images and describe what has changed between them."
+        prompt = f"""You are an expert Radiologist comparing {len(decoded)} medical images:
+{names}
+
+1. Describe the findings in each image.
+2. Compare them: what is new, resolved, improved, worsened or unchanged.
+For every abnormality, start the line with the image it is in and give its bounding box in that image as [ymin, xmin, ymax, xmax] (0-100), e.g. "Image 2: consolidation in the right lower lobe [60, 10, 85, 40]".
+
+Answer the user's question: "{question}"
+"""
+        text = self.model.invoke(prompt, image=decoded).content
+        return {"result": text, "annotations": annotations_per_image(text, len(decoded))}
+
+    def stream_image_analysis(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image."):
+        """Yields raw text chunks as they are generated. Use finalize_stream() on the joined text."""
+        full_prompt = self._image_prompt(user_prompt)
+        image = load_image(image_bytes)
+        for chunk in self.model.stream(full_prompt, image=image):
+            yield chunk.content
+
+    def finalize_stream(self, text: str) -> str:
+        return self.model._post_process(text)
+
+    @profiled("chain.analyze_note_multimodal")
     def analyze_note_multimodal(self, image_bytes: bytes, user_prompt: str = ""):
         if user_prompt and user_prompt.strip():
              full_prompt = user_prompt
         else:
              full_prompt = "Transcribe the clinical note in this image and extract key entities (Conditions, Medications, Vitals)."
         
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        with profile_section("image.decode"):
+            image = load_image(image_bytes)
         response = self.model.invoke(full_prompt, image=image)
         return response.content
 
+    def _structured_result(self, raw: str):
+        """Parses constrained JSON output into {"result", "entities", "annotations"}."""
+        try:
+            entities = json.loads(raw)
+        except json.JSONDecodeError as e:
+            # The grammar guarantees a valid prefix, so this only happens when max_tokens cuts it short.
+            raise ValueError(f"Structured output was incomplete: {e}") from e
+        boxes = []
+        for item in entities.pop("boxes", []):
+            box = normalize_box(*item["box"])
+            if box:
+                boxes.append({"box": box, "label": item["label"].strip() or DEFAULT_LABEL})
+        return {"result": entities.get("summary", ""), "entities": entities, "annotations": annotations_from_boxes(boxes)}
+
+    @profiled("chain.extract_entities_text")
+    def extract_entities_text(self, text: str):
+        """Structured variant of analyze_text: JSON entities decoded under ENTITY_SCHEMA."""
+        prompt = f"{ENTITY_INSTRUCTIONS}\n\nInput Text:\n{text}"
+        response = self.model.invoke(prompt, json_schema=ENTITY_SCHEMA, max_tokens=STRUCTURED_MAX_TOKENS)
+        return self._structured_result(response.content)
+
+    @profiled("chain.extract_entities_image")
+    def extract_entities_image(self, image_bytes: bytes, user_prompt: str = ""):
+        """Structured variant of analyze_note_multimodal for an image of a clinical note."""
+        prompt = "Transcribe the clinical note in this image. " + ENTITY_INSTRUCTIONS
+        if user_prompt and user_prompt.strip():
+            prompt += f'\nUser Request: "{user_prompt}"'
+        with profile_section("image.decode"):
+            image = load_image(image_bytes)
+        response = self.model.invoke(prompt, image=image, json_schema=ENTITY_SCHEMA, max_tokens=STRUCTURED_MAX_TOKENS)
+        return self._structured_result(response.content)
+
+    @profiled("chain.analyze_note_text")
+    def analyze_note_text(self, ocr_text: str, user_prompt: str = ""):
+        """Text-only Clinical Scribe path for notes whose OCR transcription is clean."""
+        if user_prompt and user_prompt.strip():
+            task = user_prompt
+        else:
+            task = "Summarize this clinical note and extract key entities (Conditions, Medications, Vitals)."
+        prompt = ChatPromptTemplate.from_template(
+            "The following text was transcribed from a typed clinical document.\n{task}\nOutput ONLY the final answer.\n\nDocument:\n{text}"
+        )
+        chain = prompt | self.model | StrOutputParser()
+        return chain.invoke({"task": task, "text": ocr_text})
+
+    @profiled("chain.merge_document_pages")
+    def merge_document_pages(self, task: str, page_results: list, user_prompt: str = ""):
+        """Text-only pass that combines per-page answers of a multi-page document into one."""
+        pages = "\n\n".join(f"--- Page {i} ---\n{text}" for i, text in enumerate(page_results, 1))
+        if task == "scribe":
+            instructions = "Combine these page-by-page transcriptions of one clinical document into a single note. Remove duplicates and list the key entities once (Conditions, Medications, Vitals)."
+        else:
+            instructions = "Combine these page-by-page explanations of one medical report into a single plain-English explanation for the patient. Keep every abnormal value, use **BOLD** for test names and status, and bullet points (-) for results."
+        if user_prompt and user_prompt.strip():
+            instructions += f'\nAlso answer the user\'s question: "{user_prompt}"'
+        prompt = ChatPromptTemplate.from_template("{instructions}\n\n{pages}")
+        chain = prompt | self.model | StrOutputParser()
+        return chain.invoke({"instructions": instructions, "pages": pages})
+
+    def count_tokens(self, texts: list) -> list:
+        return self.model.count_tokens(texts)
+
+    def prompt_report(self):
+        return prompt_report()
+
+    @profiled("chain.summarize_chunk")
+    def summarize_chunk(self, task: str, chunk: str, part: int, parts: int):
+        """Map step of long-document mode: one chunk of a note or report, summarized on its own."""
+        if task == "simplify":
+            instructions = f"This is part {part} of {parts} of a medical report. Explain this part in plain English for a patient. Keep every test name, value and abnormal result."
+        else:
+            instructions = f"This is part {part} of {parts} of a long clinical note. Summarize this part and list the key entities it mentions (Conditions, Medications, Vitals)."
+        prompt = ChatPromptTemplate.from_template("{instructions}\nOutput ONLY the summary.\n\n{chunk}")
+        chain = prompt | self.model | StrOutputParser()
+        return chain.invoke({"instructions": instructions, "chunk": chunk})
+
+    @profiled("chain.reduce_summaries")
+    def reduce_summaries(self, task: str, summaries: list):
+        """Reduce step of long-document mode: combines partial summaries, in order, into one answer."""
+        parts = "\n\n".join(f"--- Part {i} ---\n{text}" for i, text in enumerate(summaries, 1))
+        if task == "simplify":
+            instructions = "Combine these partial explanations of one medical report into a single plain-English explanation for the patient. Keep every abnormal value and explain any technical terms."
+        else:
+            instructions = "Combine these partial summaries of one clinical note into a single summary. Remove duplicates and list the key entities once (Conditions, Medications)."
+        prompt = ChatPromptTemplate.from_template("{instructions}\nOutput ONLY the final answer.\n\n{parts}")
+        chain = prompt | self.model | StrOutputParser()
+        return chain.invoke({"instructions": instructions, "parts": parts})
+
+    @profiled("chain.simplify_report_multimodal")
     def simplify_report_multimodal(self, image_bytes: bytes, user_prompt: str = ""):
         if user_prompt and user_prompt.strip():
-             full_prompt = f"""
+             full_prompt = build_prompt("""
              You are a helpful medical assistant for a patient.
              User Question: "{user_prompt}"
              
@@ -96,10 +325,55 @@ class ChainManager:
              - Use bullet points (-) for the list of results.
              - Put each finding on a NEW line.
              - Keep the explanation clear and spaced out.
-             """
+             """, user_prompt=user_prompt)
         else:
              full_prompt = "You are a helpful medical assistant. Read this medical report and explain it in plain English for a patient. Explain any technical terms. If any values are abnormal, highlight them."
         
-        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        with profile_section("image.decode"):
+            image = load_image(image_bytes)
         response = self.model.invoke(full_prompt, image=image)
         return response.content
+
+    # --- Conversational sessions ---
+
+    @profiled("chain.start_session")
+    def start_session(self, image_bytes=None, text: str = "", user_prompt: str = "", session_id: str = None):
+        """
+        Opens a follow-up conversation about a report (image and/or text) and answers the
+        first turn. Later turns go through ask_session and reuse this turn's KV cache.
+        """
+        image = None
+        if image_bytes is not None:
+            with profile_section("image.decode"):
+                image = load_image(image_bytes)
+        question = user_prompt.strip() if user_prompt and user_prompt.strip() else "Explain this report in plain English. Explain any technical terms and highlight abnormal values."
+        first_turn = "You are a helpful medical assistant for a patient. The patient will ask follow-up questions about this report."
+        if text and text.strip():
+            first_turn += f"\n\nReport:\n{text}"
+        first_turn += f"\n\nQuestion: {question}"
+        session = self.sessions.create(image, session_id)
+        return {"session_id": session.id, **self._session_turn(session, first_turn)}
+
+    @profiled("chain.ask_session")
+    def ask_session(self, session_id: str, question: str):
+        """Answers a follow-up question; returns None if the session is unknown or was dropped."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        return {"session_id": session.id, **self._session_turn(session, question)}
+
+    def end_session(self, session_id: str) -> bool:
+        return self.sessions.delete(session_id)
+
+    def _session_turn(self, session, question: str):
+        with session.lock:
+            messages = [HumanMessage(content=text) if role == "user" else AIMessage(content=text) for role, text in session.turns]
+            messages.append(HumanMessage(content=question))
+            response = self.model.invoke(messages, image=session.image, prompt_cache_state=session.cache_state)
+            # Keep the raw generation in the history so the next turn's tokens match the cached prefix.
+            session.turns += [("user", question), ("assistant", response.response_metadata.get("raw_text", response.content))]
+        prompt_tokens = response.response_metadata.get("prompt_tokens", 0)
+        cached_tokens = response.response_metadata.get("cached_tokens", 0)
+        metrics.observe("session.prefill_tokens", prompt_tokens - cached_tokens)
+        metrics.observe("session.cached_tokens", cached_tokens)
+        return {"result": response.content, "turn": len(session.turns) // 2, "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens}
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from PIL import Image
+
+from image_store import image_id_of
+from metrics import metrics
+
+# In-flight request coalescing.
+# A double-clicked "Analyze", or several staff opening the same report, sends
+# identical requests at once. Calls with the same method, inputs (images are
+# hashed by content) and parameters that arrive while one is already running
+# wait for that generation instead of starting their own. Stream subscribers
+# get the chunks produced so far replayed, then follow live.
+# Each coalesced call increments the "coalesce.coalesced" counter.
+
+# ChainManager methods that are pure functions of their arguments. Session
+# starts are left out: each must open its own conversation.
+COALESCED_METHODS = {
+    "analyze_text", "simplify_report", "analyze_image", "analyze_image_tiled", "compare_images",
+    "analyze_note_multimodal", "simplify_report_multimodal", "analyze_note_text",
+    "merge_document_pages", "summarize_chunk", "reduce_summaries", "extract_entities_text", "extract_entities_image", "ask_session",
+}
+COALESCED_STREAM_METHODS = {"stream_image_analysis"}
+
+
+def _feed(digest, value: Any):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        digest.update(b"b")
+        digest.update(value)
+    elif isinstance(value, Image.Image):
+        digest.update(f"i{value.mode}{value.size}".encode())
+        # Handle images are already identified by their content hash.
+        image_id = image_id_of(value)
+        digest.update(image_id.encode() if image_id else value.tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"l{len(value)}".encode())
+        for item in value:
+            _feed(digest, item)
+    else:
+        digest.update(b"j")
+        digest.update(json.dumps(value, sort_keys=True, default=repr).encode())
+
+
+def request_key(method: str, args: tuple, kwargs: Dict[str, Any]) -> str:
+    digest = hashlib.blake2b(method.encode(), digest_size=20)
+    _feed(digest, list(args))
+    _feed(digest, sorted(kwargs.items()))
+    return digest.hexdigest()
+
+
+class _Broadcast:
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 1
+        self.cond = threading.Condition()
+
+
+class Coalescer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self._streams: Dict[str, _Broadcast] = {}
+
+    def run(self, key: str, fn: Callable[[], Any], name: str = "") -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            self._count(name)
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def stream(self, key: str, fn: Callable[[], Iterator[Any]], name: str = "") -> Iterator[Any]:
+        with self._lock:
+            broadcast = self._streams.get(key)
+            if broadcast is None:
+                broadcast = self._streams[key] = _Broadcast()
+                threading.Thread(target=self._pump, args=(key, broadcast, fn), daemon=True).start()
+            else:
+                broadcast.subscribers += 1
+                self._count(name)
+        return self._follow(broadcast)
+
+    def _count(self, name: str):
+        metrics.incr("coalesce.coalesced")
+        if name:
+            metrics.incr(f"coalesce.coalesced.{name}")
+
+    def _pump(self, key: str, broadcast: _Broadcast, fn: Callable[[], Iterator[Any]]):
+        generator = None
+        try:
+            generator = fn()
+            for chunk in generator:
+                with self._lock:
+                    if broadcast.subscribers == 0:
+                        # Everyone disconnected; stop generating.
+                        self._streams.pop(key, None)
+                        break
+                with broadcast.cond:
+                    broadcast.chunks.append(chunk)
+                    broadcast.cond.notify_all()
+        except BaseException as e:
+            broadcast.error = e
+        finally:
+            if generator is not None and hasattr(generator, "close"):
+                generator.close()
+            with self._lock:
+                if self._streams.get(key) is broadcast:
+                    del self._streams[key]
+            with broadcast.cond:
+                broadcast.done = True
+                broadcast.cond.notify_all()
+
+    def _follow(self, broadcast: _Broadcast) -> Iterator[Any]:
+        position = 0
+        try:
+            while True:
+                with broadcast.cond:
+                    while position >= len(broadcast.chunks) and not broadcast.done:
+                        broadcast.cond.wait()
+                    pending = broadcast.chunks[position:]
+                    position += len(pending)
+                    done, error = broadcast.done, broadcast.error
+                yield from pending
+                if done:
+                    if error is not None:
+                        raise error
+                    return
+        finally:
+            with self._lock:
+                broadcast.subscribers -= 1
+
+
+class CoalescingProxy:
+    """
+    Wraps a ChainManager (or ModelServerClient) so identical concurrent calls share one
+    generation. With `lock`, every call on the target runs under it; the wait for an
+    in-flight twin happens outside the lock.
+    """
+
+    def __init__(self, target: Any, lock: Optional[threading.Lock] = None, coalescer: Optional[Coalescer] = None):
+        self.target = target
+        self.lock = lock
+        self.coalescer = coalescer or Coalescer()
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self.target, name)
+        if not callable(attr):
+            return attr
+        guard = self.lock or nullcontext()
+
+        def locked(*args, **kwargs):
+            with guard:
+                return attr(*args, **kwargs)
+
+        def locked_stream(*args, **kwargs):
+            with guard:
+                yield from attr(*args, **kwargs)
+
+        if name in COALESCED_STREAM_METHODS:
+            return lambda *args, **kwargs: self.coalescer.stream(request_key(name, args, kwargs), lambda: locked_stream(*args, **kwargs), name)
+        if name in COALESCED_METHODS:
+            return lambda *args, **kwargs: self.coalescer.run(request_key(name, args, kwargs), lambda: locked(*args, **kwargs), name)
+        return locked if self.lock else attr
@@ -0,0 +1,286 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+# Token-level constrained decoding to a JSON schema.
+# JSONSchemaAutomaton is an incremental, schema-aware JSON prefix recognizer:
+# states are immutable tuples, so a candidate token can be tried against the
+# committed state without copying. JSONSchemaLogitsProcessor plugs it into
+# mlx generation: at each step it keeps only the highest-scoring candidate
+# tokens that extend the output to a valid prefix and forces EOS once the
+# document is complete. If a chosen token is not a valid continuation (nothing
+# in the candidates fitted, or the sampler went its own way), the automaton can
+# no longer follow the output: constraining stops for the rest of the
+# generation and constrained_decoding.desync is counted.
+#
+# Supported schema subset: object (properties, required; no additional keys),
+# array (items, minItems, maxItems), string, number, integer, boolean.
+# Numbers are plain decimals (no exponent), which covers box coordinates.
+
+WHITESPACE = " \n\t"
+MAX_WHITESPACE_RUN = 4
+TOP_K_CANDIDATES = 64
+_NUMBER_CHARS = set("0123456789-.")
+_NUMBER_PREFIX = re.compile(r"-?((0|[1-9]\d*)(\.\d*)?)?")
+_NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?")
+_ESCAPES = set('"\\/bfnrtu')
+_HEX = set("0123456789abcdefABCDEF")
+
+# Frames (all tuples):
+#   ("value", schema)                                 expecting a value
+#   ("obj", schema, phase, seen_keys, key_buffer)     phase: open|key|colon|value_done
+#   ("arr", schema, phase, count)                     phase: open|item|value_done
+#   ("str", escape_state)                             inside a string value
+#   ("num", text, integer_only)
+#   ("lit", remaining)                                rest of true/false
+State = Tuple[Tuple[Any, ...], int, bool]  # (stack, whitespace_run, done)
+
+
+class JSONSchemaAutomaton:
+    def __init__(self, schema: Dict[str, Any]):
+        self.schema = schema
+
+    def initial(self) -> State:
+        return ((("value", self.schema),), 0, False)
+
+    def is_done(self, state: State) -> bool:
+        return state[2]
+
+    def feed_text(self, state: Optional[State], text: str) -> Optional[State]:
+        for ch in text:
+            if state is None:
+                return None
+            state = self.feed(state, ch)
+        return state
+
+    def feed(self, state: State, ch: str) -> Optional[State]:
+        stack, ws_run, done = state
+        if done:
+            return None
+        top = stack[-1]
+        kind = top[0]
+
+        # Inside strings / numbers / literals whitespace is significant.
+        if kind == "str":
+            return self._feed_string(stack, ch)
+        if kind == "num":
+            if ch in _NUMBER_CHARS and _valid_number_prefix(top[1] + ch, top[2]):
+                return (stack[:-1] + (("num", top[1] + ch, top[2]),), 0, False)
+            if not _valid_number(top[1]):
+                return None
+            return self.feed(self._pop(stack), ch)
+        if kind == "lit":
+            if ch != top[1][0]:
+                return None
+            rest = top[1][1:]
+            return self._pop(stack) if not rest else (stack[:-1] + (("lit", rest),), 0, False)
+        if kind == "obj" and top[2] == "key":
+            return self._feed_key(stack, ch)
+
+        if ch in WHITESPACE:
+            return (stack, ws_run + 1, False) if ws_run < MAX_WHITESPACE_RUN else None
+
+        if kind == "value":
+            return self._start_value(stack[:-1], top[1], ch)
+        if kind == "obj":
+            return self._feed_object(stack, ch)
+        if kind == "arr":
+            return self._feed_array(stack, ch)
+        return None
+
+    # --- helpers ---
+
+    def _pop(self, stack) -> State:
+        """Completes the top frame's value and advances its parent."""
+        stack = stack[:-1]
+        if not stack:
+            return ((), 0, True)
+        parent = stack[-1]
+        if parent[0] == "obj":
+            return (stack[:-1] + (("obj", parent[1], "value_done", parent[3], ""),), 0, False)
+        if parent[0] == "arr":
+            return (stack[:-1] + (("arr", parent[1], "value_done", parent[3] + 1),), 0, False)
+        return None
+
+    def _start_value(self, stack, schema: Dict[str, Any], ch: str) -> Optional[State]:
+        kind = schema.get("type")
+        if kind == "object" and ch == "{":
+            return (stack + (("obj", schema, "open", frozenset(), ""),), 0, False)
+        if kind == "array" and ch == "[":
+            return (stack + (("arr", schema, "open", 0),), 0, False)
+        if kind == "string" and ch == '"':
+            return (stack + (("str", ""),), 0, False)
+        if kind in ("number", "integer") and (ch.isdigit() or ch == "-"):
+            return (stack + (("num", ch, kind == "integer"),), 0, False)
+        if kind == "boolean" and ch in "tf":
+            rest = ("true" if ch == "t" else "false")[1:]
+            return (stack + (("lit", rest),), 0, False)
+        return None
+
+    def _feed_string(self, stack, ch: str) -> Optional[State]:
+        escape = stack[-1][1]
+        if escape == "":
+            if ch == '"':
+                return self._pop(stack)
+            if ch == "\\":
+                return (stack[:-1] + (("str", "\\"),), 0, False)
+            if ord(ch) < 0x20:
+                return None
+            return (stack, 0, False)
+        if escape == "\\":
+            if ch not in _ESCAPES:
+                return None
+            return (stack[:-1] + (("str", "u" if ch == "u" else ""),), 0, False)
+        # \uXXXX: escape holds "u" plus the hex digits read so far
+        if ch not in _HEX:
+            return None
+        escape += ch
+        return (stack[:-1] + (("str", "" if len(escape) == 5 else escape),), 0, False)
+
+    def _remaining_keys(self, frame) -> List[str]:
+        return [k for k in frame[1].get("properties", {}) if k not in frame[3]]
+
+    def _missing_required(self, frame) -> bool:
+        return any(k not in frame[3] for k in frame[1].get("required", []))
+
+    def _feed_object(self, stack, ch: str) -> Optional[State]:
+        frame = stack[-1]
+        _, schema, phase, seen, _ = frame
+        if phase == "open":
+            if ch == "}" and not self._missing_required(frame):
+                return self._pop(stack)
+            if ch == '"' and self._remaining_keys(frame):
+                return (stack[:-1] + (("obj", schema, "key", seen, ""),), 0, False)
+            return None
+        if phase == "colon":
+            if ch != ":":
+                return None
+            key = frame[4]
+            return (stack + (("value", schema["properties"][key]),), 0, False)
+        if phase == "value_done":
+            if ch == "}" and not self._missing_required(frame):
+                return self._pop(stack)
+            if ch == "," and self._remaining_keys(frame):
+                return (stack[:-1] + (("obj", schema, "open_after_comma", seen, ""),), 0, False)
+            return None
+        if phase == "open_after_comma":
+            if ch == '"':
+                return (stack[:-1] + (("obj", schema, "key", seen, ""),), 0, False)
+            return None
+        return None
+
+    def _feed_key(self, stack, ch: str) -> Optional[State]:
+        frame = stack[-1]
+        _, schema, _, seen, buffer = frame
+        remaining = self._remaining_keys(frame)
+        if ch == '"':
+            if buffer not in remaining:
+                return None
+            # Stash the key until its value is complete; `seen` records it now.
+            return (stack[:-1] + (("obj", schema, "colon", seen | {buffer}, buffer),), 0, False)
+        buffer += ch
+        if not any(k.startswith(buffer) for k in remaining):
+            return None
+        return (stack[:-1] + (("obj", schema, "key", seen, buffer),), 0, False)
+
+    def _feed_array(self, stack, ch: str) -> Optional[State]:
+        _, schema, phase, count = stack[-1]
+        min_items = schema.get("minItems", 0)
+        max_items = schema.get("maxItems")
+        if phase in ("open", "value_done") and ch == "]" and count >= min_items:
+            return self._pop(stack)
+        if phase == "value_done" and ch == ",":
+            if max_items is not None and count >= max_items:
+                return None
+            return (stack[:-1] + (("arr", schema, "item", count),), 0, False)
+        if phase in ("open", "item"):
+            if phase == "open" and max_items == 0:
+                return None
+            return self._start_value(stack, schema.get("items", {}), ch)
+        return None
+
+
+def _valid_number_prefix(text: str, integer_only: bool) -> bool:
+    return _NUMBER_PREFIX.fullmatch(text) is not None and not (integer_only and "." in text)
+
+
+def _valid_number(text: str) -> bool:
+    return _NUMBER.fullmatch(text) is not None
+
+
+# Decoded text per token id, shared by every request on the same tokenizer.
+_TOKEN_TEXT: Dict[int, Dict[int, str]] = {}
+_CHAR_TOKENS: Dict[int, List[int]] = {}
+
+
+class JSONSchemaLogitsProcessor:
+    """
+    mlx logits processor: (tokens, logits) -> logits. Among the top-k candidates it
+    keeps only tokens whose text extends the output to a valid prefix; once the
+    document is complete only EOS remains. state is None after a desync.
+    """
+
+    def __init__(self, schema: Dict[str, Any], tokenizer: Any, top_k: int = TOP_K_CANDIDATES):
+        self.automaton = JSONSchemaAutomaton(schema)
+        self.state = self.automaton.initial()
+        self.tokenizer = tokenizer
+        self.top_k = top_k
+        self.eos_token_id = getattr(tokenizer, "eos_token_id", None)
+        self._token_text = _TOKEN_TEXT.setdefault(id(tokenizer), {})
+        self._history_len: Optional[int] = None
+
+    def _text(self, token_id: int) -> str:
+        text = self._token_text.get(token_id)
+        if text is None:
+            text = self.tokenizer.decode([token_id])
+            self._token_text[token_id] = text
+        return text
+
+    def _advance(self, tokens):
+        # tokens holds the full history; the last entry is the token chosen after our previous call.
+        length = len(tokens) if tokens is not None else 0
+        if self._history_len is not None and length > self._history_len:
+            chosen = int(tokens[-1])
+            if chosen != self.eos_token_id and self.state is not None:
+                self.state = self.automaton.feed_text(self.state, self._text(chosen))
+                if self.state is None:
+                    metrics.incr("constrained_decoding.desync")
+        self._history_len = length
+
+    def allowed(self, candidates: List[int]) -> List[int]:
+        if self.state is None:
+            return list(candidates)
+        if self.automaton.is_done(self.state):
+            return [self.eos_token_id] if self.eos_token_id is not None else []
+        return [t for t in candidates if t != self.eos_token_id and self._text(t)
+                and self.automaton.feed_text(self.state, self._text(t)) is not None]
+
+    def __call__(self, tokens, logits):
+        import mlx.core as mx
+
+        self._advance(tokens)
+        if self.state is None:
+            return logits
+        flat = logits.reshape(-1)
+        k = min(self.top_k, flat.shape[0])
+        top = mx.argpartition(-flat, kth=k - 1)[:k]
+        scores = flat[top].tolist()
+        candidates = [t for _, t in sorted(zip(scores, top.tolist()), reverse=True)]
+        allowed = self.allowed(candidates)
+        if not allowed:
+            # Nothing in the top-k fits; fall back to scanning single-character tokens.
+            allowed = self.allowed(self._single_char_tokens())
+        if not allowed:
+            return logits
+        mask = mx.full(flat.shape, -float("inf"), dtype=logits.dtype)
+        mask[mx.array(allowed)] = 0
+        return logits + mask.reshape(logits.shape)
+
+    def _single_char_tokens(self) -> List[int]:
+        key = id(self.tokenizer)
+        if key not in _CHAR_TOKENS:
+            chars = set('{}[]":,0123456789-.' + WHITESPACE + "abcdefghijklmnopqrstuvwxyz")
+            vocab = self.tokenizer.get_vocab() if hasattr(self.tokenizer, "get_vocab") else {}
+            _CHAR_TOKENS[key] = [i for i in vocab.values() if self._text(i) in chars]
+        return _CHAR_TOKENS[key]
@@ -0,0 +1,164 @@
+import importlib.util
+import io
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from PIL import Image, ImageSequence
+
+# Multi-page document ingestion (PDF and multi-page TIFF) for Clinical Scribe and
+# Patient Portal. Pages are rasterized lazily on a background thread into a
+# small bounded queue, run through the single-image ChainManager method with
+# bounded parallelism, and the per-page answers are merged into one response.
+# PDF support uses the optional pypdfium2 package.
+
+PDF_RENDER_DPI = int(os.getenv("MEDSUPPORT_PDF_DPI", "150"))
+# Pages in flight at once. Keep at 1 for an in-process model; raise it to the
+# number of model-server replicas when MEDSUPPORT_MODEL_SERVER lists several.
+DOCUMENT_WORKERS = int(os.getenv("MEDSUPPORT_DOCUMENT_WORKERS", "1"))
+MAX_DOCUMENT_PAGES = int(os.getenv("MEDSUPPORT_MAX_DOCUMENT_PAGES", "50"))
+PREFETCH_PAGES = 2
+
+# task -> ChainManager method for a single page
+DOCUMENT_TASKS = {
+    "scribe": "analyze_note_multimodal",
+    "simplify": "simplify_report_multimodal",
+}
+
+
+def is_pdf(data: bytes) -> bool:
+    return data[:5] == b"%PDF-"
+
+
+PDF_BACKEND_MISSING = "PDF uploads require the pypdfium2 package (pip install pypdfium2)"
+
+
+def pdf_support() -> bool:
+    return importlib.util.find_spec("pypdfium2") is not None
+
+
+def _open_pdf(data: bytes):
+    try:
+        import pypdfium2 as pdfium
+    except ImportError as e:
+        raise RuntimeError(PDF_BACKEND_MISSING) from e
+    return pdfium.PdfDocument(data)
+
+
+def count_pages(data: bytes) -> int:
+    if is_pdf(data):
+        pdf = _open_pdf(data)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+    with Image.open(io.BytesIO(data)) as image:
+        return getattr(image, "n_frames", 1)
+
+
+def is_multipage(data: bytes) -> bool:
+    if is_pdf(data):
+        # A broken PDF or a missing backend is reported, not sent to the image path.
+        return count_pages(data) > 1
+    try:
+        return count_pages(data) > 1
+    except Exception:
+        # Let the single-image path report undecodable uploads as before.
+        return False
+
+
+def is_document(data: bytes) -> bool:
+    """Uploads for the document pipeline: every PDF, whatever its page count, and multi-page images."""
+    return is_pdf(data) or is_multipage(data)
+
+
+def iter_pages(data: bytes) -> Iterator[Image.Image]:
+    """Yields each page as an RGB image, rasterizing one page at a time."""
+    if is_pdf(data):
+        pdf = _open_pdf(data)
+        try:
+            for index in range(min(len(pdf), MAX_DOCUMENT_PAGES)):
+                page = pdf[index]
+                try:
+                    yield page.render(scale=PDF_RENDER_DPI / 72).to_pil().convert("RGB")
+                finally:
+                    page.close()
+        finally:
+            pdf.close()
+        return
+
+    with Image.open(io.BytesIO(data)) as image:
+        for index, frame in enumerate(ImageSequence.Iterator(image)):
+            if index >= MAX_DOCUMENT_PAGES:
+                break
+            yield frame.convert("RGB")
+
+
+def prefetch(pages: Iterator[Image.Image], depth: int = PREFETCH_PAGES) -> Iterator[Image.Image]:
+    """Rasterizes ahead of the consumer on a background thread, holding at most `depth` pages."""
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Unblocks the producer if the consumer stops early.
+        stopped.set()
+
+
+def process_document(chain_manager: Any, data: bytes, task: str, user_prompt: str = "", workers: int = DOCUMENT_WORKERS, page_method: Optional[Callable] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Yields {"type": "page", "page", "total", "result"} for every page in order,
+    then {"type": "done", "result", "pages"} with the merged answer.
+    page_method overrides the per-page ChainManager method (e.g. the OCR router for scribe).
+    """
+    page_method = page_method or getattr(chain_manager, DOCUMENT_TASKS[task])
+    total = min(count_pages(data), MAX_DOCUMENT_PAGES)
+    page_results: List[str] = []
+    in_flight = deque()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        def finish_next():
+            result = in_flight.popleft().result()
+            page_results.append(result)
+            return {"type": "page", "page": len(page_results), "total": total, "result": result}
+
+        for page in prefetch(iter_pages(data)):
+            in_flight.append(pool.submit(page_method, page, user_prompt))
+            if len(in_flight) >= max(1, workers):
+                yield finish_next()
+        while in_flight:
+            yield finish_next()
+
+    merged = page_results[0] if len(page_results) == 1 else chain_manager.merge_document_pages(task, page_results, user_prompt)
+    yield {"type": "done", "result": merged, "pages": len(page_results)}
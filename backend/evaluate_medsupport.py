@@ -12,7 +12,12 @@ if root_dir not in sys.path:
     sys.path.insert(0, root_dir)
 
 from backend.chain_manager import ChainManager
-from typing import Dict, Any
+from backend.batch_evaluators import entity_recall_scores
+from backend.keyword_matching import LEAK_MATCHER
+from backend.grounding import has_box
+from backend.trace_audit import LangSmithTraceSource, TraceAuditor
+from types import SimpleNamespace
+from typing import Dict, Any, Optional
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
 
@@ -38,23 +43,15 @@ def bounding_box_present_evaluator(run: Any, example: Any) -> Dict[str, Any]:
     response = run.outputs.get("result", "")
     expected_box = example.outputs.get("has_box", False)
     
-    box_pattern = r"\[(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?)\]"
-    has_box = bool(re.search(box_pattern, response))
-    
-    score = 1 if has_box == expected_box else 0
+    score = 1 if has_box(response) == expected_box else 0
     return {"key": "bounding_box_valid", "score": score}
 
 def medical_entity_evaluator(run: Any, example: Any) -> Dict[str, Any]:
     """Checks if key medical entities are present in the response."""
-    response = run.outputs.get("result", "").lower()
+    response = run.outputs.get("result", "")
     expected_entities = example.outputs.get("entities", [])
     
-    if not expected_entities:
-        return {"key": "medical_entity_recall", "score": 1.0}
-        
-    found_count = sum(1 for entity in expected_entities if entity.lower() in response)
-    score = found_count / len(expected_entities)
-    
+    score = entity_recall_scores([response], [expected_entities])[0]
     return {"key": "medical_entity_recall", "score": score}
 
 def format_compliance_evaluator(run: Any, example: Any) -> Dict[str, Any]:
@@ -81,24 +78,15 @@ def simplicity_score_evaluator(run: Any, example: Any) -> Dict[str, Any]:
 
 def reasoning_leak_evaluator(run: Any, example: Any) -> Dict[str, Any]:
     """Check if model's internal thought process leaked into the final answer."""
-    response = run.outputs.get("result", "").lower()
-    leak_keywords = ["thought", "i will", "reasoning", "user wants"]
+    response = run.outputs.get("result", "")
     
-    leaked = any(kw in response for kw in leak_keywords)
+    leaked = bool(LEAK_MATCHER.found(response))
     score = 0.0 if leaked else 1.0
     return {"key": "no_reasoning_leak", "score": score}
 
 # --- LLM-as-a-Judge Evaluators ---
 
-def tone_empathy_evaluator(run: Any, example: Any) -> Dict[str, Any]:
-    """Evaluates the tone and empathy of the response for a patient."""
-    if not evaluator_llm:
-        return {"key": "tone_and_empathy", "score": 0.0, "comment": "Skipped: Missing API Key"}
-        
-    input_text = example.inputs.get("text", example.inputs.get("prompt", ""))
-    response = run.outputs.get("result", "")
-    
-    prompt = PromptTemplate.from_template("""
+TONE_EMPATHY_PROMPT = PromptTemplate.from_template("""
     Role: Senior Medical Communicator
     Input: {input}
     Response: {response}
@@ -111,26 +99,8 @@ def tone_empathy_evaluator(run: Any, example: Any) -> Dict[str, Any]:
     Respond with a single score between 1 and 5 (5 being perfect). 
     Output ONLY THE NUMBER.
     """)
-    
-    try:
-        feedback = evaluator_llm.invoke(prompt.format(input=input_text, response=response))
-        match = re.search(r"\d", feedback.content)
-        score = float(match.group()) / 5.0 if match else 0.5
-    except:
-        score = 0.5
-        
-    return {"key": "tone_and_empathy", "score": score}
-
-def medical_correctness_evaluator(run: Any, example: Any) -> Dict[str, Any]:
-    """Evaluates the medical correctness based on the expected entities and common knowledge."""
-    if not evaluator_llm:
-        return {"key": "medical_correctness", "score": 0.0, "comment": "Skipped: Missing API Key"}
 
-    input_text = example.inputs.get("text", example.inputs.get("prompt", ""))
-    response = run.outputs.get("result", "")
-    reference = str(example.outputs.get("entities", "No specific reference provided."))
-    
-    prompt = PromptTemplate.from_template("""
+MEDICAL_CORRECTNESS_PROMPT = PromptTemplate.from_template("""
     Role: Board-Certified Physician
     Input: {input}
     Model Response: {response}
@@ -142,16 +112,55 @@ def medical_correctness_evaluator(run: Any, example: Any) -> Dict[str, Any]:
     Respond with a single score between 1 and 5 (5 being perfect).
     Output ONLY THE NUMBER.
     """)
+
+def build_tone_empathy_prompt(run: Any, example: Any) -> str:
+    input_text = example.inputs.get("text", example.inputs.get("prompt", ""))
+    response = run.outputs.get("result", "")
+    return TONE_EMPATHY_PROMPT.format(input=input_text, response=response)
+
+def build_medical_correctness_prompt(run: Any, example: Any) -> str:
+    input_text = example.inputs.get("text", example.inputs.get("prompt", ""))
+    response = run.outputs.get("result", "")
+    reference = str(example.outputs.get("entities", "No specific reference provided."))
+    return MEDICAL_CORRECTNESS_PROMPT.format(input=input_text, response=response, reference=reference)
+
+def parse_judge_score(content: str) -> float:
+    """Maps the judge's 1-5 answer onto 0-1, defaulting to 0.5 when no digit is found."""
+    match = re.search(r"\d", content)
+    return float(match.group()) / 5.0 if match else 0.5
+
+def tone_empathy_evaluator(run: Any, example: Any) -> Dict[str, Any]:
+    """Evaluates the tone and empathy of the response for a patient."""
+    if not evaluator_llm:
+        return {"key": "tone_and_empathy", "score": 0.0, "comment": "Skipped: Missing API Key"}
+    
+    try:
+        feedback = evaluator_llm.invoke(build_tone_empathy_prompt(run, example))
+        score = parse_judge_score(feedback.content)
+    except:
+        score = 0.5
+        
+    return {"key": "tone_and_empathy", "score": score}
+
+def medical_correctness_evaluator(run: Any, example: Any) -> Dict[str, Any]:
+    """Evaluates the medical correctness based on the expected entities and common knowledge."""
+    if not evaluator_llm:
+        return {"key": "medical_correctness", "score": 0.0, "comment": "Skipped: Missing API Key"}
     
     try:
-        feedback = evaluator_llm.invoke(prompt.format(input=input_text, response=response, reference=reference))
-        match = re.search(r"\d", feedback.content)
-        score = float(match.group()) / 5.0 if match else 0.5
+        feedback = evaluator_llm.invoke(build_medical_correctness_prompt(run, example))
+        score = parse_judge_score(feedback.content)
     except:
         score = 0.5
         
     return {"key": "medical_correctness", "score": score}
 
+# Judge evaluators that can be batched: evaluator -> (feedback key, prompt builder)
+JUDGE_EVALUATORS = {
+    tone_empathy_evaluator: ("tone_and_empathy", build_tone_empathy_prompt),
+    medical_correctness_evaluator: ("medical_correctness", build_medical_correctness_prompt),
+}
+
 # --- Datasets ---
 
 # 1. Text Analysis Examples
@@ -290,113 +299,131 @@ def create_or_get_dataset(dataset_name: str, examples: list):
     print(f"✨ Created dataset '{dataset_name}' with {len(examples)} examples.")
     return dataset_name
 
-def run_evaluations():
-    print("🚀 Starting MedSupport LangSmith Evaluations...")
-
-    # 1. Evaluate Text Analysis
-    print("\n--- Evaluating Text Analysis ---")
-    text_ds_name = create_or_get_dataset("MedSupport-Text-Tests", TEXT_EXAMPLES)
-    res_text = evaluate(
-        target_text_analysis,
-        data=text_ds_name,
-        evaluators=[
+# --- Suites ---
+# Shared by the LangSmith flow below and the local runner in local_eval.py.
+SUITES = [
+    {
+        "name": "text",
+        "title": "Text Analysis",
+        "dataset": "MedSupport-Text-Tests",
+        "examples": TEXT_EXAMPLES,
+        "target": target_text_analysis,
+        "evaluators": [
             medical_entity_evaluator, 
             tone_empathy_evaluator, 
             medical_correctness_evaluator,
             simplicity_score_evaluator,
             reasoning_leak_evaluator
         ],
-        experiment_prefix="text-analysis",
-        metadata={"version": "1.4", "task": "text-summary"}
-    )
-    print(f"✅ Text Results: {res_text.experiment_name}")
-
-    # 2. Evaluate Image Analysis (Diagnostics)
-    print("\n--- Evaluating Image Analysis ---")
-    valid_image_examples = [ex for ex in IMAGE_EXAMPLES if os.path.exists(ex["inputs"]["image_path"])]
-    if valid_image_examples:
-        img_ds_name = create_or_get_dataset("MedSupport-Image-Tests", valid_image_examples)
-        res_img = evaluate(
-            target_image_analysis,
-            data=img_ds_name,
-            evaluators=[
-                bounding_box_present_evaluator, 
-                medical_entity_evaluator,
-                medical_correctness_evaluator,
-                reasoning_leak_evaluator
-            ],
-            experiment_prefix="image-analysis",
-            metadata={"version": "1.4", "task": "vision"}
-        )
-        print(f"✅ Image Results: {res_img.experiment_name}")
-
-    # 3. Evaluate Multimodal Scribe
-    print("\n--- Evaluating Multimodal Scribe ---")
-    valid_scribe_examples = [ex for ex in SCRIBE_EXAMPLES if os.path.exists(ex["inputs"]["image_path"])]
-    if valid_scribe_examples:
-        scribe_ds_name = create_or_get_dataset("MedSupport-Scribe-Tests", valid_scribe_examples)
-        res_scribe = evaluate(
-            target_scribe_multimodal,
-            data=scribe_ds_name,
-            evaluators=[
-                medical_entity_evaluator,
-                tone_empathy_evaluator,
-                medical_correctness_evaluator,
-                simplicity_score_evaluator,
-                reasoning_leak_evaluator
-            ],
-            experiment_prefix="scribe-analysis",
-            metadata={"version": "1.2", "task": "scribe"}
-        )
-        print(f"✅ Scribe Results: {res_scribe.experiment_name}")
-
-    # 4. Evaluate Multimodal Simplification
-    print("\n--- Evaluating Multimodal Simplification ---")
-    valid_simplify_examples = [ex for ex in SIMPLIFY_EXAMPLES if os.path.exists(ex["inputs"]["image_path"])]
-    if valid_simplify_examples:
-        simplify_ds_name = create_or_get_dataset("MedSupport-Simplify-Tests", valid_simplify_examples)
-        res_simplify = evaluate(
-            target_simplify_multimodal,
-            data=simplify_ds_name,
-            evaluators=[
-                medical_entity_evaluator,
-                format_compliance_evaluator,
-                tone_empathy_evaluator,
-                medical_correctness_evaluator,
-                simplicity_score_evaluator,
-                reasoning_leak_evaluator
-            ],
-            experiment_prefix="simplify-analysis",
-            metadata={"version": "1.2", "task": "simplify"}
+        "experiment_prefix": "text-analysis",
+        "metadata": {"version": "1.4", "task": "text-summary"},
+    },
+    {
+        "name": "image",
+        "title": "Image Analysis",
+        "dataset": "MedSupport-Image-Tests",
+        "examples": IMAGE_EXAMPLES,
+        "target": target_image_analysis,
+        "evaluators": [
+            bounding_box_present_evaluator, 
+            medical_entity_evaluator,
+            medical_correctness_evaluator,
+            reasoning_leak_evaluator
+        ],
+        "experiment_prefix": "image-analysis",
+        "metadata": {"version": "1.4", "task": "vision"},
+    },
+    {
+        "name": "scribe",
+        "title": "Multimodal Scribe",
+        "dataset": "MedSupport-Scribe-Tests",
+        "examples": SCRIBE_EXAMPLES,
+        "target": target_scribe_multimodal,
+        "evaluators": [
+            medical_entity_evaluator,
+            tone_empathy_evaluator,
+            medical_correctness_evaluator,
+            simplicity_score_evaluator,
+            reasoning_leak_evaluator
+        ],
+        "experiment_prefix": "scribe-analysis",
+        "metadata": {"version": "1.2", "task": "scribe"},
+    },
+    {
+        "name": "simplify",
+        "title": "Multimodal Simplification",
+        "dataset": "MedSupport-Simplify-Tests",
+        "examples": SIMPLIFY_EXAMPLES,
+        "target": target_simplify_multimodal,
+        "evaluators": [
+            medical_entity_evaluator,
+            format_compliance_evaluator,
+            tone_empathy_evaluator,
+            medical_correctness_evaluator,
+            simplicity_score_evaluator,
+            reasoning_leak_evaluator
+        ],
+        "experiment_prefix": "simplify-analysis",
+        "metadata": {"version": "1.2", "task": "simplify"},
+    },
+]
+
+def valid_examples(examples: list) -> list:
+    """Drops image examples whose file is missing from this checkout."""
+    return [ex for ex in examples if "image_path" not in ex["inputs"] or os.path.exists(ex["inputs"]["image_path"])]
+
+def run_evaluations():
+    print("🚀 Starting MedSupport LangSmith Evaluations...")
+
+    for suite in SUITES:
+        print(f"\n--- Evaluating {suite['title']} ---")
+        examples = valid_examples(suite["examples"])
+        if not examples:
+            continue
+        ds_name = create_or_get_dataset(suite["dataset"], examples)
+        res = evaluate(
+            suite["target"],
+            data=ds_name,
+            evaluators=suite["evaluators"],
+            experiment_prefix=suite["experiment_prefix"],
+            metadata=suite["metadata"]
         )
-        print(f"✅ Simplify Results: {res_simplify.experiment_name}")
+        print(f"✅ {suite['title']} Results: {res.experiment_name}")
 
-def evaluate_project_traces(project_name: str = "MedSupport", limit: int = 10):
+def evaluate_project_traces(project_name: str = "MedSupport", limit: Optional[int] = None, max_workers: int = 4):
     """
     Utility to run our evaluators on EXISTING production traces.
     Note: Programmatic 'Registration' of Online Rules is currently UI-only,
     but this SDK method allows you to audit quality of live data.
+    Runs are audited oldest first and a checkpoint in backend/eval_results remembers
+    the last audited run, so repeated calls only score new traces; limit caps the
+    runs per call and leaves the newer ones for the next.
     """
-    print(f"\n--- Auditing Latest {limit} Traces in '{project_name}' ---")
-    runs = list(client.list_runs(
-        project_name=project_name,
-        execution_order=1,
-        limit=limit
-    ))
-    
-    if not runs:
-        print("No traces found to evaluate.")
-        return
+    print(f"\n--- Auditing New Traces in '{project_name}' ---")
+    source = LangSmithTraceSource(client, project_name, limit=limit)
+    audit_traces(source, project_name, max_workers=max_workers)
+
+def audit_traces(source: Any, name: str, max_workers: int = 4) -> int:
+    """Scores runs from any trace source (LangSmith or a LocalTraceStore) with the judge evaluators."""
+    def tone(run):
+        return tone_empathy_evaluator(run, SimpleNamespace(inputs=run.inputs, outputs={}))
+
+    def correctness(run):
+        return medical_correctness_evaluator(run, SimpleNamespace(inputs=run.inputs, outputs={"entities": []}))
+
+    def report(result):
+        scores = result["scores"]
+        print(f"Run {result['run_id'][:8]}: Tone={scores['tone_and_empathy']}, Correctness={scores['medical_correctness']}")
 
-    for run in runs:
-        # Scoring logic applied to live trace inputs
-        tone = tone_empathy_evaluator(run, type('obj', (object,), {'inputs': run.inputs, 'outputs': {}})())
-        correctness = medical_correctness_evaluator(run, type('obj', (object,), {'inputs': run.inputs, 'outputs': {'entities': []}})())
-        print(f"Run {run.id[:8]}: Tone={tone['score']}, Correctness={correctness['score']}")
+    auditor = TraceAuditor(source, [tone, correctness], name=name, max_workers=max_workers)
+    audited = auditor.run(on_result=report)
+    if not audited:
+        print("No new traces found to evaluate.")
+    return audited
 
 if __name__ == "__main__":
     run_evaluations()
     # To audit live traces, uncomment the line below:
-    # evaluate_project_traces("MedSupport", limit=5)
+    # evaluate_project_traces("MedSupport")
     print("\n✨ Evaluation complete. Results are available in LangSmith Datasets & Experiments.")
     print("💡 To see evaluators in the 'Tracing -> Evaluators' tab, follow the UI guide in walkthrough.md")
@@ -0,0 +1,140 @@
+import re
+from typing import Any, Dict, List, Optional
+
+# Bounding-box ("grounding") parsing for model responses.
+# The model is prompted to emit boxes as [ymin, xmin, ymax, xmax] on a 0-100
+# scale. Annotations follow the frontend's box_2d format: [xmin, ymin, xmax, ymax]
+# as 0-1 fractions of the image.
+
+BOX_PATTERN = re.compile(r"\[(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?)\]")
+DEFAULT_LABEL = "Abnormality"
+MERGE_IOU_THRESHOLD = 0.5
+MAX_LABEL_CHARS = 48
+
+_IMAGE_REFERENCE = re.compile(r"\bimage\s*#?\s*(\d+)\b", re.IGNORECASE)
+_SENTENCE_BREAK = re.compile(r"[.!?\n]")
+_LABEL_NOISE = re.compile(r"[*#`_\"]|^\s*(?:[-•]|\d+\.)\s*")
+
+
+def has_box(text: str) -> bool:
+    return BOX_PATTERN.search(text) is not None
+
+
+def _clamp(value: float) -> float:
+    return min(max(value, 0.0), 100.0)
+
+
+def normalize_box(ymin: float, xmin: float, ymax: float, xmax: float) -> Optional[List[float]]:
+    """Clamps to 0-100, orders the corners and rejects degenerate boxes. Returns [ymin, xmin, ymax, xmax]."""
+    ymin, ymax = sorted((_clamp(ymin), _clamp(ymax)))
+    xmin, xmax = sorted((_clamp(xmin), _clamp(xmax)))
+    if ymax - ymin <= 0 or xmax - xmin <= 0:
+        return None
+    return [ymin, xmin, ymax, xmax]
+
+
+def iou(a: List[float], b: List[float]) -> float:
+    inter_h = min(a[2], b[2]) - max(a[0], b[0])
+    inter_w = min(a[3], b[3]) - max(a[1], b[1])
+    if inter_h <= 0 or inter_w <= 0:
+        return 0.0
+    inter = inter_h * inter_w
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union
+
+
+def label_before(text: str, start: int, floor: int = 0) -> str:
+    """Uses the sentence fragment immediately preceding a box as its label."""
+    segment = text[floor:start]
+    parts = [p for p in _SENTENCE_BREAK.split(segment) if p.strip()]
+    if not parts:
+        return DEFAULT_LABEL
+    label = _LABEL_NOISE.sub("", parts[-1])
+    # Drop section headers such as "Findings: ..."
+    label = label.rsplit(":", 1)[-1].strip(" ,-") or label.strip(" :,-")
+    if not label:
+        return DEFAULT_LABEL
+    if len(label) > MAX_LABEL_CHARS:
+        label = label[:MAX_LABEL_CHARS].rsplit(" ", 1)[0] + "…"
+    return label[0].upper() + label[1:]
+
+
+def to_annotation(box: List[float], label: str) -> Dict[str, Any]:
+    ymin, xmin, ymax, xmax = box
+    return {"box_2d": [xmin / 100, ymin / 100, xmax / 100, ymax / 100], "label": label}
+
+
+def merge_boxes(boxes: List[Dict[str, Any]], threshold: float = MERGE_IOU_THRESHOLD) -> List[Dict[str, Any]]:
+    """Greedy non-maximum suppression: overlapping boxes collapse into their union, keeping the first label."""
+    merged: List[Dict[str, Any]] = []
+    for candidate in boxes:
+        for kept in merged:
+            if iou(kept["box"], candidate["box"]) > threshold:
+                a, b = kept["box"], candidate["box"]
+                kept["box"] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                if kept["label"] == DEFAULT_LABEL:
+                    kept["label"] = candidate["label"]
+                break
+        else:
+            merged.append(dict(candidate))
+    return merged
+
+
+def extract_boxes(text: str, pos: int = 0) -> List[Dict[str, Any]]:
+    """Returns validated boxes ({"box": [ymin, xmin, ymax, xmax], "label", "end"}) in order of appearance."""
+    found = []
+    floor = pos
+    for match in BOX_PATTERN.finditer(text, pos):
+        box = normalize_box(*map(float, match.groups()))
+        if box is not None:
+            found.append({"box": box, "label": label_before(text, match.start(), floor), "end": match.end()})
+        floor = match.end()
+    return found
+
+
+def parse_annotations(text: str) -> List[Dict[str, Any]]:
+    """Extracts, validates and merges all boxes in a complete response."""
+    return annotations_from_boxes(extract_boxes(text))
+
+
+def annotations_from_boxes(boxes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [to_annotation(b["box"], b["label"]) for b in merge_boxes(boxes)]
+
+
+def annotations_per_image(text: str, count: int) -> List[List[Dict[str, Any]]]:
+    """
+    For multi-image answers: each box belongs to the image last named before it
+    ("Image 2: ..."), or to the first image if none was named yet. Returns one
+    annotation list per image, merged within that image only.
+    """
+    references = [(m.end(), int(m.group(1))) for m in _IMAGE_REFERENCE.finditer(text) if 1 <= int(m.group(1)) <= count]
+    grouped: List[List[Dict[str, Any]]] = [[] for _ in range(count)]
+    for found in extract_boxes(text):
+        named = [number for end, number in references if end <= found["end"]]
+        grouped[(named[-1] if named else 1) - 1].append(found)
+    return [annotations_from_boxes(boxes) for boxes in grouped]
+
+
+class StreamingBoxParser:
+    """
+    Incremental variant of parse_annotations for token streams.
+    feed() returns annotations for boxes completed by the new text; a box that
+    overlaps one already emitted is suppressed since it can no longer be merged.
+    """
+
+    def __init__(self, threshold: float = MERGE_IOU_THRESHOLD):
+        self.text = ""
+        self.threshold = threshold
+        self._pos = 0
+        self._emitted: List[List[float]] = []
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        new = []
+        for found in extract_boxes(self.text, self._pos):
+            self._pos = found["end"]
+            if any(iou(box, found["box"]) > self.threshold for box in self._emitted):
+                continue
+            self._emitted.append(found["box"])
+            new.append(to_annotation(found["box"], found["label"]))
+        return new
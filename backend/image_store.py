@@ -0,0 +1,182 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from PIL import Image
+
+from metrics import metrics
+
+# Upload-once image handles.
+# POST /api/images stores an image under its content hash; image routes then
+# take image_id instead of the file, so follow-up questions about the same
+# study skip the upload and the decode. Decoded RGB images are kept in a
+# memory LRU bounded by pixel bytes; the original upload is also written to
+# disk so handles survive eviction and are shared by all API workers.
+#
+# Decoded images carry their handle as an attribute (see tag_image). The model
+# process uses it to key PreprocessCache, so the processor's resize and
+# normalize also run once per image rather than once per question.
+
+IMAGE_STORE_DIR = os.getenv("MEDSUPPORT_IMAGE_STORE_DIR", os.path.join(os.path.dirname(__file__), "image_store"))
+IMAGE_STORE_MEMORY_MB = int(os.getenv("MEDSUPPORT_IMAGE_STORE_MEMORY_MB", "512"))
+IMAGE_STORE_DISK_MB = int(os.getenv("MEDSUPPORT_IMAGE_STORE_DISK_MB", "2048"))
+PREPROCESS_CACHE_SIZE = int(os.getenv("MEDSUPPORT_PREPROCESS_CACHE_SIZE", "16"))
+# Images per /api/compare_images request; each adds its vision tokens to the prompt.
+MAX_COMPARE_IMAGES = int(os.getenv("MEDSUPPORT_MAX_COMPARE_IMAGES", "4"))
+IMAGE_ID_ATTR = "_medsupport_image_id"
+
+
+def image_id_for(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def tag_image(image: Image.Image, image_id: Optional[str]) -> Image.Image:
+    # An instance attribute rather than image.info: PIL copies info into crops and
+    # conversions, which are different pixels and must not share the handle.
+    if image_id:
+        setattr(image, IMAGE_ID_ATTR, image_id)
+    return image
+
+
+def image_id_of(image: Any) -> Optional[str]:
+    return getattr(image, IMAGE_ID_ATTR, None) if isinstance(image, Image.Image) else None
+
+
+def decode(data: bytes, image_id: Optional[str] = None) -> Image.Image:
+    with Image.open(io.BytesIO(data)) as opened:
+        image = opened.convert("RGB")
+    return tag_image(image, image_id)
+
+
+class ImageStore:
+    def __init__(self, directory: str = IMAGE_STORE_DIR, memory_bytes: int = IMAGE_STORE_MEMORY_MB << 20, disk_bytes: int = IMAGE_STORE_DISK_MB << 20):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._images: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def _path(self, image_id: str) -> str:
+        return os.path.join(self.directory, image_id)
+
+    def put(self, data: bytes) -> Tuple[str, Image.Image]:
+        """Stores an upload and returns (image_id, decoded image). Raises if it is not a single image."""
+        image_id = image_id_for(data)
+        with self._lock:
+            cached = self._images.get(image_id)
+        if cached is not None:
+            return image_id, cached
+        with Image.open(io.BytesIO(data)) as opened:
+            if getattr(opened, "n_frames", 1) > 1:
+                raise ValueError("Multi-page files cannot be stored as an image handle; use /api/process_document.")
+        image = decode(data, image_id)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(image_id)
+            if not os.path.exists(path):
+                with open(path + ".tmp", "wb") as f:
+                    f.write(data)
+                os.replace(path + ".tmp", path)
+                self._prune_disk()
+        self._remember(image_id, image)
+        metrics.incr("image_store.uploads")
+        return image_id, image
+
+    def get(self, image_id: str) -> Optional[Image.Image]:
+        with self._lock:
+            image = self._images.get(image_id)
+            if image is not None:
+                self._images.move_to_end(image_id)
+        if image is not None:
+            metrics.incr("image_store.memory_hits")
+            return image
+        if not self.directory or not all(c in "0123456789abcdef" for c in image_id) or not os.path.exists(self._path(image_id)):
+            metrics.incr("image_store.misses")
+            return None
+        try:
+            with open(self._path(image_id), "rb") as f:
+                image = decode(f.read(), image_id)
+            os.utime(self._path(image_id))
+        except FileNotFoundError:
+            # Pruned since the check above.
+            metrics.incr("image_store.misses")
+            return None
+        self._remember(image_id, image)
+        metrics.incr("image_store.disk_hits")
+        return image
+
+    def _remember(self, image_id: str, image: Image.Image):
+        size = len(image.getbands()) * image.width * image.height
+        with self._lock:
+            if image_id in self._images:
+                return
+            self._images[image_id] = image
+            self._used += size
+            while self._used > self.memory_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._used -= len(evicted.getbands()) * evicted.width * evicted.height
+
+    def _prune_disk(self):
+        # Other requests and API workers write and prune the same directory: any file may vanish meanwhile.
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+                except FileNotFoundError:
+                    pass
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries[:-1]:
+                if total <= self.disk_bytes:
+                    break
+                total -= size
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+class PreprocessCache:
+    """Small LRU of image-processor outputs, keyed by image handle and processor arguments."""
+
+    def __init__(self, size: int = PREPROCESS_CACHE_SIZE):
+        self.size = size
+        self._entries: "OrderedDict[Tuple, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(images: Any, kwargs: Dict[str, Any]) -> Optional[Tuple]:
+        images = images if isinstance(images, (list, tuple)) else [images]
+        ids = []
+        for image in images:
+            image_id = image_id_of(image)
+            if not image_id:
+                return None
+            ids.append(image_id)
+        return tuple(ids), repr(sorted((k, v) for k, v in kwargs.items() if k != "images"))
+
+    def get_or_compute(self, key: Optional[Tuple], compute: Callable[[], Any]) -> Any:
+        if key is None or self.size <= 0:
+            return compute()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                metrics.incr("image_store.preprocess_hits")
+                return self._entries[key]
+        result = compute()
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return result
+
+
+preprocess_cache = PreprocessCache()
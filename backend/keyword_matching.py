@@ -0,0 +1,66 @@
+import re
+from functools import lru_cache
+from typing import Iterable, Iterator, Set
+
+# Keyword matching shared by the serving path (semantic cache vetting) and the
+# batch evaluators. A keyword set is compiled once into a single regex and a
+# text is scanned in one pass. Matching is a case-insensitive substring match;
+# an occurrence counts as negated when a negation cue appears within 20
+# word/space characters before it.
+
+LEAK_KEYWORDS = ["thought", "i will", "reasoning", "user wants"]
+NEGATION_CUES = ["no", "without", "negative for", "absent", "free of"]
+NEGATION_WINDOW = 20
+
+_NEGATION_TAIL = re.compile(
+    r"(?:" + "|".join(re.escape(c) for c in NEGATION_CUES) + r")[\s\w]{0," + str(NEGATION_WINDOW) + r"}$"
+)
+_NEGATION_LOOKBEHIND = NEGATION_WINDOW + max(len(c) for c in NEGATION_CUES)
+
+
+class KeywordMatcher:
+    """Finds every (possibly overlapping) occurrence of a keyword set in one regex pass."""
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = sorted({kw.lower() for kw in keywords if kw}, key=len, reverse=True)
+        # Longest-first alternation inside a lookahead reports the longest keyword
+        # at every position; shorter keywords matching there are its prefixes.
+        self._prefixes = {
+            kw: [other for other in self.keywords if other != kw and kw.startswith(other)]
+            for kw in self.keywords
+        }
+        if self.keywords:
+            self._pattern = re.compile("(?=(" + "|".join(re.escape(kw) for kw in self.keywords) + "))")
+        else:
+            self._pattern = None
+
+    def positions(self, text_lower: str) -> Iterator[tuple]:
+        if self._pattern is None:
+            return
+        for match in self._pattern.finditer(text_lower):
+            kw = match.group(1)
+            start = match.start()
+            yield kw, start
+            for prefix in self._prefixes[kw]:
+                yield prefix, start
+
+    def found(self, text: str) -> Set[str]:
+        return {kw for kw, _ in self.positions(text.lower())}
+
+    def found_not_negated(self, text: str) -> Set[str]:
+        """Keywords present in text with no negated occurrence (e.g. "no fracture")."""
+        text_lower = text.lower()
+        present, negated = set(), set()
+        for kw, start in self.positions(text_lower):
+            present.add(kw)
+            if kw not in negated and _NEGATION_TAIL.search(text_lower, max(0, start - _NEGATION_LOOKBEHIND), start):
+                negated.add(kw)
+        return present - negated
+
+
+@lru_cache(maxsize=4096)
+def get_matcher(keywords: tuple) -> KeywordMatcher:
+    return KeywordMatcher(keywords)
+
+
+LEAK_MATCHER = KeywordMatcher(LEAK_KEYWORDS)
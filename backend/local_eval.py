@@ -0,0 +1,308 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+# Add project root to sys.path to resolve 'backend' module
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.abspath(os.path.join(current_dir, ".."))
+if root_dir not in sys.path:
+    sys.path.insert(0, root_dir)
+
+from backend import evaluate_medsupport as evals
+
+# Local evaluation engine.
+# Runs the same suites, targets and evaluators as evaluate_medsupport.py but
+# without LangSmith: model outputs are cached by (input hash, model version) in
+# a local SQLite store, heuristic evaluators run in a thread pool while
+# inference continues, and judge prompts are sent in batches.
+
+EVAL_STORE_PATH = os.getenv("MEDSUPPORT_EVAL_STORE", os.path.join(current_dir, "eval_results", "eval_store.sqlite"))
+JUDGE_BATCH_SIZE = 8
+
+
+class LocalJudgeStub:
+    """Offline stand-in for the Gemini judge. Answers every prompt with a fixed 1-5 score.
+
+    For exercising the pipeline only: its scores say nothing about the model, so
+    results print judge keys as "(stub)" and the store records judge "stub".
+    """
+
+    def __init__(self, score: int = 3):
+        self.score = score
+
+    def batch(self, prompts: List[str], config: Optional[Dict[str, Any]] = None) -> List[Any]:
+        return [SimpleNamespace(content=str(self.score)) for _ in prompts]
+
+
+class EvalStore:
+    """SQLite store for cached model outputs and evaluator feedback."""
+
+    def __init__(self, path: str = EVAL_STORE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                cache_key TEXT PRIMARY KEY,
+                suite TEXT,
+                model_version TEXT,
+                inputs_json TEXT,
+                outputs_json TEXT,
+                latency_seconds REAL,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS experiments (
+                experiment_id TEXT PRIMARY KEY,
+                suite TEXT,
+                model_version TEXT,
+                judge TEXT,
+                metadata_json TEXT,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS feedback (
+                experiment_id TEXT,
+                example_index INTEGER,
+                key TEXT,
+                score REAL,
+                comment TEXT
+            );
+        """)
+        self._conn.commit()
+
+    def get_output(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT outputs_json FROM outputs WHERE cache_key = ?", (cache_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_output(self, cache_key: str, suite: str, model_version: str, inputs: Dict[str, Any], outputs: Dict[str, Any], latency: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key, suite, model_version, json.dumps(inputs), json.dumps(outputs), latency, time.time()),
+            )
+            self._conn.commit()
+
+    def start_experiment(self, suite: str, model_version: str, judge: str, metadata: Dict[str, Any]) -> str:
+        experiment_id = f"{suite}-{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO experiments VALUES (?, ?, ?, ?, ?, ?, NULL)",
+                (experiment_id, suite, model_version, judge, json.dumps(metadata), time.time()),
+            )
+            self._conn.commit()
+        return experiment_id
+
+    def finish_experiment(self, experiment_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE experiments SET finished_at = ? WHERE experiment_id = ?", (time.time(), experiment_id))
+            self._conn.commit()
+
+    def add_feedback(self, experiment_id: str, example_index: int, feedback: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO feedback VALUES (?, ?, ?, ?, ?)",
+                (experiment_id, example_index, feedback["key"], feedback.get("score"), feedback.get("comment")),
+            )
+            self._conn.commit()
+
+
+def example_cache_key(suite_name: str, inputs: Dict[str, Any], model_version: str) -> str:
+    """Hashes the example inputs (including image bytes) together with the model version."""
+    digest = hashlib.sha256()
+    digest.update(suite_name.encode())
+    digest.update(json.dumps(inputs, sort_keys=True).encode())
+    image_path = inputs.get("image_path")
+    if image_path and os.path.exists(image_path):
+        with open(image_path, "rb") as f:
+            digest.update(f.read())
+    digest.update(model_version.encode())
+    return digest.hexdigest()
+
+
+class LocalEvaluationRunner:
+    def __init__(
+        self,
+        store: EvalStore,
+        judge: Any = None,
+        judge_name: str = "none",
+        target_workers: int = 1,
+        evaluator_workers: int = 8,
+        judge_concurrency: int = 8,
+        model_version: Optional[str] = None,
+    ):
+        # The MLX model is a single in-process instance, so target_workers
+        # defaults to 1; raise it only when targets hit independent replicas.
+        self.store = store
+        self.judge = judge
+        self.judge_name = judge_name
+        self.target_workers = target_workers
+        self.evaluator_workers = evaluator_workers
+        self.judge_concurrency = judge_concurrency
+        self.model_version = model_version or os.getenv("MEDSUPPORT_MODEL_VERSION", evals.chain_manager.model.model_path)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _run_target(self, suite: Dict[str, Any], inputs: Dict[str, Any], cache_key: str) -> Dict[str, Any]:
+        start = time.perf_counter()
+        outputs = suite["target"](inputs)
+        self.store.put_output(cache_key, suite["name"], self.model_version, inputs, outputs, time.perf_counter() - start)
+        return outputs
+
+    def _judge_batch(self, experiment_id: str, batch: List[tuple]) -> List[Dict[str, Any]]:
+        prompts = [prompt for _, _, prompt in batch]
+        try:
+            replies = self.judge.batch(prompts, config={"max_concurrency": self.judge_concurrency})
+            scores = [evals.parse_judge_score(reply.content) for reply in replies]
+        except Exception as e:
+            print(f"Judge batch failed: {e}")
+            scores = [0.5] * len(batch)
+
+        results = []
+        for (example_index, key, _), score in zip(batch, scores):
+            feedback = {"key": key, "score": score}
+            self.store.add_feedback(experiment_id, example_index, feedback)
+            results.append(feedback)
+        return results
+
+    def _run_heuristics(self, experiment_id: str, example_index: int, evaluators: list, run: Any, example: Any) -> List[Dict[str, Any]]:
+        results = []
+        for evaluator in evaluators:
+            feedback = evaluator(run, example)
+            self.store.add_feedback(experiment_id, example_index, feedback)
+            results.append(feedback)
+        return results
+
+    def run(self, suites: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+        """Evaluates all suites concurrently and returns mean score per feedback key per suite."""
+        experiments = {}
+        pending_targets = {}
+        ready = []
+
+        with ThreadPoolExecutor(max_workers=self.target_workers) as target_pool, \
+             ThreadPoolExecutor(max_workers=self.evaluator_workers) as evaluator_pool:
+            for suite in suites:
+                experiments[suite["name"]] = self.store.start_experiment(
+                    suite["name"], self.model_version, self.judge_name, suite["metadata"]
+                )
+                for index, example in enumerate(evals.valid_examples(suite["examples"])):
+                    cache_key = example_cache_key(suite["name"], example["inputs"], self.model_version)
+                    cached = self.store.get_output(cache_key)
+                    if cached is not None:
+                        self.cache_hits += 1
+                        ready.append((suite, index, example, cached))
+                    else:
+                        self.cache_misses += 1
+                        future = target_pool.submit(self._run_target, suite, example["inputs"], cache_key)
+                        pending_targets[future] = (suite, index, example)
+
+            def completed_outputs():
+                yield from ready
+                for future in as_completed(pending_targets):
+                    suite, index, example = pending_targets[future]
+                    try:
+                        yield suite, index, example, future.result()
+                    except Exception as e:
+                        print(f"❌ Target failed for {suite['name']}[{index}]: {e}")
+
+            eval_futures = []
+            judge_queues: Dict[str, List[tuple]] = {name: [] for name in experiments}
+            for suite, index, example, outputs in completed_outputs():
+                experiment_id = experiments[suite["name"]]
+                run = SimpleNamespace(outputs=outputs)
+                ex = SimpleNamespace(inputs=example["inputs"], outputs=example["outputs"])
+
+                heuristics = [e for e in suite["evaluators"] if e not in evals.JUDGE_EVALUATORS]
+                judged = [e for e in suite["evaluators"] if e in evals.JUDGE_EVALUATORS]
+                if self.judge is None:
+                    # Keep the original "skipped" feedback when no judge is configured.
+                    heuristics += judged
+                    judged = []
+                eval_futures.append((suite["name"], evaluator_pool.submit(
+                    self._run_heuristics, experiment_id, index, heuristics, run, ex
+                )))
+
+                queue = judge_queues[suite["name"]]
+                for evaluator in judged:
+                    key, build_prompt = evals.JUDGE_EVALUATORS[evaluator]
+                    queue.append((index, key, build_prompt(run, ex)))
+                if len(queue) >= JUDGE_BATCH_SIZE:
+                    eval_futures.append((suite["name"], evaluator_pool.submit(self._judge_batch, experiment_id, queue[:])))
+                    queue.clear()
+
+            for name, queue in judge_queues.items():
+                if queue:
+                    eval_futures.append((name, evaluator_pool.submit(self._judge_batch, experiments[name], queue[:])))
+
+            scores: Dict[str, Dict[str, List[float]]] = {name: {} for name in experiments}
+            for name, future in eval_futures:
+                for feedback in future.result():
+                    if feedback.get("score") is not None:
+                        scores[name].setdefault(feedback["key"], []).append(feedback["score"])
+
+        for experiment_id in experiments.values():
+            self.store.finish_experiment(experiment_id)
+
+        return {
+            name: {key: sum(values) / len(values) for key, values in keys.items()}
+            for name, keys in scores.items()
+        }
+
+
+def build_judge(kind: str):
+    if kind == "stub":
+        return LocalJudgeStub()
+    if kind == "gemini":
+        if not evals.evaluator_llm:
+            print("⚠️ GOOGLE_API_KEY not set; judge evaluators will be skipped.")
+        return evals.evaluator_llm
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run MedSupport evaluations locally.")
+    parser.add_argument("--suites", default=",".join(s["name"] for s in evals.SUITES),
+                        help="Comma-separated suite names (text,image,scribe,simplify).")
+    parser.add_argument("--judge", choices=["stub", "gemini", "none"], default="none",
+                        help="Judge for LLM-graded evaluators; 'stub' returns fixed scores for testing the pipeline.")
+    parser.add_argument("--target-workers", type=int, default=1)
+    parser.add_argument("--evaluator-workers", type=int, default=8)
+    parser.add_argument("--judge-concurrency", type=int, default=8)
+    parser.add_argument("--store", default=EVAL_STORE_PATH)
+    args = parser.parse_args()
+
+    wanted = set(args.suites.split(","))
+    suites = [s for s in evals.SUITES if s["name"] in wanted]
+    runner = LocalEvaluationRunner(
+        EvalStore(args.store),
+        judge=build_judge(args.judge),
+        judge_name=args.judge,
+        target_workers=args.target_workers,
+        evaluator_workers=args.evaluator_workers,
+        judge_concurrency=args.judge_concurrency,
+    )
+
+    print(f"🚀 Starting local MedSupport evaluations ({', '.join(s['name'] for s in suites)})...")
+    start = time.perf_counter()
+    results = runner.run(suites)
+    stub_keys = {key for key, _ in evals.JUDGE_EVALUATORS.values()} if args.judge == "stub" else set()
+    for name, keys in results.items():
+        print(f"\n--- {name} ---")
+        for key, score in sorted(keys.items()):
+            print(f"{key}{' (stub)' if key in stub_keys else ''}: {score:.2f}")
+    print(f"\n✨ Done in {time.perf_counter() - start:.1f}s "
+          f"(cache hits: {runner.cache_hits}, misses: {runner.cache_misses}). Results stored in {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import math
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+from documents import DOCUMENT_WORKERS
+from metrics import metrics
+
+# Map-reduce for clinical notes longer than one comfortable prompt.
+# analyze_text and simplify_report switch to this mode when the input exceeds
+# LONG_DOCUMENT_TOKENS: the text is split on section headers, sections are
+# packed into chunks of balanced size (from real token counts), each chunk is
+# summarized on its own (in parallel across model-server replicas), and the
+# partial summaries are reduced, hierarchically if needed, into one answer.
+# Prefill cost grows with the chunk size instead of the whole note.
+
+LONG_DOCUMENT_TOKENS = int(os.getenv("MEDSUPPORT_LONG_DOCUMENT_TOKENS", "4096"))
+MAX_CHUNK_TOKENS = int(os.getenv("MEDSUPPORT_MAX_CHUNK_TOKENS", "2048"))
+LONG_DOCUMENT_TASKS = ("analyze", "simplify")
+
+# "HISTORY OF PRESENT ILLNESS:", "Assessment and Plan:", "## Medications", "MEDICATIONS"
+_SECTION_HEADER = re.compile(
+    r"^[ \t]*(?:#{1,6}[ \t]+\S.*|[A-Z][A-Za-z0-9 /&(),'-]{2,60}:|[A-Z][A-Z0-9 /&(),'-]{3,60})[ \t]*$",
+    re.MULTILINE,
+)
+_PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def split_sections(text: str) -> List[str]:
+    starts = sorted({0} | {m.start() for m in _SECTION_HEADER.finditer(text)})
+    sections = [text[a:b].strip() for a, b in zip(starts, starts[1:] + [len(text)])]
+    return [s for s in sections if s]
+
+
+def _split_oversized(section: str, tokens: int, limit: int) -> List[str]:
+    """Splits a section on paragraphs, then sentences, then characters; tokens are apportioned by length."""
+    per_char = tokens / max(1, len(section))
+    for pattern in (_PARAGRAPH_BREAK, _SENTENCE_END):
+        parts = [p.strip() for p in pattern.split(section) if p.strip()]
+        if len(parts) > 1:
+            pieces: List[str] = []
+            for part in parts:
+                part_tokens = math.ceil(len(part) * per_char)
+                pieces += _split_oversized(part, part_tokens, limit) if part_tokens > limit else [part]
+            return pieces
+    width = max(1, int(limit / per_char)) if per_char else len(section)
+    return [section[i:i + width] for i in range(0, len(section), width)]
+
+
+def plan_chunks(sections: List[str], section_tokens: List[int], max_chunk_tokens: int = MAX_CHUNK_TOKENS) -> List[str]:
+    """
+    Packs consecutive sections into chunks. The chunk size is tuned from the token
+    total: the fewest chunks that fit max_chunk_tokens, balanced so the last one is
+    not a small remainder.
+    """
+    pieces: List[tuple] = []
+    for section, tokens in zip(sections, section_tokens):
+        if tokens > max_chunk_tokens:
+            per_char = tokens / max(1, len(section))
+            pieces += [(p, math.ceil(len(p) * per_char)) for p in _split_oversized(section, tokens, max_chunk_tokens)]
+        else:
+            pieces.append((section, tokens))
+
+    total = sum(tokens for _, tokens in pieces)
+    target = math.ceil(total / max(1, math.ceil(total / max_chunk_tokens)))
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece, tokens in pieces:
+        if current and (current_tokens + tokens > max_chunk_tokens or current_tokens >= target):
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _group_partials(partials: List[str], tokens: List[int], limit: int) -> List[List[str]]:
+    """Consecutive groups within limit tokens, at least two partials each so every round shrinks the list."""
+    groups: List[List[str]] = []
+    used = 0
+    for partial, count in zip(partials, tokens):
+        if groups and (len(groups[-1]) < 2 or used + count <= limit):
+            groups[-1].append(partial)
+            used += count
+        else:
+            groups.append([partial])
+            used = count
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        groups[-2] += groups.pop()
+    return groups
+
+
+def is_long(chain_manager: Any, text: str, threshold: int = LONG_DOCUMENT_TOKENS) -> bool:
+    # A token is at least one character, so short inputs skip the tokenizer.
+    if len(text) <= threshold:
+        return False
+    return chain_manager.count_tokens([text])[0] > threshold
+
+
+def map_reduce(chain_manager: Any, text: str, task: str, workers: int = DOCUMENT_WORKERS, max_chunk_tokens: int = MAX_CHUNK_TOKENS) -> Dict[str, Any]:
+    """Returns {"result", "map_reduce": {"chunks", "chunk_tokens", "input_tokens", "reduce_rounds", "timings"}}."""
+    timings: Dict[str, float] = {}
+
+    start = time.perf_counter()
+    sections = split_sections(text)
+    section_tokens = chain_manager.count_tokens(sections)
+    chunks = plan_chunks(sections, section_tokens, max_chunk_tokens)
+    timings["chunk_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        partials = list(pool.map(lambda args: chain_manager.summarize_chunk(task, args[1], args[0], len(chunks)), enumerate(chunks, 1)))
+    timings["map_seconds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rounds = 0
+    while len(partials) > 1:
+        # Partials that do not fit one prompt are reduced in groups, then again.
+        rounds += 1
+        groups = _group_partials(partials, chain_manager.count_tokens(partials), max_chunk_tokens)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            partials = list(pool.map(lambda group: chain_manager.reduce_summaries(task, group), groups))
+    timings["reduce_seconds"] = time.perf_counter() - start
+
+    for stage, seconds in timings.items():
+        metrics.observe(f"long_document.{stage}", seconds)
+    metrics.incr("long_document.requests")
+    return {
+        "result": partials[0],
+        "map_reduce": {
+            "chunks": len(chunks),
+            "chunk_tokens": max(chain_manager.count_tokens(chunks)),
+            "input_tokens": sum(section_tokens),
+            "reduce_rounds": rounds,
+            "timings": timings,
+        },
+    }
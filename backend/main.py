@@ -1,10 +1,31 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from dotenv import load_dotenv
+
+# Load .env before local modules read their settings
+load_dotenv()
+
+from fastapi import Depends, FastAPI, File, Header, UploadFile, Form, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from chain_manager import ChainManager
+from typing import List, Optional
+from background_loader import BackgroundLoader
+from coalescing import CoalescingProxy
+from profiler import PROFILE_HEADER, ProfileStore, profile_request, should_profile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from grounding import StreamingBoxParser, parse_annotations
+from tiling import TILING_MODES
+from documents import DOCUMENT_TASKS, PDF_BACKEND_MISSING, is_document, is_pdf, pdf_support, process_document
+from long_documents import is_long, map_reduce
+from metrics import metrics
+from ocr_router import OCRRouter
+from semantic_cache import SemanticCache
+from image_store import MAX_COMPARE_IMAGES, ImageStore
+import hmac
+import json
 import logging
+import os
 import sys
-import re
+import threading
 
 app = FastAPI(title="MedSupport API")
 
@@ -17,8 +38,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global chain manager
-chain_manager = ChainManager()
+# Global chain manager. With MEDSUPPORT_MODEL_SERVER set, inference is forwarded
+# to dedicated model-server processes and this worker never loads the model.
+# Either way the heavy imports happen in a background thread started at startup,
+# so the HTTP layer answers /api/health right away.
+# Identical concurrent requests share one generation (see coalescing.py).
+# Handlers run every call into it through run_in_threadpool, so a generation
+# never blocks the event loop. An in-process ChainManager shares one model,
+# processor and cache set, so its calls are serialized by a lock as in
+# model_server.py; model servers serialize on their side.
+def build_chain_manager():
+    if os.getenv("MEDSUPPORT_MODEL_SERVER"):
+        from model_server import ModelServerClient
+        return CoalescingProxy(ModelServerClient.from_env(os.getenv("MEDSUPPORT_MODEL_SERVER")))
+    from chain_manager import ChainManager
+    return CoalescingProxy(ChainManager(), lock=threading.Lock())
+
+chain_manager = BackgroundLoader(build_chain_manager)
+
+# Typed Scribe uploads take the OCR -> text-only path when the transcription is clean
+ocr_router = OCRRouter(chain_manager)
+semantic_cache = SemanticCache()
+image_store = ImageStore()
+
+@app.on_event("startup")
+def start_background_loading():
+    chain_manager.start()
 
 # --- Logging Configuration ---
 logger = logging.getLogger("medsupport")
@@ -29,22 +74,163 @@ log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messa
 c_handler.setFormatter(log_format)
 logger.addHandler(c_handler)
 
+# --- Profiling ---
+profile_store = ProfileStore()
+
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    if not request.url.path.startswith("/api/") or request.url.path.startswith("/api/admin/"):
+        return await call_next(request)
+    if not should_profile(request.headers.get(PROFILE_HEADER)):
+        return await call_next(request)
+
+    with profile_request(request.url.path) as session:
+        response = await call_next(request)
+    profile_store.save(session)
+    logger.info(f"Profiled {session.endpoint} as {session.request_id} ({session.total_seconds:.2f}s)")
+    response.headers["X-MedSupport-Profile-Id"] = session.request_id
+    return response
+
+# --- Inference readiness ---
+# Requests that need the model wait for the background import off the event loop.
+@app.middleware("http")
+async def inference_ready_middleware(request: Request, call_next):
+    path = request.url.path
+    if chain_manager.ready or not path.startswith("/api/") or path == "/api/health" or path.startswith("/api/admin/"):
+        return await call_next(request)
+    try:
+        await run_in_threadpool(chain_manager.get)
+    except RuntimeError as e:
+        logger.error(f"Inference modules unavailable: {e}")
+        return JSONResponse(status_code=503, content={"detail": str(e)})
+    return await call_next(request)
+
 class TextRequest(BaseModel):
     text: str
+    # Return typed entities decoded under a JSON schema instead of free text.
+    structured: bool = False
+
+class Medication(BaseModel):
+    name: str
+    dose: str = ""
+    frequency: str = ""
+
+class Vital(BaseModel):
+    name: str
+    value: str
+
+class ClinicalEntities(BaseModel):
+    summary: str = ""
+    conditions: List[str] = []
+    medications: List[Medication] = []
+    vitals: List[Vital] = []
+
+class QuestionRequest(BaseModel):
+    question: str
+
+class SessionResponse(BaseModel):
+    session_id: str
+    result: str
+    turn: int
+    prompt_tokens: int = 0
+    # Tokens served from the session's KV cache instead of being prefilled again.
+    cached_tokens: int = 0
+
+class ComparisonResponse(BaseModel):
+    result: str
+    # One annotation list per image, in request order.
+    annotations: List[list] = []
 
 class AnalysisResponse(BaseModel):
     result: str
     annotations: list = []
+    entities: Optional[ClinicalEntities] = None
+    # Set when the answer came from the semantic cache; an admin removes a wrong one via /api/admin/semantic_cache/{cache_id}/false_hit.
+    cache_id: Optional[str] = None
+    # Long-document mode: chunk count, token sizes and per-stage timings (chunk, map, reduce).
+    map_reduce: Optional[dict] = None
 
 @app.get("/api/health")
 async def health_check():
-    return {"status": "ok"}
+    return {"status": "ok", "inference_ready": chain_manager.ready}
+
+@app.get("/api/admin/model")
+async def model_stats():
+    if not chain_manager.ready:
+        return {"loaded": False, "detail": f"Inference modules {chain_manager.status}"}
+    model = getattr(chain_manager, "model", None)
+    if model is None:
+        return {"loaded": None, "detail": "Model runs in a separate model-server process"}
+    return {"loaded": model.is_loaded, "load_stats": model.load_stats}
+
+@app.get("/api/admin/metrics")
+async def get_metrics():
+    snapshot = metrics.snapshot()
+    snapshot["ocr_routing"] = ocr_router.stats()
+    snapshot["semantic_cache"] = semantic_cache.stats()
+    return snapshot
+
+@app.get("/api/admin/prompts")
+async def prompt_stats():
+    """Per endpoint: prompt tokens and prefill seconds per generation, and tokens saved by prompt compaction."""
+    if not chain_manager.ready:
+        return {"endpoints": {}, "detail": f"Inference modules {chain_manager.status}"}
+    return {"endpoints": await run_in_threadpool(chain_manager.prompt_report)}
+
+# --- Admin authentication ---
+# Routes that expose or change other users' data (cache review, profiles with
+# request contents) need the X-MedSupport-Admin-Key header to match
+# MEDSUPPORT_ADMIN_KEY. Without a configured key they are closed.
+ADMIN_KEY = os.getenv("MEDSUPPORT_ADMIN_KEY", "")
+
+def require_admin(x_medsupport_admin_key: str = Header("")):
+    if not ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="Admin routes are disabled; set MEDSUPPORT_ADMIN_KEY to enable them.")
+    if not hmac.compare_digest(x_medsupport_admin_key.encode(), ADMIN_KEY.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
+
+@app.get("/api/admin/semantic_cache/pending", dependencies=[Depends(require_admin)])
+async def pending_cache_entries():
+    """Generated answers waiting for review; none of them is served until approved."""
+    return {"entries": await run_in_threadpool(semantic_cache.pending)}
+
+@app.post("/api/admin/semantic_cache/{cache_id}/approve", dependencies=[Depends(require_admin)])
+async def approve_cache_entry(cache_id: str):
+    if not await run_in_threadpool(semantic_cache.approve, cache_id):
+        raise HTTPException(status_code=404, detail="Cache entry not found")
+    return {"status": "approved"}
+
+@app.post("/api/admin/semantic_cache/{cache_id}/false_hit", dependencies=[Depends(require_admin)])
+async def report_false_hit(cache_id: str):
+    if not await run_in_threadpool(semantic_cache.report_false_hit, cache_id):
+        raise HTTPException(status_code=404, detail="Cache entry not found")
+    return {"status": "removed"}
+
+@app.get("/api/admin/profiles", dependencies=[Depends(require_admin)])
+async def list_profiles(limit: int = 10):
+    return {"profiles": profile_store.slowest(limit)}
+
+@app.get("/api/admin/profiles/{request_id}", dependencies=[Depends(require_admin)])
+async def get_profile(request_id: str):
+    profile = profile_store.get(request_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile
 
 @app.post("/api/analyze_text", response_model=AnalysisResponse)
 async def analyze_text(request: TextRequest):
     logger.info(f"Received text analysis request. Length: {len(request.text)} chars")
     try:
-        response = chain_manager.analyze_text(request.text)
+        if request.structured:
+            return await run_in_threadpool(chain_manager.extract_entities_text, request.text)
+        hit = await run_in_threadpool(semantic_cache.lookup, request.text)
+        if hit:
+            logger.info(f"Semantic cache hit ({hit['similarity']:.3f}): {hit['question']!r}")
+            return {"result": hit["answer"], "cache_id": hit["id"]}
+        if await run_in_threadpool(is_long, chain_manager, request.text):
+            return await run_in_threadpool(map_reduce, chain_manager, request.text, "analyze")
+        response = await run_in_threadpool(chain_manager.analyze_text, request.text)
+        await run_in_threadpool(semantic_cache.add, request.text, response)
         return {"result": response}
     except Exception as e:
         logger.error(f"Text analysis failed: {e}", exc_info=True)
@@ -54,54 +240,205 @@ async def analyze_text(request: TextRequest):
 async def simplify_report(request: TextRequest):
     logger.info(f"Received simplify report request. Length: {len(request.text)} chars")
     try:
-        response = chain_manager.simplify_report(request.text)
+        if await run_in_threadpool(is_long, chain_manager, request.text):
+            return await run_in_threadpool(map_reduce, chain_manager, request.text, "simplify")
+        response = await run_in_threadpool(chain_manager.simplify_report, request.text)
         return {"result": response}
     except Exception as e:
         logger.error(f"Report simplification failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Upload-once image handles ---
+
+@app.post("/api/images")
+async def upload_image(file: UploadFile = File(...)):
+    """Stores an image and returns its handle; pass it as image_id to any image route instead of re-uploading."""
+    contents = await file.read()
+    try:
+        image_id, image = await run_in_threadpool(image_store.put, contents)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not store image: {e}")
+    logger.info(f"Stored image {image_id} ({file.filename}, {image.width}x{image.height})")
+    return {"image_id": image_id, "width": image.width, "height": image.height}
+
+async def read_image_input(file: Optional[UploadFile], image_id: str):
+    """Upload bytes, or the stored decoded image for an image_id from /api/images."""
+    if image_id:
+        image = await run_in_threadpool(image_store.get, image_id)
+        if image is None:
+            raise HTTPException(status_code=404, detail="Unknown image_id; upload the image again via /api/images")
+        return image
+    if file is None:
+        raise HTTPException(status_code=400, detail="Provide a file or an image_id.")
+    return await file.read()
+
 @app.post("/api/analyze_image", response_model=AnalysisResponse)
-async def analyze_image(file: UploadFile = File(...), prompt: str = Form("Describe the medical findings in this image.")):
-    logger.info(f"Received image analysis request. File: {file.filename}, Prompt: {prompt}")
+async def analyze_image(file: Optional[UploadFile] = File(None), prompt: str = Form("Describe the medical findings in this image."), tiling: str = Form("off"), image_id: str = Form("")):
+    logger.info(f"Received image analysis request. File: {file.filename if file else image_id}, Prompt: {prompt}, Tiling: {tiling}")
+    if tiling not in TILING_MODES:
+        raise HTTPException(status_code=400, detail=f"tiling must be one of {', '.join(TILING_MODES)}")
+    contents = await read_image_input(file, image_id)
     try:
-        contents = await file.read()
-        response_text = chain_manager.analyze_image(contents, prompt)
-        
-        # Parse bounding boxes
-        box_pattern = r"\[(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?),\s*(\d+(?:\.\d+)?)\]"
-        matches = re.finditer(box_pattern, response_text)
-        
-        annotations = []
-        for match in matches:
-            y1, x1, y2, x2 = map(float, match.groups())
-            annotations.append({
-                "box_2d": [x1/100, y1/100, x2/100, y2/100],
-                "label": "Abnormality"
-            })
-            
+        if tiling != "off":
+            return await run_in_threadpool(chain_manager.analyze_image_tiled, contents, prompt, tiling)
+        response_text = await run_in_threadpool(chain_manager.analyze_image, contents, prompt)
+        annotations = parse_annotations(response_text)
         return {"result": response_text, "annotations": annotations}
     except Exception as e:
         logger.error(f"Image analysis failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/compare_images", response_model=ComparisonResponse)
+async def compare_images(files: List[UploadFile] = File([]), image_ids: List[str] = Form([]), labels: List[str] = Form([]), prompt: str = Form("")):
+    """
+    Compares several images (e.g. a prior and a current study) in one generation. Images are
+    taken from image_ids first, then files; labels ("last month", "today") name them in order.
+    """
+    logger.info(f"Received image comparison request. Files: {[f.filename for f in files]}, Image ids: {image_ids}, Prompt: {prompt}")
+    count = len(files) + len(image_ids)
+    if not 2 <= count <= MAX_COMPARE_IMAGES:
+        raise HTTPException(status_code=400, detail=f"Provide between 2 and {MAX_COMPARE_IMAGES} images.")
+    images = [await read_image_input(None, image_id) for image_id in image_ids]
+    images += [await file.read() for file in files]
+    try:
+        return await run_in_threadpool(chain_manager.compare_images, images, prompt, labels)
+    except Exception as e:
+        logger.error(f"Image comparison failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/analyze_image_stream")
+async def analyze_image_stream(file: Optional[UploadFile] = File(None), prompt: str = Form("Describe the medical findings in this image."), image_id: str = Form("")):
+    """
+    Streams newline-delimited JSON events: {"type": "box", "annotation": ...} as soon as each
+    bounding box is generated, then {"type": "done", "result": ..., "annotations": [...]}.
+    """
+    logger.info(f"Received streaming image analysis request. File: {file.filename if file else image_id}, Prompt: {prompt}")
+    contents = await read_image_input(file, image_id)
+
+    def events():
+        parser = StreamingBoxParser()
+        try:
+            for chunk in chain_manager.stream_image_analysis(contents, prompt):
+                for annotation in parser.feed(chunk):
+                    yield json.dumps({"type": "box", "annotation": annotation}) + "\n"
+            response_text = chain_manager.finalize_stream(parser.text)
+            yield json.dumps({"type": "done", "result": response_text, "annotations": parse_annotations(response_text)}) + "\n"
+        except Exception as e:
+            logger.error(f"Streaming image analysis failed: {e}", exc_info=True)
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.post("/api/analyze_note_multimodal", response_model=AnalysisResponse)
-async def analyze_note_multimodal(file: UploadFile = File(...), prompt: str = Form("")):
-    logger.info(f"Received multimodal scribe request. File: {file.filename}, Prompt: {prompt}")
+async def analyze_note_multimodal(file: Optional[UploadFile] = File(None), prompt: str = Form(""), structured: bool = Form(False), image_id: str = Form("")):
+    logger.info(f"Received multimodal scribe request. File: {file.filename if file else image_id}, Prompt: {prompt}, Structured: {structured}")
+    contents = await read_image_input(file, image_id)
+    document = await document_upload(contents)
     try:
-        contents = await file.read()
-        response_text = chain_manager.analyze_note_multimodal(contents, prompt)
+        if structured:
+            if document:
+                raise HTTPException(status_code=400, detail="Structured output supports single images; use /api/process_document for PDFs and multi-page files.")
+            return await run_in_threadpool(chain_manager.extract_entities_image, contents, prompt)
+        if document:
+            return {"result": await run_in_threadpool(merged_document_result, contents, "scribe", prompt)}
+        response_text = await run_in_threadpool(ocr_router.analyze_note, contents, prompt)
         return {"result": response_text}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Multimodal scribe failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/simplify_report_multimodal", response_model=AnalysisResponse)
-async def simplify_report_multimodal(file: UploadFile = File(...), prompt: str = Form("")):
-    logger.info(f"Received multimodal report simplify request. File: {file.filename}, Prompt: {prompt}")
+async def simplify_report_multimodal(file: Optional[UploadFile] = File(None), prompt: str = Form(""), image_id: str = Form("")):
+    logger.info(f"Received multimodal report simplify request. File: {file.filename if file else image_id}, Prompt: {prompt}")
+    contents = await read_image_input(file, image_id)
+    document = await document_upload(contents)
     try:
-        contents = await file.read()
-        response_text = chain_manager.simplify_report_multimodal(contents, prompt)
+        if document:
+            return {"result": await run_in_threadpool(merged_document_result, contents, "simplify", prompt)}
+        response_text = await run_in_threadpool(chain_manager.simplify_report_multimodal, contents, prompt)
         return {"result": response_text}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Multimodal report simplification failed: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+
+def require_pdf_support(contents: bytes):
+    if is_pdf(contents) and not pdf_support():
+        raise HTTPException(status_code=501, detail=PDF_BACKEND_MISSING)
+
+async def document_upload(contents) -> bool:
+    """True for uploads that take the document pipeline: any PDF, whatever its page count, or a multi-page TIFF."""
+    if not isinstance(contents, bytes):
+        return False
+    require_pdf_support(contents)
+    try:
+        return await run_in_threadpool(is_document, contents)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not read document: {e}")
+
+def document_page_method(task: str):
+    return ocr_router.analyze_note if task == "scribe" else None
+
+def merged_document_result(contents: bytes, task: str, prompt: str) -> str:
+    for event in process_document(chain_manager, contents, task, prompt, page_method=document_page_method(task)):
+        if event["type"] == "done":
+            return event["result"]
+
+@app.post("/api/process_document")
+async def process_document_stream(file: UploadFile = File(...), task: str = Form("scribe"), prompt: str = Form("")):
+    """
+    Multi-page PDF / TIFF ingestion for Clinical Scribe (task=scribe) and Patient Portal (task=simplify).
+    Streams newline-delimited JSON: one {"type": "page", ...} event per processed page, then
+    {"type": "done", "result": ..., "pages": n} with the merged answer.
+    """
+    logger.info(f"Received document request. File: {file.filename}, Task: {task}, Prompt: {prompt}")
+    if task not in DOCUMENT_TASKS:
+        raise HTTPException(status_code=400, detail=f"task must be one of {', '.join(DOCUMENT_TASKS)}")
+    contents = await file.read()
+    require_pdf_support(contents)
+
+    def events():
+        try:
+            for event in process_document(chain_manager, contents, task, prompt, page_method=document_page_method(task)):
+                yield json.dumps(event) + "\n"
+        except Exception as e:
+            logger.error(f"Document processing failed: {e}", exc_info=True)
+            yield json.dumps({"type": "error", "detail": str(e)}) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+# --- Conversational sessions (follow-up questions reuse the conversation's KV cache) ---
+
+@app.post("/api/sessions", response_model=SessionResponse)
+async def start_session(file: Optional[UploadFile] = File(None), text: str = Form(""), prompt: str = Form(""), image_id: str = Form("")):
+    logger.info(f"Received session start. File: {file.filename if file else image_id or None}, Text length: {len(text)}, Prompt: {prompt}")
+    if file is None and not image_id and not text.strip():
+        raise HTTPException(status_code=400, detail="Provide a report image (file or image_id) or report text.")
+    contents = await read_image_input(file, image_id) if file is not None or image_id else None
+    try:
+        return await run_in_threadpool(chain_manager.start_session, contents, text, prompt)
+    except Exception as e:
+        logger.error(f"Session start failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/sessions/{session_id}/ask", response_model=SessionResponse)
+async def ask_session(session_id: str, request: QuestionRequest):
+    logger.info(f"Received follow-up for session {session_id}. Length: {len(request.question)} chars")
+    try:
+        response = await run_in_threadpool(chain_manager.ask_session, session_id, request.question)
+    except Exception as e:
+        logger.error(f"Session follow-up failed: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+    if response is None:
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return response
+
+@app.delete("/api/sessions/{session_id}")
+async def end_session(session_id: str):
+    if not await run_in_threadpool(chain_manager.end_session, session_id):
+        raise HTTPException(status_code=404, detail="Session not found or expired")
+    return {"status": "ended"}
+
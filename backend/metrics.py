@@ -0,0 +1,55 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+# Minimal in-process metrics: counters and timing summaries, exposed by
+# /api/admin/metrics. Each API worker keeps its own numbers.
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            t = self._timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+            t["count"] += 1
+            t["total"] += value
+            t["max"] = max(t["max"], value)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def mean(self, name: str) -> float:
+        with self._lock:
+            t = self._timings.get(name)
+            return t["total"] / t["count"] if t and t["count"] else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "timings": {
+                    name: {"count": t["count"], "mean": t["total"] / t["count"] if t["count"] else 0.0, "max": t["max"], "total": t["total"]}
+                    for name, t in self._timings.items()
+                },
+            }
+
+
+metrics = Metrics()
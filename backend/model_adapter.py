@@ -1,39 +1,51 @@
-import mlx_vlm
-from mlx_vlm import load, generate
+from mlx_vlm import generate, stream_generate
 from mlx_vlm.prompt_utils import apply_chat_template
 from mlx_vlm.utils import load_config
 import os
 import re
-import torch
-import numpy as np
-from typing import Any, List, Optional, Dict
+from typing import Any, Iterator, List, Optional, Dict
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
 from pydantic import Field
+from profiler import profiled, profile_section
+from weight_loading import load_weights
+from constrained_decoding import JSONSchemaLogitsProcessor
+from image_store import PREPROCESS_CACHE_SIZE, image_id_of, preprocess_cache
+from prompts import record_generation, set_token_counter
 
 # Patch for Gemma3Processor and ImageProcessor (transformers 5.x)
 def apply_mlx_vlm_patches(processor):
+    # torch is only needed once a processor exists, so it is imported here rather than at module import.
+    import torch
     try:
         # Patch 1: Main Processor __call__ to handle NumPy conversion for mlx_vlm
         original_call = processor.__call__
         def patched_call(*args, **kwargs):
             kwargs["return_tensors"] = "pt"
-            res = original_call(*args, **kwargs)
-            return {k: v.detach().cpu().numpy() if torch.is_tensor(v) else v for k, v in res.items()}
+            with profile_section("processor.call"):
+                res = original_call(*args, **kwargs)
+            with profile_section("processor.torch_to_numpy"):
+                return {k: v.detach().cpu().numpy() if torch.is_tensor(v) else v for k, v in res.items()}
         processor.__call__ = patched_call
         
         # Patch 2: ImageProcessor preprocess (called directly in some mlx_vlm paths)
         if hasattr(processor, "image_processor"):
             original_preprocess = processor.image_processor.preprocess
-            def patched_preprocess(*args, **kwargs):
+            def convert_preprocess(*args, **kwargs):
                 kwargs["return_tensors"] = "pt"
-                res = original_preprocess(*args, **kwargs)
+                with profile_section("image_processor.preprocess"):
+                    res = original_preprocess(*args, **kwargs)
                 if isinstance(res, dict):
                     return {k: v.detach().cpu().numpy() if torch.is_tensor(v) else v for k, v in res.items()}
                 elif isinstance(res, list):
                     return [v.detach().cpu().numpy() if torch.is_tensor(v) else v for v in res]
                 return res
+            def patched_preprocess(*args, **kwargs):
+                # Images from an upload handle are preprocessed once and reused.
+                images = args[0] if args else kwargs.get("images")
+                key = preprocess_cache.key(images, kwargs)
+                return preprocess_cache.get_or_compute(key, lambda: convert_preprocess(*args, **kwargs))
             processor.image_processor.preprocess = patched_preprocess
             
         print("DEBUG: Applied Gemma3 patches to processor and image_processor.")
@@ -46,44 +58,44 @@ class MLXVLMAdapter(BaseChatModel):
     processor: Any = Field(default=None, exclude=True)
     boi_char: str = Field(default="", exclude=True)
     is_loaded: bool = Field(default=False)
+    load_stats: Dict[str, Any] = Field(default_factory=dict, exclude=True)
+    vision_cache: Any = Field(default=None, exclude=True)
 
-    def _generate(
-        self,
-        messages: List[BaseMessage],
-        stop: Optional[List[str]] = None,
-        run_manager: Optional[Any] = None,
-        **kwargs: Any,
-    ) -> ChatResult:
-        if not self.is_loaded:
-            self._load_model()
-
-        # Extract prompt string
-        prompt = ""
-        image = kwargs.get("image")
-        
+    def _format_prompt(self, messages: List[BaseMessage], image: Any) -> str:
+        # Extract the conversation turns; a plain invoke is a single user turn.
+        formatted_messages = []
         for msg in messages:
-            if isinstance(msg, HumanMessage):
-                if isinstance(msg.content, list):
-                    for part in msg.content:
-                        if part["type"] == "text":
-                            prompt = part["text"]
-                else:
-                    prompt = msg.content
-                break
+            if not isinstance(msg, (HumanMessage, AIMessage)):
+                continue
+            text = ""
+            if isinstance(msg.content, list):
+                for part in msg.content:
+                    if part["type"] == "text":
+                        text = part["text"]
+            else:
+                text = msg.content
+            formatted_messages.append({"role": "user" if isinstance(msg, HumanMessage) else "assistant", "content": text})
 
-        # Standard multimodal structure for apply_chat_template
-        if image:
-            formatted_messages = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}]
-        else:
-            formatted_messages = [{"role": "user", "content": prompt}]
+        # Standard multimodal structure for apply_chat_template: the image belongs to the first user turn
+        if image and formatted_messages:
+            if isinstance(image, list):
+                # Several images: each one follows its name ("Image 1:", ...) so the answer can refer to it.
+                parts = []
+                for i in range(1, len(image) + 1):
+                    parts += [{"type": "text", "text": f"Image {i}:"}, {"type": "image"}]
+                formatted_messages[0]["content"] = parts + [{"type": "text", "text": formatted_messages[0]["content"]}]
+            else:
+                formatted_messages[0]["content"] = [{"type": "image"}, {"type": "text", "text": formatted_messages[0]["content"]}]
 
-        config = load_config(self.model_path, trust_remote_code=True)
-        formatted_prompt = apply_chat_template(
-            self.processor, 
-            config, 
-            formatted_messages, 
-            add_generation_prompt=True
-        )
+        with profile_section("adapter.load_config"):
+            config = load_config(self.model_path, trust_remote_code=True)
+        with profile_section("adapter.apply_chat_template"):
+            formatted_prompt = apply_chat_template(
+                self.processor, 
+                config, 
+                formatted_messages, 
+                add_generation_prompt=True
+            )
 
         # Handle Gemma 3 image tokens manually using the programmatically decoded boi_char
         if image:
@@ -97,25 +109,103 @@ class MLXVLMAdapter(BaseChatModel):
                 else:
                     formatted_prompt += self.boi_char
                 print(f"DEBUG: Manually inserted decoded boi_char (repr: {repr(self.boi_char)})")
+        return formatted_prompt
 
-        output = generate(
+    @profiled("adapter.generate")
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if not self.is_loaded:
+            self._load_model()
+
+        image = kwargs.get("image")
+        formatted_prompt = self._format_prompt(messages, image)
+
+        # json_schema constrains decoding token by token, so the output is the JSON document itself.
+        json_schema = kwargs.get("json_schema")
+        extra = {}
+        if json_schema:
+            tokenizer = getattr(self.processor, "tokenizer", self.processor)
+            extra["logits_processors"] = [JSONSchemaLogitsProcessor(json_schema, tokenizer)]
+        # A session's PromptCacheState keeps the KV cache between turns; only the new suffix is prefilled.
+        if kwargs.get("prompt_cache_state") is not None:
+            extra["prompt_cache_state"] = kwargs["prompt_cache_state"]
+        # Handle images also keep their projected vision features between questions.
+        if image_id_of(image) and self.vision_cache is not None:
+            extra["vision_cache"] = self.vision_cache
+
+        with profile_section("adapter.mlx_generate"):
+            output = generate(
+                self.model, 
+                self.processor, 
+                formatted_prompt, 
+                image, 
+                max_tokens=kwargs.get("max_tokens", 512),
+                temperature=kwargs.get("temperature", 0.1),
+                # A repetition penalty would fight the grammar's repeated braces and quotes.
+                repetition_penalty=None if json_schema else kwargs.get("repetition_penalty", 1.1),
+                **extra
+            )
+        record_generation(getattr(output, "prompt_tokens", 0), getattr(output, "prompt_tps", 0.0))
+
+        if json_schema:
+            cleaned_text = output.text.strip()
+        else:
+            with profile_section("adapter.post_process"):
+                cleaned_text = self._post_process(output.text)
+        ai_msg = AIMessage(content=cleaned_text, response_metadata={
+            "raw_text": output.text,
+            "prompt_tokens": getattr(output, "prompt_tokens", 0),
+            "cached_tokens": getattr(output, "cached_tokens", 0),
+        })
+        return ChatResult(generations=[ChatGeneration(message=ai_msg)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        # Yields raw model text as it is decoded; callers apply _post_process
+        # to the accumulated text once the stream ends.
+        if not self.is_loaded:
+            self._load_model()
+
+        image = kwargs.get("image")
+        formatted_prompt = self._format_prompt(messages, image)
+
+        extra = {"vision_cache": self.vision_cache} if image_id_of(image) and self.vision_cache is not None else {}
+
+        chunk = None
+        for chunk in stream_generate(
             self.model, 
             self.processor, 
             formatted_prompt, 
             image, 
             max_tokens=kwargs.get("max_tokens", 512),
             temperature=kwargs.get("temperature", 0.1),
-            repetition_penalty=kwargs.get("repetition_penalty", 1.1)
-        )
-
-        cleaned_text = self._post_process(output.text)
-        ai_msg = AIMessage(content=cleaned_text)
-        return ChatResult(generations=[ChatGeneration(message=ai_msg)])
+            repetition_penalty=kwargs.get("repetition_penalty", 1.1),
+            **extra
+        ):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk.text))
+        if chunk is not None:
+            record_generation(chunk.prompt_tokens, chunk.prompt_tps)
 
+    @profiled("adapter.load_model")
     def _load_model(self):
         print(f"Loading local MLX model: {self.model_path}")
-        self.model, self.processor = load(self.model_path, trust_remote_code=True)
-        apply_mlx_vlm_patches(self.processor)
+        self.model, self.processor, self.load_stats = load_weights(self.model_path)
+        with profile_section("adapter.apply_mlx_vlm_patches"):
+            apply_mlx_vlm_patches(self.processor)
+        from mlx_vlm.vision_cache import VisionFeatureCache
+        self.vision_cache = VisionFeatureCache(max_size=PREPROCESS_CACHE_SIZE)
+        tokenizer = getattr(self.processor, "tokenizer", self.processor)
+        set_token_counter(lambda text: len(tokenizer.encode(text, add_special_tokens=False)))
         
         # Get the CORRECT boi_char from tokenizer
         try:
@@ -127,6 +217,13 @@ class MLXVLMAdapter(BaseChatModel):
             
         self.is_loaded = True
 
+    def count_tokens(self, texts: List[str]) -> List[int]:
+        """Token counts from the model's own tokenizer, without special tokens."""
+        if not self.is_loaded:
+            self._load_model()
+        tokenizer = getattr(self.processor, "tokenizer", self.processor)
+        return [len(tokenizer.encode(text, add_special_tokens=False)) for text in texts]
+
     def _post_process(self, text: str) -> str:
         cleaned = re.sub(r'<unused\d+>', '', text)
         if "Strategizing complete. Proceeding with response generation." in cleaned:
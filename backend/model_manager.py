@@ -6,6 +6,7 @@ from PIL import Image
 import os
 import re
 from types import SimpleNamespace
+from weight_loading import load_weights
 
 class ModelManager:
     def __init__(self, model_path="Rafath1/medgemma-medsupport-4bit"):
@@ -13,6 +14,7 @@ class ModelManager:
         self.model = None
         self.processor = None
         self.is_loaded = False
+        self.load_stats = {}
 
     def load_model(self):
         if self.is_loaded:
@@ -20,7 +22,7 @@ class ModelManager:
         
         print(f"Loading model: {self.model_path}")
         try:
-            self.model, self.processor = load(self.model_path, trust_remote_code=True)
+            self.model, self.processor, self.load_stats = load_weights(self.model_path)
             self.is_loaded = True
             print("Model loaded successfully.")
         except Exception as e:
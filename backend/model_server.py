@@ -0,0 +1,331 @@
+import argparse
+import io
+import itertools
+import os
+import queue
+import threading
+import uuid
+import zlib
+from multiprocessing import resource_tracker
+from multiprocessing.connection import Client, Listener
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, Iterator, List, Optional
+
+from PIL import Image
+
+from coalescing import CoalescingProxy
+from image_store import image_id_of, tag_image
+
+# Split deployment: API workers (uvicorn, any number of processes) forward
+# inference calls to one or more dedicated model-server processes that each
+# hold a ChainManager / MLXVLMAdapter. Requests travel over a local
+# multiprocessing connection; decoded RGB pixels are placed in shared memory
+# and only the segment name is sent, so images are never pickled.
+#
+#   python model_server.py --address /tmp/medsupport-model-0.sock
+#   MEDSUPPORT_MODEL_SERVER=/tmp/medsupport-model-0.sock uvicorn main:app --workers 4
+
+MODEL_SERVER_ADDRESSES = os.getenv("MEDSUPPORT_MODEL_SERVER", "")
+# Requests are pickled, so a connection must authenticate. Unix sockets are
+# protected by file permissions and fall back to a fixed key; TCP addresses
+# require MEDSUPPORT_MODEL_SERVER_KEY to be set on both sides.
+MODEL_SERVER_KEY = os.getenv("MEDSUPPORT_MODEL_SERVER_KEY", "")
+DEFAULT_UNIX_SOCKET_KEY = "medsupport"
+
+# ChainManager methods whose first argument is an uploaded image.
+# Methods whose first argument is a list of images, each shared in its own segment.
+IMAGE_LIST_METHODS = {"compare_images"}
+IMAGE_METHODS = {"analyze_image", "analyze_image_tiled", "stream_image_analysis", "analyze_note_multimodal", "simplify_report_multimodal", "extract_entities_image", "start_session"}
+ALLOWED_METHODS = IMAGE_METHODS | {"analyze_text", "simplify_report", "finalize_stream", "merge_document_pages", "analyze_note_text", "extract_entities_text", "ask_session", "end_session", "count_tokens", "summarize_chunk", "reduce_summaries", "prompt_report"} | IMAGE_LIST_METHODS
+STREAM_METHODS = {"stream_image_analysis"}
+
+
+def parse_address(address: str):
+    """'host:port' becomes a TCP address; anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def authkey_for(address) -> bytes:
+    if MODEL_SERVER_KEY:
+        return MODEL_SERVER_KEY.encode()
+    if isinstance(address, tuple):
+        raise RuntimeError(f"Model server address {address[0]}:{address[1]} is TCP; set MEDSUPPORT_MODEL_SERVER_KEY to a secret shared by the server and its clients.")
+    return DEFAULT_UNIX_SOCKET_KEY.encode()
+
+
+# --- Shared-memory image transfer ---
+
+def share_image(image_data):
+    """Decodes an upload (or takes a decoded page) in the API worker and copies its pixels into a new shared-memory segment."""
+    image_id = image_id_of(image_data)
+    if isinstance(image_data, Image.Image):
+        image = image_data if image_data.mode == "RGB" else image_data.convert("RGB")
+    else:
+        image = Image.open(io.BytesIO(image_data)).convert("RGB")
+    data = image.tobytes()
+    shm = SharedMemory(create=True, size=max(len(data), 1))
+    shm.buf[:len(data)] = data
+    # The upload handle travels along so the model process can reuse preprocessing.
+    return shm, {"shm": shm.name, "size": list(image.size), "mode": image.mode, "nbytes": len(data), "image_id": image_id, "pid": os.getpid()}
+
+
+def attach_image(descriptor: Dict[str, Any]) -> Image.Image:
+    shm = SharedMemory(name=descriptor["shm"])
+    # The creating API worker owns the segment; stop this process's resource
+    # tracker from unlinking it on exit.
+    if descriptor.get("pid") != os.getpid():
+        try:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+    try:
+        view = shm.buf[:descriptor["nbytes"]]
+        image = Image.frombytes(descriptor["mode"], tuple(descriptor["size"]), view)
+        view.release()
+        return tag_image(image, descriptor.get("image_id"))
+    finally:
+        shm.close()
+
+
+def release_shared(shms: List[SharedMemory]):
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+# --- Server ---
+
+class ModelServer:
+    def __init__(self, address: str, chain_manager: Any = None, preload: bool = True):
+        self.address = parse_address(address)
+        self.authkey = authkey_for(self.address)
+        if chain_manager is None:
+            from chain_manager import ChainManager
+            chain_manager = ChainManager()
+        # One MLX model per process: generations run one at a time. Identical requests
+        # from different API workers are coalesced before they queue for the lock.
+        self._lock = threading.Lock()
+        self.chain_manager = CoalescingProxy(chain_manager, lock=self._lock)
+        if preload and not chain_manager.model.is_loaded:
+            chain_manager.model._load_model()
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Model server listening on {self.address}")
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    self._dispatch(conn, request)
+                except OSError:
+                    # Client went away mid-stream.
+                    return
+
+    def _dispatch(self, conn, request: Dict[str, Any]):
+        method = request.get("method")
+        if method not in ALLOWED_METHODS:
+            conn.send({"ok": False, "error": f"Unknown method: {method}"})
+            return
+
+        args = list(request.get("args", []))
+        try:
+            if request.get("image"):
+                args.insert(0, attach_image(request["image"]))
+            elif request.get("images"):
+                args.insert(0, [attach_image(descriptor) for descriptor in request["images"]])
+            target = getattr(self.chain_manager, method)
+            if method in STREAM_METHODS:
+                for chunk in target(*args, **request.get("kwargs", {})):
+                    conn.send({"ok": True, "chunk": chunk})
+                conn.send({"ok": True, "done": True})
+            else:
+                conn.send({"ok": True, "result": target(*args, **request.get("kwargs", {}))})
+        except Exception as e:
+            print(f"Model server call {method} failed: {e}")
+            conn.send({"ok": False, "error": str(e)})
+
+
+# --- Client ---
+
+class ModelServerError(RuntimeError):
+    pass
+
+
+class ModelServerClient:
+    """Drop-in replacement for ChainManager that forwards calls to model-server processes."""
+
+    def __init__(self, addresses: List[str]):
+        if not addresses:
+            raise ValueError("At least one model server address is required")
+        self.addresses = [parse_address(a) for a in addresses]
+        self.authkeys = [authkey_for(a) for a in self.addresses]
+        self._pools = {i: queue.LifoQueue() for i in range(len(self.addresses))}
+        self._next = itertools.cycle(range(len(self.addresses)))
+        self._next_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, value: str = MODEL_SERVER_ADDRESSES) -> "ModelServerClient":
+        return cls([a.strip() for a in value.split(",") if a.strip()])
+
+    def _acquire(self, index: Optional[int] = None):
+        if index is None:
+            with self._next_lock:
+                index = next(self._next)
+        try:
+            return index, self._pools[index].get_nowait()
+        except queue.Empty:
+            return index, Client(self.addresses[index], authkey=self.authkeys[index])
+
+    def _release(self, index: int, conn, reusable: bool):
+        if reusable:
+            self._pools[index].put(conn)
+        else:
+            conn.close()
+
+    def _request(self, method: str, args: tuple, kwargs: Dict[str, Any]):
+        shms = []
+        request = {"method": method, "args": list(args), "kwargs": kwargs}
+        if method in IMAGE_METHODS and args[0] is not None:
+            shm, request["image"] = share_image(args[0])
+            shms.append(shm)
+            request["args"] = list(args[1:])
+        elif method in IMAGE_LIST_METHODS:
+            request["images"] = []
+            try:
+                for image in args[0]:
+                    shm, descriptor = share_image(image)
+                    shms.append(shm)
+                    request["images"].append(descriptor)
+            except Exception:
+                release_shared(shms)
+                raise
+            request["args"] = list(args[1:])
+        return shms, request
+
+    def _replica_for(self, session_id: str) -> int:
+        # A session's KV cache lives in one replica, so its turns must all go there.
+        return zlib.crc32(session_id.encode()) % len(self.addresses)
+
+    def _call(self, method: str, *args, _replica: Optional[int] = None, **kwargs):
+        shms, request = self._request(method, args, kwargs)
+        try:
+            # Connecting may fail (server down, wrong key); the segments are released either way.
+            index, conn = self._acquire(_replica)
+            reusable = False
+            try:
+                conn.send(request)
+                reply = conn.recv()
+                reusable = True
+            finally:
+                self._release(index, conn, reusable)
+        finally:
+            release_shared(shms)
+        if not reply["ok"]:
+            raise ModelServerError(reply["error"])
+        return reply["result"]
+
+    def _stream(self, method: str, *args, **kwargs) -> Iterator[str]:
+        shms, request = self._request(method, args, kwargs)
+        try:
+            index, conn = self._acquire()
+            reusable = False
+            try:
+                conn.send(request)
+                while True:
+                    reply = conn.recv()
+                    if not reply["ok"]:
+                        reusable = True
+                        raise ModelServerError(reply["error"])
+                    if reply.get("done"):
+                        reusable = True
+                        return
+                    yield reply["chunk"]
+            finally:
+                # A stream abandoned mid-way leaves unread messages; drop that connection.
+                self._release(index, conn, reusable)
+        finally:
+            release_shared(shms)
+
+    def analyze_text(self, text: str):
+        return self._call("analyze_text", text)
+
+    def simplify_report(self, text: str):
+        return self._call("simplify_report", text)
+
+    def analyze_image(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image."):
+        return self._call("analyze_image", image_bytes, user_prompt)
+
+    def analyze_image_tiled(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image.", mode: str = "full"):
+        return self._call("analyze_image_tiled", image_bytes, user_prompt, mode)
+
+    def stream_image_analysis(self, image_bytes: bytes, user_prompt: str = "Describe the medical findings in this image."):
+        return self._stream("stream_image_analysis", image_bytes, user_prompt)
+
+    def compare_images(self, images: list, user_prompt: str = "", labels: Optional[list] = None):
+        return self._call("compare_images", images, user_prompt, labels)
+
+    def finalize_stream(self, text: str) -> str:
+        return self._call("finalize_stream", text)
+
+    def analyze_note_multimodal(self, image_bytes: bytes, user_prompt: str = ""):
+        return self._call("analyze_note_multimodal", image_bytes, user_prompt)
+
+    def simplify_report_multimodal(self, image_bytes: bytes, user_prompt: str = ""):
+        return self._call("simplify_report_multimodal", image_bytes, user_prompt)
+
+    def analyze_note_text(self, ocr_text: str, user_prompt: str = ""):
+        return self._call("analyze_note_text", ocr_text, user_prompt)
+
+    def merge_document_pages(self, task: str, page_results: list, user_prompt: str = ""):
+        return self._call("merge_document_pages", task, page_results, user_prompt)
+
+    def count_tokens(self, texts: list):
+        return self._call("count_tokens", texts)
+
+    def prompt_report(self):
+        # Reports the replica this call lands on.
+        return self._call("prompt_report")
+
+    def summarize_chunk(self, task: str, chunk: str, part: int, parts: int):
+        return self._call("summarize_chunk", task, chunk, part, parts)
+
+    def reduce_summaries(self, task: str, summaries: list):
+        return self._call("reduce_summaries", task, summaries)
+
+    def extract_entities_text(self, text: str):
+        return self._call("extract_entities_text", text)
+
+    def extract_entities_image(self, image_bytes: bytes, user_prompt: str = ""):
+        return self._call("extract_entities_image", image_bytes, user_prompt)
+
+    def start_session(self, image_bytes=None, text: str = "", user_prompt: str = "", session_id: str = None):
+        session_id = session_id or uuid.uuid4().hex
+        return self._call("start_session", image_bytes, text, user_prompt, session_id, _replica=self._replica_for(session_id))
+
+    def ask_session(self, session_id: str, question: str):
+        return self._call("ask_session", session_id, question, _replica=self._replica_for(session_id))
+
+    def end_session(self, session_id: str) -> bool:
+        return self._call("end_session", session_id, _replica=self._replica_for(session_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a MedSupport model server process.")
+    parser.add_argument("--address", default="/tmp/medsupport-model-0.sock",
+                        help="Unix socket path or host:port to listen on.")
+    parser.add_argument("--no-preload", action="store_true", help="Load the model on first request instead of at startup.")
+    args = parser.parse_args()
+    ModelServer(args.address, preload=not args.no_preload).serve_forever()
@@ -0,0 +1,111 @@
+import io
+import os
+import shutil
+import time
+from typing import Any, Dict, Tuple
+
+from PIL import Image
+
+from metrics import metrics
+
+# OCR fast path for Clinical Scribe.
+# Clean typed printouts do not need the vision encoder: a local Tesseract pass
+# extracts the text, and when its confidence is high the note is analyzed with
+# text-only inference (ChainManager.analyze_note_text). Anything that OCRs
+# poorly (handwriting, photos, scans with noise) falls back to the vision path.
+# Requires the optional pytesseract package and the tesseract binary.
+#
+# MEDSUPPORT_OCR_ROUTING: "auto" (use when available), "on", or "off".
+
+OCR_ROUTING = os.getenv("MEDSUPPORT_OCR_ROUTING", "auto")
+MIN_WORDS = int(os.getenv("MEDSUPPORT_OCR_MIN_WORDS", "15"))
+MIN_MEAN_CONFIDENCE = float(os.getenv("MEDSUPPORT_OCR_MIN_CONFIDENCE", "80"))
+MAX_LOW_CONFIDENCE_FRACTION = 0.15
+LOW_CONFIDENCE = 60
+
+
+def ocr_available() -> bool:
+    try:
+        import pytesseract  # noqa: F401
+    except ImportError:
+        return False
+    return shutil.which("tesseract") is not None
+
+
+def run_ocr(image: Image.Image) -> Tuple[str, Dict[str, float]]:
+    """Returns (text, quality) where quality has words, mean_confidence and low_confidence_fraction."""
+    import pytesseract
+
+    data = pytesseract.image_to_data(image.convert("L"), output_type=pytesseract.Output.DICT)
+    lines: Dict[Tuple[int, int, int], list] = {}
+    confidences = []
+    for i, word in enumerate(data["text"]):
+        conf = float(data["conf"][i])
+        if not word.strip() or conf < 0:
+            continue
+        confidences.append(conf)
+        lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+
+    text = "\n".join(" ".join(words) for _, words in sorted(lines.items()))
+    words = len(confidences)
+    quality = {
+        "words": words,
+        "mean_confidence": sum(confidences) / words if words else 0.0,
+        "low_confidence_fraction": sum(1 for c in confidences if c < LOW_CONFIDENCE) / words if words else 1.0,
+    }
+    return text, quality
+
+
+def is_clean(quality: Dict[str, float]) -> bool:
+    return (
+        quality["words"] >= MIN_WORDS
+        and quality["mean_confidence"] >= MIN_MEAN_CONFIDENCE
+        and quality["low_confidence_fraction"] <= MAX_LOW_CONFIDENCE_FRACTION
+    )
+
+
+class OCRRouter:
+    def __init__(self, chain_manager: Any, mode: str = OCR_ROUTING):
+        self.chain_manager = chain_manager
+        self.enabled = mode == "on" or (mode == "auto" and ocr_available())
+        if mode == "on" and not ocr_available():
+            print("WARNING: MEDSUPPORT_OCR_ROUTING=on but pytesseract/tesseract is not installed; using vision only.")
+            self.enabled = False
+
+    def analyze_note(self, image_data: Any, user_prompt: str = "") -> str:
+        """Drop-in for ChainManager.analyze_note_multimodal that takes the text path when OCR is clean."""
+        if self.enabled:
+            image = image_data if isinstance(image_data, Image.Image) else Image.open(io.BytesIO(image_data))
+            start = time.perf_counter()
+            try:
+                text, quality = run_ocr(image)
+            except Exception as e:
+                print(f"OCR failed, falling back to vision: {e}")
+                text, quality = "", None
+            ocr_seconds = time.perf_counter() - start
+            metrics.observe("scribe.ocr_seconds", ocr_seconds)
+
+            if quality and is_clean(quality):
+                metrics.incr("scribe.routed_text")
+                start = time.perf_counter()
+                result = self.chain_manager.analyze_note_text(text, user_prompt)
+                metrics.observe("scribe.text_route_total_seconds", ocr_seconds + time.perf_counter() - start)
+                return result
+
+        metrics.incr("scribe.routed_vision")
+        with metrics.timer("scribe.vision_path_seconds"):
+            return self.chain_manager.analyze_note_multimodal(image_data, user_prompt)
+
+    def stats(self) -> Dict[str, Any]:
+        routed_text = metrics.counter("scribe.routed_text")
+        vision = metrics.mean("scribe.vision_path_seconds")
+        text_route = metrics.mean("scribe.text_route_total_seconds")
+        saved = routed_text * (vision - text_route) if vision and text_route else None
+        return {
+            "enabled": self.enabled,
+            "routed_text": routed_text,
+            "routed_vision": metrics.counter("scribe.routed_vision"),
+            "mean_vision_seconds": vision,
+            "mean_text_route_seconds": text_route,
+            "estimated_seconds_saved": saved,
+        }
@@ -0,0 +1,268 @@
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+# Opt-in request profiling.
+# A request is profiled when it carries the PROFILE_HEADER or is picked by the
+# sampling rate. Sections (load_config, processor patches, image decode,
+# generate, ...) are timed individually, and the outermost profiled call also
+# captures a cProfile trace plus tracemalloc allocations. Results are written
+# to PROFILE_DIR keyed by request id.
+
+PROFILE_HEADER = "X-MedSupport-Profile"
+PROFILE_DIR = os.getenv("MEDSUPPORT_PROFILE_DIR", os.path.join(os.path.dirname(__file__), "profiles"))
+PROFILE_SAMPLE_RATE = float(os.getenv("MEDSUPPORT_PROFILE_SAMPLE_RATE", "0"))
+# Profiles kept on disk; the oldest are removed beyond this.
+PROFILE_MAX_FILES = int(os.getenv("MEDSUPPORT_PROFILE_MAX_FILES", "500"))
+PROFILE_TOP_FUNCTIONS = 25
+PROFILE_TOP_ALLOCATIONS = 15
+
+_current_session: contextvars.ContextVar[Optional["ProfileSession"]] = contextvars.ContextVar(
+    "medsupport_profile_session", default=None
+)
+# Name of the outermost profiled call (e.g. "chain.analyze_text"), tracked whether or not
+# the request is profiled; per-endpoint metrics are keyed by it.
+_current_call: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("medsupport_current_call", default=None)
+
+# tracemalloc is process-wide: it runs while any profiled request needs it and is
+# stopped by the last one (unless something else started it). With overlapping
+# requests the reported peak covers all of them.
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+_tracemalloc_started = False
+
+
+def _acquire_tracemalloc():
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _tracemalloc_started = True
+            tracemalloc.reset_peak()
+        _tracemalloc_users += 1
+
+
+def _release_tracemalloc() -> tuple:
+    """Returns (snapshot, peak bytes) taken before tracing can stop."""
+    global _tracemalloc_users, _tracemalloc_started
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0 and _tracemalloc_started:
+            tracemalloc.stop()
+            _tracemalloc_started = False
+    return snapshot, peak
+
+
+class ProfileSession:
+    def __init__(self, request_id: str, endpoint: str):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.sections: List[Dict[str, Any]] = []
+        self.profiler: Optional[cProfile.Profile] = None
+        self.peak_memory_bytes = 0
+        self.top_allocations: List[str] = []
+        self.total_seconds = 0.0
+        # Sections of one request can run on several threads (page workers, map-reduce); each has its own nesting.
+        self._local = threading.local()
+        self._sections_lock = threading.Lock()
+
+    @property
+    def _depth(self) -> int:
+        return getattr(self._local, "depth", 0)
+
+    @_depth.setter
+    def _depth(self, value: int):
+        self._local.depth = value
+
+    def record(self, name: str, seconds: float):
+        with self._sections_lock:
+            self.sections.append({"name": name, "seconds": round(seconds, 6), "depth": self._depth})
+
+    def claim_trace(self) -> bool:
+        """Starts the cProfile/tracemalloc trace unless one is already running; True for the caller that started it."""
+        with self._sections_lock:
+            if self.profiler is not None:
+                return False
+            self.start_trace()
+            return True
+
+    def start_trace(self):
+        self.profiler = cProfile.Profile()
+        _acquire_tracemalloc()
+        self.profiler.enable()
+
+    def stop_trace(self):
+        self.profiler.disable()
+        snapshot, self.peak_memory_bytes = _release_tracemalloc()
+        self.top_allocations = [str(stat) for stat in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "endpoint": self.endpoint,
+            "started_at": self.started_at,
+            "total_seconds": round(self.total_seconds, 6),
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "sections": self.sections,
+        }
+
+    def stats_text(self) -> str:
+        if not self.profiler:
+            return ""
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        return stream.getvalue()
+
+
+class ProfileStore:
+    """Keeps profile traces on disk and a small in-memory index of their durations."""
+
+    def __init__(self, directory: str = PROFILE_DIR, max_profiles: int = PROFILE_MAX_FILES):
+        self.directory = directory
+        self.max_profiles = max(1, max_profiles)
+        self._index: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._load_index()
+        with self._lock:
+            self._prune()
+
+    def _load_index(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+                self._index[data["request_id"]] = _index_entry(data)
+            except (OSError, ValueError, KeyError):
+                continue
+
+    def save(self, session: ProfileSession):
+        os.makedirs(self.directory, exist_ok=True)
+        data = session.summary()
+        data["top_allocations"] = session.top_allocations
+        data["cprofile"] = session.stats_text()
+        base = os.path.join(self.directory, session.request_id)
+        with open(base + ".json", "w") as f:
+            json.dump(data, f, indent=2)
+        if session.profiler:
+            session.profiler.dump_stats(base + ".prof")
+        with self._lock:
+            self._index[session.request_id] = _index_entry(data)
+            self._prune()
+
+    def _prune(self):
+        # Called with self._lock held.
+        excess = len(self._index) - self.max_profiles
+        if excess <= 0:
+            return
+        for entry in sorted(self._index.values(), key=lambda e: e["started_at"])[:excess]:
+            del self._index[entry["request_id"]]
+            for ext in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(self.directory, entry["request_id"] + ext))
+                except FileNotFoundError:
+                    pass
+
+    def slowest(self, limit: int = 10) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = list(self._index.values())
+        return sorted(entries, key=lambda e: e["total_seconds"], reverse=True)[:limit]
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        path = os.path.join(self.directory, os.path.basename(request_id) + ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+
+def _index_entry(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "request_id": data["request_id"],
+        "endpoint": data.get("endpoint", ""),
+        "started_at": data.get("started_at", 0),
+        "total_seconds": data.get("total_seconds", 0.0),
+        "peak_memory_bytes": data.get("peak_memory_bytes", 0),
+    }
+
+
+def should_profile(header_value: Optional[str]) -> bool:
+    if header_value and header_value.strip().lower() in ("1", "true", "yes", "on"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+@contextmanager
+def profile_request(endpoint: str, request_id: Optional[str] = None):
+    """Activates a ProfileSession for the duration of a request."""
+    session = ProfileSession(request_id or uuid.uuid4().hex, endpoint)
+    token = _current_session.set(session)
+    start = time.perf_counter()
+    try:
+        yield session
+    finally:
+        session.total_seconds = time.perf_counter() - start
+        _current_session.reset(token)
+
+
+def current_session() -> Optional[ProfileSession]:
+    return _current_session.get()
+
+
+def current_call() -> Optional[str]:
+    return _current_call.get()
+
+
+@contextmanager
+def profile_section(name: str):
+    """Times a block when the current request is being profiled; no-op otherwise."""
+    session = _current_session.get()
+    if session is None:
+        yield
+        return
+
+    owns_trace = session.claim_trace()
+    session._depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        session._depth -= 1
+        session.record(name, elapsed)
+        if owns_trace:
+            session.stop_trace()
+
+
+def profiled(name: str):
+    """Decorator form of profile_section."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _current_call.set(name) if _current_call.get() is None else None
+            try:
+                with profile_section(name):
+                    return func(*args, **kwargs)
+            finally:
+                if token is not None:
+                    _current_call.reset(token)
+        return wrapper
+    return decorator
@@ -0,0 +1,125 @@
+import re
+import textwrap
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from metrics import metrics
+from profiler import current_call
+
+# Prompt building and per-endpoint prompt accounting.
+# Templates stay readable triple-quoted blocks in the source; build_prompt
+# strips their indentation and padding, collapses blank-line runs, drops
+# repeated lines, and fills a placeholder used on several lines only at its
+# last occurrence (the user's question is asked once, at the end). Values are
+# inserted after compaction, so a clinical note keeps its own layout.
+#
+# Accounting uses the model's real tokenizer, registered once the model is
+# loaded. Each built prompt is tokenized once and records its tokens plus the
+# tokens compaction saved on its template. Savings are counted once per
+# template with the placeholders left unfilled and cached, so they leave out
+# the values of dropped repeated placeholders. The adapter records
+# prompt tokens and prefill seconds of every generation. Both are keyed by the
+# endpoint, the outermost profiled ChainManager call, and summarized by
+# prompt_report().
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+_INNER_SPACES = re.compile(r"(?<=\S)[ \t]{2,}")
+
+_token_counter: Optional[Callable[[str], int]] = None
+# Raw template -> (compacted template, tokens saved by compaction, or None before a counter is set).
+_compacted: Dict[str, Tuple[str, Optional[int]]] = {}
+
+
+def set_token_counter(counter: Optional[Callable[[str], int]]):
+    global _token_counter
+    _token_counter = counter
+    _compacted.clear()
+
+
+def current_endpoint() -> str:
+    name = current_call() or "unknown"
+    return name[len("chain."):] if name.startswith("chain.") else name
+
+
+def render(template: str, values: Dict[str, Any]) -> str:
+    """Single-pass substitution of {name} placeholders; other braces (JSON examples, values) are left alone."""
+    return _PLACEHOLDER.sub(lambda m: str(values[m.group(1)]) if m.group(1) in values else m.group(0), template)
+
+
+def compact(template: str) -> str:
+    """Removes common indentation, trailing and repeated inner spaces, blank-line runs and repeated lines."""
+    lines = []
+    seen = set()
+    for line in textwrap.dedent(template.strip("\n")).splitlines():
+        line = _INNER_SPACES.sub(" ", line.rstrip())
+        key = line.strip()
+        if key:
+            if key in seen:
+                continue
+            seen.add(key)
+        elif not lines or not lines[-1]:
+            continue
+        lines.append(line)
+    while lines and not lines[-1]:
+        lines.pop()
+    return "\n".join(lines)
+
+
+def _last_uses_only(template: str) -> str:
+    lines = template.split("\n")
+    last_line = {}
+    for index, line in enumerate(lines):
+        for name in _PLACEHOLDER.findall(line):
+            last_line[name] = index
+    kept = [line for index, line in enumerate(lines) if all(last_line[name] == index for name in _PLACEHOLDER.findall(line))]
+    return compact("\n".join(kept))
+
+
+def _compact_template(template: str) -> Tuple[str, Optional[int]]:
+    cached = _compacted.get(template)
+    if cached is None:
+        compacted = _last_uses_only(compact(template))
+        counter = _token_counter
+        saved = counter(template) - counter(compacted) if counter is not None else None
+        cached = _compacted[template] = (compacted, saved)
+    return cached
+
+
+def build_prompt(template: str, **values: Any) -> str:
+    compacted, saved = _compact_template(template)
+    prompt = render(compacted, values)
+    if _token_counter is not None and saved is not None:
+        endpoint = current_endpoint()
+        built = _token_counter(prompt)
+        metrics.incr(f"prompt.{endpoint}.raw_tokens", built + saved)
+        metrics.incr(f"prompt.{endpoint}.built_tokens", built)
+        metrics.incr(f"prompt.{endpoint}.tokens_saved", saved)
+    return prompt
+
+
+def record_generation(prompt_tokens: int, prompt_tps: float):
+    """Called by the adapter after each generation; prompt_tokens includes the chat template and image tokens."""
+    endpoint = current_endpoint()
+    metrics.observe(f"prompt.{endpoint}.prompt_tokens", prompt_tokens)
+    if prompt_tps:
+        metrics.observe(f"prompt.{endpoint}.prefill_seconds", prompt_tokens / prompt_tps)
+
+
+def prompt_report() -> Dict[str, Dict[str, Any]]:
+    """Per endpoint: generations, mean prompt tokens and prefill seconds, and tokens saved against the raw templates."""
+    snapshot = metrics.snapshot()
+    report: Dict[str, Dict[str, Any]] = {}
+    for name, timing in snapshot["timings"].items():
+        if name.startswith("prompt.") and name.endswith(".prompt_tokens"):
+            endpoint = name[len("prompt."):-len(".prompt_tokens")]
+            prefill = snapshot["timings"].get(f"prompt.{endpoint}.prefill_seconds")
+            report[endpoint] = {
+                "generations": timing["count"],
+                "mean_prompt_tokens": timing["mean"],
+                "mean_prefill_seconds": prefill["mean"] if prefill else None,
+            }
+    for name, value in snapshot["counters"].items():
+        if name.startswith("prompt.") and name.endswith(".raw_tokens"):
+            endpoint = name[len("prompt."):-len(".raw_tokens")]
+            saved = snapshot["counters"].get(f"prompt.{endpoint}.tokens_saved", 0)
+            report.setdefault(endpoint, {}).update({"tokens_saved": saved, "saved_fraction": saved / value if value else 0.0})
+    return report
@@ -0,0 +1,281 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional
+
+from keyword_matching import LEAK_MATCHER
+from metrics import metrics
+
+# Semantic answer cache for /api/analyze_text.
+# Patients ask the same general questions ("What is TSH?", "side effects of
+# Lisinopril") in many phrasings. Questions are normalized and embedded with a
+# small local model; the nearest cached question above a cosine-similarity
+# threshold has its answer served without generation.
+#
+# Only short, single-line inputs without digits are cached: anything carrying
+# patient specifics (values, doses, dates, whole notes) always goes to the
+# model. A generated answer that passes vetting (non-empty, free of leaked
+# reasoning) is stored as pending; it is served only after a reviewer approves
+# it (POST /api/admin/semantic_cache/{id}/approve). A served answer that turns
+# out wrong for the question can be reported as a false hit, which removes it
+# and is counted in the metrics; the same route rejects a pending entry.
+#
+# The cache is off unless MEDSUPPORT_SEMANTIC_CACHE=on.
+#
+# The embedder is sentence-transformers (MEDSUPPORT_SEMANTIC_CACHE_MODEL) when
+# installed, otherwise a dependency-free hashed n-gram embedding with a
+# stricter threshold. numpy and the embedder load on first use, keeping them
+# off the API import path. Each API worker keeps its own index; the files under
+# MEDSUPPORT_SEMANTIC_CACHE_PATH hold whichever worker saved last.
+
+SEMANTIC_CACHE = os.getenv("MEDSUPPORT_SEMANTIC_CACHE", "off")
+SEMANTIC_CACHE_MODEL = os.getenv("MEDSUPPORT_SEMANTIC_CACHE_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_CACHE_PATH = os.getenv("MEDSUPPORT_SEMANTIC_CACHE_PATH", os.path.join(os.path.dirname(__file__), "semantic_cache"))
+SIMILARITY_THRESHOLD = os.getenv("MEDSUPPORT_SEMANTIC_CACHE_THRESHOLD")
+MAX_ENTRIES = int(os.getenv("MEDSUPPORT_SEMANTIC_CACHE_MAX_ENTRIES", "1000"))
+MAX_QUESTION_CHARS = 200
+HASHING_DIM = 1024
+# Ignored by the hashing embedder so that "What is TSH?" and "What is LDL?" do not look alike.
+STOPWORDS = frozenset(
+    "a an and are can could do does for how i in is it me my of on or please should tell the to what when which who why with would you "
+    "about explain exactly mean means".split()
+)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", text.lower())).strip()
+
+
+def is_cacheable(text: str) -> bool:
+    """General questions only: short, one line, and no numbers that could be patient values."""
+    text = text.strip()
+    return 0 < len(text) <= MAX_QUESTION_CHARS and "\n" not in text and not any(c.isdigit() for c in text)
+
+
+def is_vetted(answer: str) -> bool:
+    return bool(answer and answer.strip()) and not LEAK_MATCHER.found(answer)
+
+
+class HashingEmbedder:
+    """Hashed content-word and character-trigram counts, L2-normalized. No model download needed."""
+
+    name = "hashing"
+    default_threshold = 0.9
+
+    def __init__(self, dim: int = HASHING_DIM):
+        self.dim = dim
+
+    def embed(self, text: str):
+        import numpy as np
+
+        vector = np.zeros(self.dim, dtype=np.float32)
+        words = [w for w in text.split() if w not in STOPWORDS] or text.split()
+        grams = words + [f"#{w[i:i + 3]}" for w in words for i in range(max(1, len(w) - 2))]
+        for gram in grams:
+            vector[zlib.crc32(gram.encode()) % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SentenceTransformerEmbedder:
+    default_threshold = 0.92
+
+    def __init__(self, model_name: str = SEMANTIC_CACHE_MODEL):
+        from sentence_transformers import SentenceTransformer
+
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, text: str):
+        import numpy as np
+
+        return np.asarray(self.model.encode(text, normalize_embeddings=True), dtype=np.float32)
+
+
+def load_embedder():
+    try:
+        return SentenceTransformerEmbedder()
+    except ImportError:
+        return HashingEmbedder()
+    except Exception as e:
+        print(f"WARNING: Could not load embedding model {SEMANTIC_CACHE_MODEL}: {e}; using hashed n-grams.")
+        return HashingEmbedder()
+
+
+class SemanticCache:
+    def __init__(self, path: str = SEMANTIC_CACHE_PATH, max_entries: int = MAX_ENTRIES, threshold: Optional[float] = None, enabled: bool = SEMANTIC_CACHE == "on", embedder: Any = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._threshold = threshold if threshold is not None else (float(SIMILARITY_THRESHOLD) if SIMILARITY_THRESHOLD else None)
+        self._embedder = embedder
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._vectors = None  # (n, dim) float32, row i belongs to self._entries[i]
+        self._entries: List[Dict[str, Any]] = []
+
+    @property
+    def threshold(self) -> float:
+        return self._threshold if self._threshold is not None else self._embedder.default_threshold
+
+    def _ensure_loaded(self):
+        # Called with self._lock held.
+        if self._loaded:
+            return
+        import numpy as np
+
+        if self._embedder is None:
+            self._embedder = load_embedder()
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        index_file, entries_file = self._files()
+        if index_file and os.path.exists(index_file) and os.path.exists(entries_file):
+            with open(entries_file) as f:
+                stored = json.load(f)
+            # An index built with another embedder is not comparable; start over.
+            if stored.get("embedder") == self._embedder.name:
+                self._entries = stored["entries"]
+                self._vectors = np.load(index_file)
+        self._loaded = True
+
+    def _files(self):
+        if not self.path:
+            return None, None
+        return os.path.join(self.path, "index.npy"), os.path.join(self.path, "entries.json")
+
+    def _save(self):
+        # Called with self._lock held. Written to temp files and renamed, so other workers never read half a file.
+        import numpy as np
+
+        index_file, entries_file = self._files()
+        if not index_file:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(index_file + ".tmp", "wb") as f:
+            np.save(f, self._vectors)
+        with open(entries_file + ".tmp", "w") as f:
+            json.dump({"embedder": self._embedder.name, "entries": self._entries}, f)
+        os.replace(index_file + ".tmp", index_file)
+        os.replace(entries_file + ".tmp", entries_file)
+
+    def lookup(self, text: str) -> Optional[Dict[str, Any]]:
+        """Returns {"id", "answer", "question", "similarity"} for a hit, else None."""
+        if not self.enabled or not is_cacheable(text):
+            metrics.incr("semantic_cache.bypassed")
+            return None
+        import numpy as np
+
+        with self._lock:
+            self._ensure_loaded()
+            metrics.incr("semantic_cache.lookups")
+            approved = np.array([entry.get("approved", False) for entry in self._entries], dtype=bool)
+            if not approved.any():
+                metrics.incr("semantic_cache.misses")
+                return None
+            query = self._embedder.embed(normalize_question(text))
+            # Pending entries are never served.
+            scores = np.where(approved, self._vectors @ query, -1.0)
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            metrics.observe("semantic_cache.best_similarity", similarity)
+            if similarity < self.threshold:
+                metrics.incr("semantic_cache.misses")
+                return None
+            entry = self._entries[best]
+            entry["hits"] += 1
+            entry["last_used"] = time.time()
+        metrics.incr("semantic_cache.hits")
+        return {"id": entry["id"], "answer": entry["answer"], "question": entry["question"], "similarity": similarity}
+
+    def add(self, text: str, answer: str) -> bool:
+        """Stores a vetted answer as pending review. A question that already has an entry is not added again."""
+        if not self.enabled or not is_cacheable(text):
+            return False
+        if not is_vetted(answer):
+            metrics.incr("semantic_cache.rejected")
+            return False
+        import numpy as np
+
+        with self._lock:
+            self._ensure_loaded()
+            vector = self._embedder.embed(normalize_question(text))
+            if self._entries and float(np.max(self._vectors @ vector)) >= self.threshold:
+                return False
+            if len(self._entries) >= self.max_entries:
+                # Evict the least recently used pending entry; an approved one goes only when
+                # nothing is pending, so a flood of unreviewed answers costs at most one of them.
+                self._remove(min(range(len(self._entries)), key=lambda i: (self._entries[i].get("approved", False), self._entries[i]["last_used"])))
+                metrics.incr("semantic_cache.evicted")
+            entry = {"id": uuid.uuid4().hex[:12], "question": text.strip(), "answer": answer, "approved": False, "hits": 0, "created": time.time(), "last_used": time.time()}
+            self._entries.append(entry)
+            self._vectors = vector[None, :] if self._vectors.size == 0 else np.vstack([self._vectors, vector])
+            self._save()
+        metrics.incr("semantic_cache.inserted")
+        return True
+
+    def _remove(self, index: int):
+        import numpy as np
+
+        del self._entries[index]
+        self._vectors = np.delete(self._vectors, index, axis=0)
+
+    def approve(self, entry_id: str) -> bool:
+        """A reviewer checked the answer: from now on it is served for similar questions."""
+        with self._lock:
+            self._ensure_loaded()
+            for entry in self._entries:
+                if entry["id"] == entry_id:
+                    entry["approved"] = True
+                    self._save()
+                    break
+            else:
+                return False
+        metrics.incr("semantic_cache.approved")
+        return True
+
+    def pending(self) -> List[Dict[str, Any]]:
+        """Entries waiting for review, oldest first."""
+        with self._lock:
+            self._ensure_loaded()
+            return [
+                {"id": entry["id"], "question": entry["question"], "answer": entry["answer"], "created": entry["created"]}
+                for entry in self._entries
+                if not entry.get("approved", False)
+            ]
+
+    def report_false_hit(self, entry_id: str) -> bool:
+        """A served answer did not fit the question: drop the entry and count it."""
+        with self._lock:
+            self._ensure_loaded()
+            for i, entry in enumerate(self._entries):
+                if entry["id"] == entry_id:
+                    self._remove(i)
+                    self._save()
+                    break
+            else:
+                return False
+        metrics.incr("semantic_cache.false_hits")
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        hits = metrics.counter("semantic_cache.hits")
+        lookups = metrics.counter("semantic_cache.lookups")
+        with self._lock:
+            entries = len(self._entries)
+            pending = sum(not entry.get("approved", False) for entry in self._entries)
+            embedder = self._embedder.name if self._embedder is not None else None
+        return {
+            "enabled": self.enabled,
+            "embedder": embedder,
+            "threshold": self.threshold if self._embedder is not None else self._threshold,
+            "entries": entries,
+            "pending": pending,
+            "hit_rate": hits / lookups if lookups else None,
+            "false_hit_rate": metrics.counter("semantic_cache.false_hits") / hits if hits else None,
+        }
@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from metrics import metrics
+
+# Conversational sessions for follow-up questions (Patient Explainer).
+# A session keeps its image, the turns so far and mlx_vlm's PromptCacheState,
+# i.e. the KV cache of everything already prefilled. A follow-up re-templates
+# the whole conversation, mlx_vlm matches the cached token prefix, and only the
+# new question is prefilled; the vision encoder does not run again.
+#
+# Live sessions are kept in memory with LRU eviction. With
+# MEDSUPPORT_SESSION_SPILL_DIR set, evicted sessions are written to disk
+# (KV state as safetensors in the cache's own dtype, trimmed to the used
+# length, plus the image and turns) and restored on their next question.
+
+MAX_SESSIONS = int(os.getenv("MEDSUPPORT_MAX_SESSIONS", "8"))
+SESSION_SPILL_DIR = os.getenv("MEDSUPPORT_SESSION_SPILL_DIR", "")
+MAX_SPILLED_SESSIONS = int(os.getenv("MEDSUPPORT_MAX_SPILLED_SESSIONS", "64"))
+
+Turn = Tuple[str, str]  # (role, text), role is "user" or "assistant"
+
+
+def new_cache_state():
+    from mlx_vlm.generate import PromptCacheState
+
+    return PromptCacheState()
+
+
+class Session:
+    def __init__(self, session_id: str, image: Optional[Image.Image] = None, turns: Optional[List[Turn]] = None, cache_state: Any = None):
+        self.id = session_id
+        self.image = image
+        self.turns: List[Turn] = turns or []
+        self.cache_state = cache_state if cache_state is not None else new_cache_state()
+        # One turn at a time per conversation.
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+
+
+# --- Disk spill ---
+
+def save_session(session: Session, spill_dir: str):
+    """Writes {id}.safetensors (KV state + metadata) and {id}.png (the image, if any)."""
+    import mlx.core as mx
+    from mlx.utils import tree_flatten
+
+    cache = session.cache_state.cache or []
+    arrays = dict(tree_flatten([c.state for c in cache]))
+    metadata = {
+        "classes": json.dumps([type(c).__name__ for c in cache]),
+        "meta_state": json.dumps([c.meta_state for c in cache]),
+        "token_ids": json.dumps(session.cache_state.token_ids or []),
+        "turns": json.dumps(session.turns),
+    }
+    base = os.path.join(spill_dir, session.id)
+    mx.save_safetensors(base + ".safetensors", arrays, metadata=metadata)
+    if session.image is not None:
+        session.image.save(base + ".png")
+
+
+def load_session(session_id: str, spill_dir: str) -> Optional[Session]:
+    import mlx.core as mx
+    from mlx.utils import tree_unflatten
+    from mlx_vlm.models import cache as cache_module
+
+    base = os.path.join(spill_dir, session_id)
+    if not os.path.exists(base + ".safetensors"):
+        return None
+    arrays, metadata = mx.load(base + ".safetensors", return_metadata=True)
+    classes = json.loads(metadata["classes"])
+    states = tree_unflatten(list(arrays.items())) if arrays else []
+    meta_states = json.loads(metadata["meta_state"])
+    cache_state = new_cache_state()
+    if classes:
+        cache_state.update(
+            json.loads(metadata["token_ids"]),
+            [getattr(cache_module, name).from_state(state, meta) for name, state, meta in zip(classes, states, meta_states)],
+        )
+    image = None
+    if os.path.exists(base + ".png"):
+        with Image.open(base + ".png") as stored:
+            image = stored.convert("RGB")
+    turns = [tuple(turn) for turn in json.loads(metadata["turns"])]
+    return Session(session_id, image, turns, cache_state)
+
+
+def remove_spilled(session_id: str, spill_dir: str):
+    for ext in (".safetensors", ".png"):
+        try:
+            os.remove(os.path.join(spill_dir, session_id + ext))
+        except FileNotFoundError:
+            pass
+
+
+class SessionStore:
+    def __init__(self, max_sessions: int = MAX_SESSIONS, spill_dir: str = SESSION_SPILL_DIR, max_spilled: int = MAX_SPILLED_SESSIONS):
+        self.max_sessions = max(1, max_sessions)
+        self.spill_dir = spill_dir
+        self.max_spilled = max_spilled
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # Evicted sessions whose spill is still being written: id -> (session, eviction token).
+        self._spilling: Dict[str, Tuple[Session, object]] = {}
+        self._lock = threading.Lock()
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def create(self, image: Optional[Image.Image] = None, session_id: Optional[str] = None) -> Session:
+        session = Session(session_id or uuid.uuid4().hex, image)
+        with self._lock:
+            self._sessions[session.id] = session
+            victims = self._evict()
+        self._spill(victims)
+        metrics.incr("session.created")
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        victims = []
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            elif session_id in self._spilling:
+                # Evicted but not written out yet: take the live object back.
+                session, _ = self._spilling.pop(session_id)
+                self._sessions[session_id] = session
+                victims = self._evict()
+        if session is None and self.spill_dir and all(c.isalnum() for c in session_id):
+            # Disk reads happen outside the store lock; if another request restored
+            # the session meanwhile, its copy wins.
+            loaded = load_session(session_id, self.spill_dir)
+            if loaded is not None:
+                # Holding the session's lock keeps a new spill of it from starting before the old files are gone.
+                with loaded.lock:
+                    with self._lock:
+                        session = self._sessions.get(session_id)
+                        if session is None:
+                            session = self._sessions[session_id] = loaded
+                            victims = self._evict()
+                    if session is loaded:
+                        remove_spilled(session_id, self.spill_dir)
+                        metrics.incr("session.restored")
+        self._spill(victims)
+        if session is not None:
+            session.last_used = time.time()
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            found = self._sessions.pop(session_id, None) is not None
+            found = self._spilling.pop(session_id, None) is not None or found
+        if self.spill_dir and all(c.isalnum() for c in session_id):
+            found = found or os.path.exists(os.path.join(self.spill_dir, session_id + ".safetensors"))
+            remove_spilled(session_id, self.spill_dir)
+        return found
+
+    def _evict(self) -> List[Tuple[Session, object]]:
+        # Called with self._lock held. Only unlinks the least recently used sessions;
+        # the caller spills them with _spill once the lock is released.
+        victims = []
+        while len(self._sessions) > self.max_sessions:
+            _, session = self._sessions.popitem(last=False)
+            metrics.incr("session.evicted")
+            if self.spill_dir:
+                token = object()
+                self._spilling[session.id] = (session, token)
+                victims.append((session, token))
+        return victims
+
+    def _spill(self, victims: List[Tuple[Session, object]]):
+        for session, token in victims:
+            # Waits for a turn in progress on this session, not for the whole store.
+            with session.lock:
+                save_session(session, self.spill_dir)
+                with self._lock:
+                    entry = self._spilling.get(session.id)
+                    current = entry is not None and entry[1] is token
+                    if current:
+                        del self._spilling[session.id]
+            if current:
+                metrics.incr("session.spilled")
+            elif entry is None:
+                # Taken back by get() or deleted while it was written: the file is stale.
+                remove_spilled(session.id, self.spill_dir)
+        if victims:
+            self._prune_spilled()
+
+    def _prune_spilled(self):
+        files = []
+        for name in os.listdir(self.spill_dir):
+            if name.endswith(".safetensors"):
+                try:
+                    files.append((os.path.getmtime(os.path.join(self.spill_dir, name)), name))
+                except FileNotFoundError:
+                    pass  # restored or pruned by another request meanwhile
+        files.sort()
+        for _, name in files[:max(0, len(files) - self.max_spilled)]:
+            remove_spilled(name[:-len(".safetensors")], self.spill_dir)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            live = len(self._sessions)
+        return {"live": live, "max_sessions": self.max_sessions, "spill_dir": self.spill_dir or None}
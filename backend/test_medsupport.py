@@ -1,6 +1,42 @@
 from fastapi.testclient import TestClient
 from main import app
+import asyncio
+import bench_import_time
+import io
+import json
 import os
+import sys
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from PIL import Image
+
+import main
+import model_server
+import ocr_router
+import sessions
+import weight_loading
+from batch_evaluators import entity_recall_scores, forbidden_keyword_hits, reasoning_leak_scores
+from coalescing import CoalescingProxy
+from constrained_decoding import JSONSchemaAutomaton, JSONSchemaLogitsProcessor
+from documents import is_document, pdf_support
+from grounding import StreamingBoxParser, annotations_per_image, parse_annotations
+from image_store import ImageStore, PreprocessCache
+from long_documents import is_long, map_reduce, split_sections
+from metrics import metrics
+from model_server import ModelServer, ModelServerClient
+from ocr_router import OCRRouter, is_clean
+from profiler import ProfileStore, profile_request, profile_section, profiled
+from prompts import build_prompt, prompt_report, record_generation, set_token_counter
+from semantic_cache import HashingEmbedder, SemanticCache
+from tiling import MAX_TILES, plan_tiles, regions_from_boxes, to_global_box
+from trace_audit import LangSmithTraceSource, LocalTraceStore, TraceAuditor
 
 client = TestClient(app)
 
@@ -61,7 +97,92 @@ def test_patient_portal_multimodal():
         print(f"FAILURE: Status {response.status_code}")
         print("Error:", response.text)
 
-import re
+def test_import_time_budget():
+    print("\n--- Testing API Import Time ---")
+    problems = bench_import_time.check()
+    for problem in problems:
+        print(f"FAIL: {problem}")
+    assert not problems
+    print("PASS: main imports within budget without heavy inference modules.")
+
+def test_profiling_trace(tmp_path, monkeypatch):
+
+    class ProfiledChain:
+        ready = True
+        @profiled("chain.analyze_text")
+        def analyze_text(self, text):
+            for _ in range(2):
+                with profile_section("adapter.mlx_generate"):
+                    pass
+            return "TSH is a thyroid hormone."
+
+    monkeypatch.setattr(main, "chain_manager", ProfiledChain())
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache(path="", enabled=False))
+    monkeypatch.setattr(main, "profile_store", ProfileStore(str(tmp_path)))
+    monkeypatch.setattr(main, "ADMIN_KEY", "admin-secret")
+    admin = {"X-MedSupport-Admin-Key": "admin-secret"}
+
+    assert "X-MedSupport-Profile-Id" not in client.post("/api/analyze_text", json={"text": "What is TSH?"}).headers
+    response = client.post("/api/analyze_text", json={"text": "What is TSH?"}, headers={"X-MedSupport-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-MedSupport-Profile-Id"]
+
+    profiles = client.get("/api/admin/profiles", params={"limit": 5}, headers=admin).json()["profiles"]
+    assert [p["request_id"] for p in profiles] == [profile_id]
+    detail = client.get(f"/api/admin/profiles/{profile_id}", headers=admin).json()
+    assert detail["endpoint"] == "/api/analyze_text"
+    # Sections are recorded as they close: the nested generate calls first, then the outer chain call.
+    sections = detail["sections"]
+    assert [(s["name"], s["depth"]) for s in sections] == [("adapter.mlx_generate", 1), ("adapter.mlx_generate", 1), ("chain.analyze_text", 0)]
+    assert sections[2]["seconds"] >= sections[0]["seconds"] + sections[1]["seconds"]
+    assert detail["total_seconds"] >= sections[2]["seconds"]
+    assert "analyze_text" in detail["cprofile"]
+
+    # The index is rebuilt from disk on startup.
+    assert ProfileStore(str(tmp_path)).slowest(5) == profiles
+    assert client.get("/api/admin/profiles/missing", headers=admin).status_code == 404
+    # Profiles hold request details: the admin key is required.
+    assert client.get(f"/api/admin/profiles/{profile_id}").status_code == 401
+    assert client.get("/api/admin/profiles", headers={"X-MedSupport-Admin-Key": "guess"}).status_code == 401
+    monkeypatch.setattr(main, "ADMIN_KEY", "")
+    assert client.get("/api/admin/profiles", headers=admin).status_code == 403
+
+    # Only the newest max_profiles traces are kept on disk.
+    store = ProfileStore(str(tmp_path / "bounded"), max_profiles=2)
+    for name in ("first", "second", "third"):
+        with profile_request("/api/analyze_text", request_id=name) as session:
+            pass
+        store.save(session)
+    assert sorted(p["request_id"] for p in store.slowest(5)) == ["second", "third"]
+    assert store.get("first") is None and sorted(os.listdir(tmp_path / "bounded")) == ["second.json", "third.json"]
+    assert len(ProfileStore(str(tmp_path / "bounded"), max_profiles=1).slowest(5)) == 1
+
+def test_profiling_overlap():
+
+    a_started, b_started, a_done = threading.Event(), threading.Event(), threading.Event()
+    recorded, errors = {}, []
+
+    def request(name, wait_for, then):
+        try:
+            with profile_request(f"/api/{name}") as session, profile_section(f"chain.{name}"):
+                recorded[name] = session
+                then.set()
+                wait_for.wait(5)
+                with profile_section("adapter.mlx_generate"):
+                    pass
+        except Exception as e:
+            errors.append(e)
+
+    # A finishes while B is still running: B's allocation snapshot must still work.
+    go = threading.Event()
+    go.set()
+    b = threading.Thread(target=request, args=("b", a_done, b_started))
+    a = threading.Thread(target=lambda: (b_started.wait(5), request("a", go, a_started), a_done.set()))
+    b.start(); a.start(); a.join(); b.join()
+    assert errors == []
+    assert [(s["name"], s["depth"]) for s in recorded["b"].sections] == [("adapter.mlx_generate", 1), ("chain.b", 0)]
+    assert recorded["a"].peak_memory_bytes > 0 and recorded["b"].peak_memory_bytes > 0
+    assert not tracemalloc.is_tracing()
 
 def run_image_test(image_path, prompt, endpoint, expected_keywords=None, forbidden_keywords=None, required_sections=None):
     if not image_path:
@@ -96,21 +217,11 @@ def run_image_test(image_path, prompt, endpoint, expected_keywords=None, forbidd
 
         # 2. Forbidden Keywords (Hallucination Check with Negation Support)
         if forbidden_keywords:
-            # Simple negation pattern: "no [keyword]", "without [keyword]", "negative for [keyword]"
-            # We assume the keyword might be capitalized or plural, so we lower() both.
-            text_lower = result_text.lower()
-            found_forbidden = []
-            
+            # Negation-aware match: "no [keyword]", "without [keyword]", "negative for [keyword]"
+            found_forbidden = forbidden_keyword_hits([result_text], forbidden_keywords)[0]
             for kw in forbidden_keywords:
-                kw_lower = kw.lower()
-                if kw_lower in text_lower:
-                    # Check context for negation
-                    # Regex finds: (no|without|negative for|absent) followed by up to 20 chars then the keyword
-                    negation_pattern = r"(no|without|negative for|absent|free of)[\s\w]{0,20}" + re.escape(kw_lower)
-                    if re.search(negation_pattern, text_lower):
-                        print(f"INFO: Found forbidden term '{kw}' but it appears to be negated. Passing.")
-                    else:
-                        found_forbidden.append(kw)
+                if kw.lower() in result_text.lower() and kw not in found_forbidden:
+                    print(f"INFO: Found forbidden term '{kw}' but it appears to be negated. Passing.")
             
             if found_forbidden:
                 print(f"FAIL: Found forbidden keywords (Hallucination risk): {found_forbidden}")
@@ -138,6 +249,629 @@ def run_image_test(image_path, prompt, endpoint, expected_keywords=None, forbidd
         print(f"FAILURE: Status {response.status_code}")
         print("Error:", response.text)
 
+def test_batch_evaluators():
+    print("\n--- Testing Batch Heuristic Evaluators ---")
+    responses = [
+        "No fracture seen. Mild edema of the soft tissue.",
+        "Findings are negative for pneumonia; lungs are clear.",
+        "The user wants a summary. I will list the medications.",
+    ]
+    hits = forbidden_keyword_hits(responses, ["fracture", "edema", "pneumonia"])
+    assert hits == [["edema"], [], []], hits
+
+    recall = entity_recall_scores(responses, [["fracture", "edema"], ["lungs", "heart"], []])
+    assert recall == [1.0, 0.5, 1.0], recall
+
+    assert reasoning_leak_scores(responses) == [1.0, 1.0, 0.0]
+    print("PASS: Batch evaluators match per-example semantics.")
+
+def test_trace_audit(tmp_path):
+    print("\n--- Testing Trace Audit Checkpoints ---")
+
+    def length(run):
+        return {"key": "length", "score": len(run.outputs["result"])}
+
+    store = LocalTraceStore(str(tmp_path / "traces.jsonl"))
+    for i in range(5):
+        store.append(f"run-{i}", {"text": "q"}, {"result": "x" * i})
+    auditor = TraceAuditor(store, [length], name="local", max_workers=2, checkpoint_every=2, audit_dir=str(tmp_path))
+    assert auditor.run() == 5
+    with open(auditor.results_path) as f:
+        results = [json.loads(line) for line in f]
+    assert results == [{"run_id": f"run-{i}", "scores": {"length": i}} for i in range(5)]
+
+    # A second run resumes from the checkpoint and scores only the new trace.
+    store.append("run-5", {"text": "q"}, {"result": "x" * 5})
+    assert auditor.load_checkpoint()["last_run_id"] == "run-4"
+    assert auditor.run() == 1 and auditor.run() == 0
+    assert auditor.load_checkpoint()["last_run_id"] == "run-5"
+
+    class Client:
+        """Lists runs newest first, as LangSmith does."""
+        def __init__(self, runs):
+            self.runs = runs
+        def list_runs(self, project_name, execution_order, start_time=None):
+            return reversed([run for run in self.runs if start_time is None or run.start_time >= start_time])
+
+    start = datetime(2024, 1, 1)
+    runs = [SimpleNamespace(id=f"ls-{i}", start_time=start + timedelta(minutes=i), inputs={}, outputs={"result": "x" * i}) for i in range(5)]
+    auditor = TraceAuditor(LangSmithTraceSource(Client(runs), "MedSupport", limit=3), [length], name="langsmith", audit_dir=str(tmp_path))
+    seen = []
+    # The oldest runs go first; the limit defers newer runs instead of skipping older ones.
+    assert auditor.run(on_result=lambda result: seen.append(result["run_id"])) == 3
+    runs.append(SimpleNamespace(id="ls-5", start_time=start + timedelta(minutes=5), inputs={}, outputs={"result": ""}))
+    assert auditor.run(on_result=lambda result: seen.append(result["run_id"])) == 3
+    assert seen == [f"ls-{i}" for i in range(6)]
+
+    # A scorer failing on one trace is recorded; the others are still scored.
+    def first_char(run):
+        return {"key": "first_char", "score": run.outputs["result"][0]}
+
+    store = LocalTraceStore(str(tmp_path / "odd.jsonl"))
+    for i in range(3):
+        store.append(f"odd-{i}", {"text": "q"}, {"result": "x" * (2 - i)})
+    auditor = TraceAuditor(store, [length, first_char], name="odd", max_workers=1, checkpoint_every=100, audit_dir=str(tmp_path))
+    assert auditor.run() == 3
+    with open(auditor.results_path) as f:
+        results = [json.loads(line) for line in f]
+    assert [r["scores"] for r in results] == [{"length": 2, "first_char": "x"}, {"length": 1, "first_char": "x"}, {"length": 0}]
+    assert "first_char" in results[2]["errors"]
+
+    # A crash mid-audit still checkpoints what was written: the rerun resumes without duplicates.
+    for i in range(3, 6):
+        store.append(f"odd-{i}", {"text": "q"}, {"result": "x"})
+
+    def crash_on(run_id):
+        def on_result(result):
+            if result["run_id"] == run_id:
+                raise RuntimeError("consumer failed")
+        return on_result
+
+    with pytest.raises(RuntimeError):
+        auditor.run(on_result=crash_on("odd-4"))
+    assert auditor.load_checkpoint()["last_run_id"] == "odd-4"
+    assert auditor.run() == 1
+    with open(auditor.results_path) as f:
+        assert [json.loads(line)["run_id"] for line in f] == [f"odd-{i}" for i in range(6)]
+    print("PASS: Audits resume from the checkpoint without skipping runs.")
+
+def test_session_eviction(tmp_path, monkeypatch):
+    print("\n--- Testing Session LRU Eviction and Spill ---")
+    pytest.importorskip("mlx_vlm")
+
+    store = sessions.SessionStore(max_sessions=2, spill_dir=str(tmp_path))
+    save_session = sessions.save_session
+
+    def save_unlocked(session, spill_dir):
+        # Spills are written after the store lock is released.
+        assert not store._lock.locked()
+        save_session(session, spill_dir)
+
+    monkeypatch.setattr(sessions, "save_session", save_unlocked)
+    first = store.create(Image.new("RGB", (8, 8), "red"), "first")
+    first.turns = [("user", "What is TSH?"), ("assistant", "A thyroid hormone.")]
+    store.create(None, "second")
+    assert store.get("first") is first  # now most recently used
+    store.create(None, "third")  # evicts "second"
+    assert store.stats()["live"] == 2
+    assert os.path.exists(tmp_path / "second.safetensors") and not os.path.exists(tmp_path / "first.safetensors")
+
+    store.create(None, "fourth")  # evicts "first", with its image and turns
+    restored = store.get("first")
+    assert restored is not first and restored.turns == first.turns
+    assert restored.image.getpixel((0, 0)) == (255, 0, 0)
+    assert not os.path.exists(tmp_path / "first.safetensors")  # live again, the spill is removed
+    assert store.delete("second") and store.get("second") is None
+    print("PASS: Least recently used sessions spill to disk and come back.")
+
+def test_local_eval(tmp_path):
+    print("\n--- Testing Local Evaluation Engine ---")
+    # local_eval imports the evaluation suites, which build a ChainManager.
+    pytest.importorskip("mlx_vlm")
+    from local_eval import EvalStore, LocalEvaluationRunner, LocalJudgeStub, example_cache_key
+    from backend import evaluate_medsupport as evals
+
+    store = EvalStore(str(tmp_path / "eval_store.sqlite"))
+    key = example_cache_key("text", {"text": "What is TSH?"}, "v1")
+    assert key != example_cache_key("text", {"text": "What is TSH?"}, "v2")
+    assert store.get_output(key) is None
+    store.put_output(key, "text", "v1", {"text": "What is TSH?"}, {"result": "A thyroid hormone."}, 0.5)
+    assert EvalStore(store.path).get_output(key) == {"result": "A thyroid hormone."}
+
+    calls = []
+
+    def target(inputs):
+        calls.append(inputs["text"])
+        return {"result": f"About {inputs['text']}"}
+
+    def answered(run, example):
+        return {"key": "answered", "score": 1.0 if run.outputs["result"] else 0.0}
+
+    suite = {
+        "name": "text",
+        "metadata": {},
+        "target": target,
+        "evaluators": [answered, evals.tone_empathy_evaluator],
+        "examples": [{"inputs": {"text": f"Question {i}"}, "outputs": {}} for i in range(10)],
+    }
+    runner = LocalEvaluationRunner(store, judge=LocalJudgeStub(score=4), judge_name="stub", model_version="v1")
+    assert runner.run([suite]) == {"text": {"answered": 1.0, "tone_and_empathy": pytest.approx(0.8)}}
+    assert (runner.cache_hits, runner.cache_misses) == (0, 10) and len(calls) == 10
+
+    # Outputs are reused for the same model version; judge prompts still run (in batches of 8 and 2).
+    runner = LocalEvaluationRunner(store, judge=LocalJudgeStub(score=2), judge_name="stub", model_version="v1")
+    assert runner.run([suite]) == {"text": {"answered": 1.0, "tone_and_empathy": pytest.approx(0.4)}}
+    assert (runner.cache_hits, runner.cache_misses) == (10, 0) and len(calls) == 10
+    with store._lock:
+        rows = store._conn.execute("SELECT COUNT(*) FROM feedback").fetchone()[0]
+    assert rows == 40
+    print("PASS: Outputs are cached per model version and judged in batches.")
+
+def test_ocr_routing(monkeypatch):
+    print("\n--- Testing OCR Quality-gate Routing ---")
+
+    clean = {"words": 40, "mean_confidence": 92.0, "low_confidence_fraction": 0.05}
+    assert is_clean(clean)
+    assert not is_clean(dict(clean, words=ocr_router.MIN_WORDS - 1))  # too little text to trust
+    assert not is_clean(dict(clean, mean_confidence=70.0))  # handwriting, photos
+    assert not is_clean(dict(clean, low_confidence_fraction=0.3))  # a noisy region
+
+    class Chain:
+        def __init__(self):
+            self.calls = []
+        def analyze_note_text(self, text, user_prompt=""):
+            self.calls.append(("text", text))
+            return "text route"
+        def analyze_note_multimodal(self, image, user_prompt=""):
+            self.calls.append(("vision", None))
+            return "vision route"
+
+    outcomes = []
+    def fake_ocr(image):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(ocr_router, "run_ocr", fake_ocr)
+    chain = Chain()
+    router = OCRRouter(chain, mode="auto")
+    router.enabled = True
+    image = Image.new("RGB", (64, 64), "white")
+    routed_text, routed_vision = metrics.counter("scribe.routed_text"), metrics.counter("scribe.routed_vision")
+
+    outcomes[:] = [("BP 120/80 ...", clean), ("scrawl", dict(clean, mean_confidence=40.0)), RuntimeError("tesseract crashed")]
+    assert [router.analyze_note(image) for _ in range(3)] == ["text route", "vision route", "vision route"]
+    assert chain.calls == [("text", "BP 120/80 ..."), ("vision", None), ("vision", None)]
+    assert metrics.counter("scribe.routed_text") == routed_text + 1
+    assert metrics.counter("scribe.routed_vision") == routed_vision + 2
+
+    # Disabled routing never runs OCR.
+    chain = Chain()
+    assert not OCRRouter(chain, mode="off").enabled
+    assert OCRRouter(chain, mode="off").analyze_note(image) == "vision route" and outcomes == []
+    print("PASS: Only clean OCR takes the text path; everything else uses vision.")
+
+def test_tiling():
+    print("\n--- Testing High-resolution Tiling ---")
+    for width, height in [(4000, 3000), (1800, 900), (900, 600), (20000, 20000)]:
+        tiles = plan_tiles(width, height)
+        assert len(tiles) <= MAX_TILES, (width, height, len(tiles))
+        assert all(0 <= l < r <= width and 0 <= t < b <= height for l, t, r, b in tiles)
+        # Every pixel row and column is covered: the tiles reach both edges and leave no gaps.
+        for axis, length in ((0, width), (1, height)):
+            spans = sorted({(tile[axis], tile[axis + 2]) for tile in tiles})
+            assert spans[0][0] == 0 and spans[-1][1] == length
+            assert all(start <= previous_end for (_, previous_end), (start, _) in zip(spans, spans[1:]))
+    assert len(plan_tiles(20000, 20000, max_tiles=4)) <= 4
+
+    region = (1000, 500, 2000, 1500)
+    local = [10.0, 20.0, 60.0, 80.0]
+    global_box = to_global_box(local, region, 4000, 2000)
+    assert global_box == pytest.approx([30.0, 30.0, 55.0, 45.0])
+    # Back to tile-local coordinates.
+    left, top, right, bottom = region
+    back = [
+        (global_box[0] / 100 * 2000 - top) / (bottom - top) * 100,
+        (global_box[1] / 100 * 4000 - left) / (right - left) * 100,
+        (global_box[2] / 100 * 2000 - top) / (bottom - top) * 100,
+        (global_box[3] / 100 * 4000 - left) / (right - left) * 100,
+    ]
+    assert back == pytest.approx(local)
+
+    boxes = [
+        {"box": [0, 0, 10, 10], "label": "edge"},  # grown past the top-left corner
+        {"box": [40, 40, 50, 50], "label": "a"},
+        {"box": [45, 45, 55, 55], "label": "b"},  # overlaps "a"
+        {"box": [90, 90, 100, 100], "label": "corner"},
+    ]
+    regions = regions_from_boxes(boxes, 1000, 1000)
+    assert regions == [(0, 0, 125, 125), (375, 375, 575, 575), (875, 875, 1000, 1000)], regions
+    print("PASS: Tiles cover the image within the cap; boxes map back and crops merge.")
+
+def test_analyze_image_tiled():
+    print("\n--- Testing Tiled Image Analysis ---")
+    pytest.importorskip("mlx_vlm")
+    from chain_manager import ChainManager
+
+    class TileModel:
+        def __init__(self):
+            self.crops = []
+        def invoke(self, prompt, image=None):
+            if "zoomed-in" not in prompt:
+                return SimpleNamespace(content="Overview: no clear abnormality.")
+            self.crops.append(image.size)
+            # Only the first tile reports a finding, in its own coordinates.
+            return SimpleNamespace(content="Hairline fracture [0, 0, 50, 50]" if len(self.crops) == 1 else "Normal.")
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (4000, 2000), "black").save(buffer, format="PNG")
+    manager = ChainManager()
+    manager.model = TileModel()
+    response = manager.analyze_image_tiled(buffer.getvalue(), "Any fracture?", mode="full")
+
+    tiles = plan_tiles(4000, 2000)
+    assert manager.model.crops == [(r - l, b - t) for l, t, r, b in tiles]
+    assert response["result"].startswith("Overview: no clear abnormality.")
+    assert "**High-resolution findings**" in response["result"] and "Hairline fracture" in response["result"]
+    assert len(response["annotations"]) == 1
+    print("PASS: Tile findings are reported in global coordinates.")
+
+def test_grounding_parser():
+    print("\n--- Testing Grounding Parser ---")
+    text = "There is a fracture in the distal radius. [10, 20, 30, 40] Repeat [11, 21, 29, 39]. Out of range [90, 90, 120, 110]"
+    annotations = parse_annotations(text)
+    assert len(annotations) == 2, annotations
+    assert annotations[0]["label"] == "There is a fracture in the distal radius"
+    assert annotations[1]["box_2d"] == [0.9, 0.9, 1.0, 1.0]
+
+    parser = StreamingBoxParser()
+    streamed = []
+    for i in range(0, len(text), 5):
+        streamed += parser.feed(text[i:i + 5])
+    assert [a["label"] for a in streamed] == [a["label"] for a in annotations], streamed
+    print("PASS: Boxes parsed, clamped, merged and streamed.")
+
+def test_image_comparison():
+    print("\n--- Testing Multi-image Comparison ---")
+    text = ("Image 1: small nodule in the left upper lobe [20, 60, 30, 70]\n"
+            "Image 2: the nodule has grown [18, 58, 34, 74]; new effusion at the right base [80, 5, 95, 35]\n"
+            "Compared to image 1, the heart size is unchanged.")
+    prior, current, third = annotations_per_image(text, 3)
+    assert [a["label"] for a in prior] == ["Small nodule in the left upper lobe"], prior
+    assert len(current) == 2 and third == [], current
+    print("PASS: Boxes attributed to the image they were reported for.")
+
+def test_model_server_round_trip(tmp_path):
+    print("\n--- Testing Model Server Round Trip ---")
+
+    class StubChain:
+        def compare_images(self, images, user_prompt="", labels=None):
+            return {"result": user_prompt, "sizes": [list(image.size) for image in images], "labels": labels}
+
+    address = str(tmp_path / "model.sock")
+    server = ModelServer(address, chain_manager=StubChain(), preload=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(address):
+            break
+        time.sleep(0.02)
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 6), "white").save(buffer, format="PNG")
+    client = ModelServerClient([address])
+    reply = client.compare_images([buffer.getvalue(), Image.new("RGB", (4, 4))], "What changed?", ["prior", "today"])
+    assert reply == {"result": "What changed?", "sizes": [[8, 6], [4, 4]], "labels": ["prior", "today"]}, reply
+    print("PASS: Image lists reach the model server through shared memory.")
+
+def test_model_server_failures(tmp_path, monkeypatch):
+    print("\n--- Testing Model Server Failure Handling ---")
+
+    # A failed connection must not leak the request's shared-memory segments.
+    released = []
+    real_release = model_server.release_shared
+    monkeypatch.setattr(model_server, "release_shared", lambda shms: (released.extend(shms), real_release(shms)))
+    client = model_server.ModelServerClient([str(tmp_path / "missing.sock")])
+    with pytest.raises(OSError):
+        client.compare_images([Image.new("RGB", (4, 4)), Image.new("RGB", (4, 4))], "q")
+    with pytest.raises(OSError):
+        list(client.stream_image_analysis(Image.new("RGB", (4, 4)), "q"))
+    assert len(released) == 3, released
+
+    # Pickled requests over TCP need an explicit shared key.
+    monkeypatch.setattr(model_server, "MODEL_SERVER_KEY", "")
+    with pytest.raises(RuntimeError):
+        model_server.ModelServerClient(["10.0.0.5:7000"])
+    monkeypatch.setattr(model_server, "MODEL_SERVER_KEY", "s3cret")
+    assert model_server.ModelServerClient(["10.0.0.5:7000"]).authkeys == [b"s3cret"]
+    print("PASS: Segments released on connection failure; TCP requires a key.")
+
+def test_constrained_json():
+    print("\n--- Testing Constrained JSON Decoding ---")
+    schema = {
+        "type": "object",
+        "properties": {
+            "conditions": {"type": "array", "items": {"type": "string"}},
+            "box": {"type": "array", "items": {"type": "number"}, "minItems": 4, "maxItems": 4},
+        },
+        "required": ["conditions"],
+    }
+    automaton = JSONSchemaAutomaton(schema)
+    valid = '{"conditions": ["Type 2 \\"DM\\""], "box": [10, 20.5, 30, 40]}'
+    state = automaton.feed_text(automaton.initial(), valid)
+    assert state is not None and automaton.is_done(state)
+    # Missing required key, unknown key, wrong item type, too many box values, trailing data.
+    for bad in ['{"box": [1, 2, 3, 4]}', '{"conditions": [], "extra"', '{"conditions": [1', '{"conditions": [], "box": [1, 2, 3, 4, 5', '{"conditions": []}}']:
+        assert automaton.feed_text(automaton.initial(), bad) is None, bad
+
+    class Tokenizer:
+        eos_token_id = 0
+        vocab = ["<eos>", "Sure!", '{"', "conditions", '":', " [", '"Asthma"', "]}", "01"]
+        def decode(self, ids):
+            return "".join(self.vocab[i] for i in ids)
+
+    processor = JSONSchemaLogitsProcessor(schema, Tokenizer())
+    assert processor.allowed(range(9)) == [2]
+    processor.state = automaton.feed_text(processor.state, '{"conditions": ["Asthma"')
+    assert processor.allowed(range(9)) == [7]
+    processor.state = automaton.feed_text(processor.state, "]}")
+    assert processor.allowed(range(9)) == [0]
+
+    # A chosen token the schema rejects desyncs the automaton: constraining stops instead of continuing from a stale state.
+    desyncs = metrics.counter("constrained_decoding.desync")
+    processor = JSONSchemaLogitsProcessor(schema, Tokenizer())
+    processor._advance([5])  # prompt
+    processor._advance([5, 2])  # '{"'
+    assert processor.state is not None and processor.allowed(range(9)) == [3]
+    processor._advance([5, 2, 1])  # "Sure!"
+    assert processor.state is None and metrics.counter("constrained_decoding.desync") == desyncs + 1
+    assert processor.allowed(range(9)) == list(range(9))
+    processor._advance([5, 2, 1, 3])
+    assert metrics.counter("constrained_decoding.desync") == desyncs + 1
+    print("PASS: Only schema-valid continuations are allowed.")
+
+def test_semantic_cache(tmp_path, monkeypatch):
+    print("\n--- Testing Semantic Answer Cache ---")
+    if "MEDSUPPORT_SEMANTIC_CACHE" not in os.environ:
+        assert not SemanticCache(path="").enabled  # off unless MEDSUPPORT_SEMANTIC_CACHE=on
+    cache = SemanticCache(path=str(tmp_path), embedder=HashingEmbedder(), enabled=True)
+    assert cache.add("What is TSH?", "TSH is thyroid-stimulating hormone.")
+    assert not cache.add("what is TSH", "TSH is a hormone.")  # already has an entry
+    assert not cache.add("My TSH is 4.5, is that bad?", "...")  # patient values are never cached
+    assert not cache.add("What is LDL?", "The user wants to know about LDL. I need to explain.")  # reasoning leak
+
+    # Nothing is served before review.
+    assert cache.lookup("what does TSH mean") is None
+    [pending] = cache.pending()
+    assert pending["question"] == "What is TSH?"
+    assert cache.approve(pending["id"]) and not cache.approve("missing")
+    assert cache.pending() == []
+
+    hit = cache.lookup("what does TSH mean")
+    assert hit and hit["id"] == pending["id"] and hit["answer"].startswith("TSH is"), hit
+    assert cache.lookup("What is LDL?") is None
+
+    reloaded = SemanticCache(path=str(tmp_path), embedder=HashingEmbedder(), enabled=True)
+    assert reloaded.lookup("Can you explain TSH?")["id"] == hit["id"]
+    assert reloaded.report_false_hit(hit["id"]) and reloaded.lookup("What is TSH?") is None
+
+    # A flood of unreviewed answers evicts pending entries, never the approved ones.
+    small = SemanticCache(path="", max_entries=2, embedder=HashingEmbedder(), enabled=True)
+    small.add("What is TSH?", "TSH is thyroid-stimulating hormone.")
+    small.approve(small.pending()[0]["id"])
+    for question in ["What is LDL?", "What is HDL?", "What is ferritin?", "What is creatinine?"]:
+        assert small.add(question, f"{question[8:-1]} is a lab value.")
+    assert small.stats()["entries"] == 2 and [p["question"] for p in small.pending()] == ["What is creatinine?"]
+    assert small.lookup("What is TSH?")["answer"].startswith("TSH is")
+
+    # Reviewing answers that are served to every later patient is an admin action.
+    monkeypatch.setattr(main, "semantic_cache", reloaded)
+    monkeypatch.setattr(main, "ADMIN_KEY", "admin-secret")
+    reloaded.add("What is LDL?", "LDL is low-density lipoprotein.")
+    [pending] = reloaded.pending()
+    assert client.get("/api/admin/semantic_cache/pending").status_code == 401
+    assert client.post(f"/api/admin/semantic_cache/{pending['id']}/approve").status_code == 401
+    assert client.post(f"/api/admin/semantic_cache/{pending['id']}/false_hit").status_code == 401
+    admin = {"X-MedSupport-Admin-Key": "admin-secret"}
+    assert client.get("/api/admin/semantic_cache/pending", headers=admin).json()["entries"][0]["id"] == pending["id"]
+    assert client.post(f"/api/admin/semantic_cache/{pending['id']}/approve", headers=admin).json() == {"status": "approved"}
+    print("PASS: Only approved answers are served, specifics bypass, index persists.")
+
+def test_request_coalescing(monkeypatch):
+    print("\n--- Testing In-flight Request Coalescing ---")
+
+    class SlowChain:
+        ready = True
+        calls = 0
+        active = 0
+        max_active = 0
+        def _enter(self):
+            SlowChain.calls += 1
+            SlowChain.active += 1
+            SlowChain.max_active = max(SlowChain.max_active, SlowChain.active)
+        def analyze_text(self, text):
+            self._enter()
+            time.sleep(0.3)
+            SlowChain.active -= 1
+            return f"answer to {text}"
+        def stream_image_analysis(self, image_bytes, user_prompt=""):
+            self._enter()
+            for word in ["a ", "b ", "c"]:
+                time.sleep(0.1)
+                yield word
+            SlowChain.active -= 1
+        def finalize_stream(self, text):
+            return text
+
+    # The in-process wiring from main.build_chain_manager, around a model that must not run twice at once.
+    monkeypatch.delenv("MEDSUPPORT_MODEL_SERVER", raising=False)
+    monkeypatch.setitem(sys.modules, "chain_manager", types.SimpleNamespace(ChainManager=SlowChain))
+    monkeypatch.setattr(main, "chain_manager", main.build_chain_manager())
+    monkeypatch.setattr(main, "semantic_cache", SemanticCache(path="", enabled=False))
+
+    async def send(requests):
+        # One event loop for all requests: a handler that blocks it would serialize them.
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as http:
+            return await asyncio.gather(*(http.post(url, **kwargs) for url, kwargs in requests))
+
+    texts = ["What is TSH?", "What is TSH?", "What is TSH?", "What is LDL?"]
+    responses = asyncio.run(send([("/api/analyze_text", {"json": {"text": t}}) for t in texts]))
+    assert [r.json()["result"] for r in responses] == [f"answer to {t}" for t in texts]
+    assert SlowChain.calls == 2, SlowChain.calls
+    # Different requests still overlap on the event loop but take turns on the model.
+    assert SlowChain.max_active == 1, SlowChain.max_active
+
+    SlowChain.calls = 0
+    upload = {"files": {"file": ("scan.png", b"png", "image/png")}, "data": {"prompt": "q"}}
+    responses = asyncio.run(send([("/api/analyze_image_stream", upload)] * 3))
+    assert all(r.text.splitlines()[-1] == '{"type": "done", "result": "a b c", "annotations": []}' for r in responses), responses[0].text
+    assert SlowChain.calls == 1, SlowChain.calls
+    print("PASS: Identical concurrent HTTP requests and streams ran once.")
+
+def test_single_page_pdf(monkeypatch):
+    print("\n--- Testing Single-page PDF Routing ---")
+
+    class PageChain:
+        ready = True
+        pages = []
+        def simplify_report_multimodal(self, image, user_prompt=""):
+            PageChain.pages.append(image)
+            return "simplified"
+
+    monkeypatch.setattr(main, "chain_manager", PageChain())
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), "white").save(buffer, format="PDF")
+    pdf = buffer.getvalue()
+    assert is_document(pdf)
+
+    response = client.post("/api/simplify_report_multimodal", files={"file": ("report.pdf", pdf, "application/pdf")})
+    if pdf_support():
+        assert response.status_code == 200 and response.json()["result"] == "simplified"
+        assert len(PageChain.pages) == 1 and isinstance(PageChain.pages[0], Image.Image)
+    else:
+        # Never handed to Image.open as a picture: a clear "not implemented here" instead of a 500.
+        assert response.status_code == 501 and "pypdfium2" in response.json()["detail"]
+        assert PageChain.pages == []
+        response = client.post("/api/process_document", files={"file": ("report.pdf", pdf, "application/pdf")}, data={"task": "simplify"})
+        assert response.status_code == 501
+    print("PASS: A one-page PDF takes the document pipeline.")
+
+def test_process_rss(monkeypatch):
+    print("\n--- Testing Process RSS Reporting ---")
+
+    assert weight_loading.process_rss_bytes() > 0
+
+    def no_proc(*args, **kwargs):
+        raise OSError("no /proc")
+
+    # Without /proc the peak RSS from getrusage is reported instead.
+    monkeypatch.setattr(weight_loading, "open", no_proc, raising=False)
+    assert weight_loading.process_rss_bytes() > 0
+    print("PASS: RSS is reported with and without /proc.")
+
+def test_long_document_map_reduce():
+    print("\n--- Testing Long-document Map-reduce ---")
+
+    class WordChain:
+        # One token per word; summaries keep the first word of each chunk.
+        def count_tokens(self, texts):
+            return [len(t.split()) for t in texts]
+        def summarize_chunk(self, task, chunk, part, parts):
+            return f"{part}/{parts}:{chunk.split()[0]}"
+        def reduce_summaries(self, task, summaries):
+            return " ".join(summaries)
+
+    note = "\n".join(f"SECTION {i}:\n" + "word " * 300 for i in range(1, 8))
+    assert [s.split(":")[0] for s in split_sections(note)] == [f"SECTION {i}" for i in range(1, 8)]
+    chain = WordChain()
+    assert not is_long(chain, "What is TSH?", threshold=1000) and is_long(chain, note, threshold=1000)
+    out = map_reduce(chain, note, "analyze", max_chunk_tokens=1000)
+    stats = out["map_reduce"]
+    # 2114 tokens in chunks of at most 1000, balanced: three chunks, each starting on a section header.
+    assert stats["chunks"] == 3 and stats["chunk_tokens"] <= 1000, stats
+    assert out["result"] == "1/3:SECTION 2/3:SECTION 3/3:SECTION", out["result"]
+    assert set(stats["timings"]) == {"chunk_seconds", "map_seconds", "reduce_seconds"}
+    print("PASS: Sections packed into balanced chunks and reduced in order.")
+
+def test_prompt_builder():
+    print("\n--- Testing Prompt Builder ---")
+    template = """
+            You are an expert Radiologist. 
+            User Request: "{user_prompt}"
+            
+            
+            Analyze this image.   Report {"box": [ymin, xmin, ymax, xmax]}.
+            Analyze this image.   Report {"box": [ymin, xmin, ymax, xmax]}.
+            Note:
+              {note}
+            Answer the user's specific question: "{user_prompt}"
+            """
+
+    @profiled("chain.test_prompt")
+    def run():
+        prompt = build_prompt(template, user_prompt="Is there a fracture?", note="BP  120/80\n\n\nHR 70")
+        record_generation(300, 1000.0)
+        return prompt
+
+    counted = []
+    set_token_counter(lambda text: counted.append(text) or len(text.split()))
+    try:
+        prompt = run()
+        assert run() == prompt
+    finally:
+        set_token_counter(None)
+    # The template is tokenized once (raw and compacted), each rendered prompt once.
+    assert len(counted) == 4 and counted.count(prompt) == 2
+    assert prompt == (
+        'You are an expert Radiologist.\n\nAnalyze this image. Report {"box": [ymin, xmin, ymax, xmax]}.\n'
+        'Note:\n  BP  120/80\n\n\nHR 70\nAnswer the user\'s specific question: "Is there a fracture?"'
+    ), prompt
+    report = prompt_report()["test_prompt"]
+    # Saved tokens are counted on the template: the dropped "{user_prompt}" line costs 3 words, not its value.
+    assert report["tokens_saved"] == 24 and report["mean_prefill_seconds"] == 0.3, report
+    print("PASS: Prompt compacted, question asked once, values kept verbatim.")
+
+def test_image_handles(tmp_path):
+    print("\n--- Testing Upload-once Image Handles ---")
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 48), "white").save(buffer, format="PNG")
+    store = ImageStore(directory=str(tmp_path))
+    image_id, image = store.put(buffer.getvalue())
+    assert store.put(buffer.getvalue())[0] == image_id and store.get(image_id) is image
+
+    # A fresh store (another worker, or after eviction) decodes from disk.
+    restored = ImageStore(directory=str(tmp_path)).get(image_id)
+    assert restored.size == (64, 48) and ImageStore(directory=str(tmp_path)).get("0" * 64) is None
+
+    cache, calls = PreprocessCache(size=4), []
+    for _ in range(2):
+        cache.get_or_compute(cache.key([restored], {"return_tensors": "pt"}), lambda: calls.append(1))
+    assert len(calls) == 1
+    assert cache.key([restored.crop((0, 0, 32, 32))], {}) is None  # crops are new pixels, never cached
+
+    # Two workers uploading at once into one small directory prune it without tripping over each other.
+    shared = tmp_path / "shared"
+    workers = [ImageStore(directory=str(shared), disk_bytes=2000) for _ in range(2)]
+    errors = []
+
+    def upload(store, offset):
+        for i in range(20):
+            buffer = io.BytesIO()
+            Image.new("RGB", (16, 16), (offset + i, 0, 0)).save(buffer, format="PNG")
+            try:
+                store.put(buffer.getvalue())
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=upload, args=(store, 100 * n)) for n, store in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and sum(f.stat().st_size for f in shared.iterdir()) <= 2000
+    print("PASS: Handles resolve from memory and disk; preprocessing is reused.")
+
 def test_diagnostics_image():
     print("\n--- Testing Diagnostics Image (X-Ray) ---")
     image_path = get_image_path("chest_xray.png")
@@ -0,0 +1,102 @@
+import math
+import os
+from typing import Any, Dict, List, Tuple
+
+from PIL import Image
+
+# Tiled high-resolution inference helpers.
+# Large radiographs lose small findings when squashed to the vision encoder's
+# input size. Tiling splits the full-resolution image into overlapping tiles
+# (or, coarse-to-fine, only crops around regions flagged at low resolution)
+# and maps boxes found in each tile back to global 0-100 coordinates.
+
+TILE_SIZE = int(os.getenv("MEDSUPPORT_TILE_SIZE", "896"))
+TILE_OVERLAP = float(os.getenv("MEDSUPPORT_TILE_OVERLAP", "0.15"))
+# Images smaller than this multiple of TILE_SIZE gain nothing from tiling.
+MIN_TILING_SCALE = 1.5
+MAX_TILES = int(os.getenv("MEDSUPPORT_MAX_TILES", "16"))
+# Coarse-to-fine crops are the flagged box grown by this fraction on each side.
+REGION_MARGIN = 0.25
+
+TILING_MODES = ("off", "full", "coarse_to_fine")
+
+Region = Tuple[int, int, int, int]  # left, top, right, bottom in pixels
+
+
+def needs_tiling(image: Image.Image, tile_size: int = TILE_SIZE) -> bool:
+    return max(image.size) >= tile_size * MIN_TILING_SCALE
+
+
+def _axis_starts(length: int, tile: int, overlap: float) -> List[int]:
+    if length <= tile:
+        return [0]
+    stride = max(1, int(tile * (1 - overlap)))
+    count = math.ceil((length - tile) / stride) + 1
+    # Spread the tiles evenly so the last one ends exactly at the edge.
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def plan_tiles(width: int, height: int, tile_size: int = TILE_SIZE, overlap: float = TILE_OVERLAP, max_tiles: int = MAX_TILES) -> List[Region]:
+    """Overlapping grid covering the image; the tile size grows if the grid would exceed max_tiles."""
+    while True:
+        xs = _axis_starts(width, tile_size, overlap)
+        ys = _axis_starts(height, tile_size, overlap)
+        if len(xs) * len(ys) <= max_tiles:
+            break
+        tile_size = int(tile_size * 1.25)
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in ys for x in xs]
+
+
+def _merge_regions(regions: List[Region]) -> List[Region]:
+    """Replaces overlapping crops with their bounding union until none overlap."""
+    merged: List[Region] = []
+    for region in regions:
+        while True:
+            for i, other in enumerate(merged):
+                if region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]:
+                    del merged[i]
+                    region = (min(region[0], other[0]), min(region[1], other[1]), max(region[2], other[2]), max(region[3], other[3]))
+                    break
+            else:
+                break
+        merged.append(region)
+    return merged
+
+
+def regions_from_boxes(boxes: List[Dict[str, Any]], width: int, height: int, margin: float = REGION_MARGIN) -> List[Region]:
+    """
+    Pixel crops around boxes flagged on the low-resolution pass (boxes in 0-100 [ymin, xmin, ymax, xmax]),
+    clamped to the image. Overlapping crops are merged so no area is examined twice.
+    """
+    regions = []
+    for b in boxes:
+        ymin, xmin, ymax, xmax = b["box"]
+        grow_y, grow_x = (ymax - ymin) * margin, (xmax - xmin) * margin
+        left = int(max(0.0, xmin - grow_x) / 100 * width)
+        top = int(max(0.0, ymin - grow_y) / 100 * height)
+        right = int(min(100.0, xmax + grow_x) / 100 * width)
+        bottom = int(min(100.0, ymax + grow_y) / 100 * height)
+        if right > left and bottom > top:
+            regions.append((left, top, right, bottom))
+    return _merge_regions(regions)
+
+
+def to_global_box(box: List[float], region: Region, width: int, height: int) -> List[float]:
+    """Maps a tile-local 0-100 box to 0-100 coordinates of the full image."""
+    left, top, right, bottom = region
+    tile_w, tile_h = right - left, bottom - top
+    ymin, xmin, ymax, xmax = box
+    return [
+        (top + ymin / 100 * tile_h) / height * 100,
+        (left + xmin / 100 * tile_w) / width * 100,
+        (top + ymax / 100 * tile_h) / height * 100,
+        (left + xmax / 100 * tile_w) / width * 100,
+    ]
+
+
+def describe_region(region: Region, width: int, height: int) -> str:
+    left, top, right, bottom = region
+    cx, cy = (left + right) / 2 / width, (top + bottom) / 2 / height
+    vertical = "upper" if cy < 1 / 3 else "lower" if cy > 2 / 3 else "middle"
+    horizontal = "left" if cx < 1 / 3 else "right" if cx > 2 / 3 else "center"
+    return f"{vertical} {horizontal}"
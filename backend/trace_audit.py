@@ -0,0 +1,167 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Streaming audit of production traces.
+# Runs are pulled lazily from a trace source, scored with bounded concurrency,
+# appended to a local JSONL results file, and a checkpoint remembers the last
+# audited run so each invocation only processes traces it has not seen.
+
+AUDIT_DIR = os.getenv("MEDSUPPORT_AUDIT_DIR", os.path.join(os.path.dirname(__file__), "eval_results"))
+
+
+class LangSmithTraceSource:
+    """
+    Yields LangSmith runs started since the last audited run, oldest first.
+    limit caps the runs audited per invocation; the newer ones are left for the next.
+    """
+
+    def __init__(self, client: Any, project_name: str, limit: Optional[int] = None):
+        self.client = client
+        self.project_name = project_name
+        self.limit = limit
+
+    def iter_new(self, checkpoint: Dict[str, Any]) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        last_run_id = checkpoint.get("last_run_id")
+        since = checkpoint.get("start_time")
+        window = {"start_time": datetime.fromisoformat(since)} if since else {}
+        # list_runs pages newest first. Page down to the checkpointed run (start_time
+        # bounds the listing if it is gone), then replay the backlog oldest first so
+        # the checkpoint only ever moves past runs that were scored.
+        backlog = []
+        for run in self.client.list_runs(project_name=self.project_name, execution_order=1, **window):
+            if last_run_id and str(run.id) == last_run_id:
+                break
+            backlog.append(run)
+        backlog.reverse()
+        for run in backlog[:self.limit]:
+            yield run, {"last_run_id": str(run.id), "start_time": run.start_time.isoformat()}
+
+
+class LocalTraceStore:
+    """Append-only JSONL file of runs ({"id", "inputs", "outputs"}), a local stand-in for LangSmith."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def append(self, run_id: str, inputs: Dict[str, Any], outputs: Dict[str, Any]):
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"id": run_id, "inputs": inputs, "outputs": outputs, "start_time": time.time()}) + "\n")
+
+    def iter_new(self, checkpoint: Dict[str, Any]) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            offset = checkpoint.get("offset", 0)
+            # Fall back to a full scan if the file was rewritten under us.
+            if offset and not self._follows(f, offset, checkpoint.get("last_run_id")):
+                offset = 0
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                run = SimpleNamespace(id=data["id"], inputs=data.get("inputs", {}), outputs=data.get("outputs", {}))
+                yield run, {"last_run_id": data["id"], "offset": f.tell()}
+
+    def _follows(self, f, offset: int, run_id: Optional[str]) -> bool:
+        # The checkpointed run must be the line ending exactly at offset.
+        start = max(0, offset - 65536)
+        f.seek(start)
+        tail = f.read(offset - start).rstrip(b"\n").rsplit(b"\n", 1)[-1]
+        try:
+            return json.loads(tail).get("id") == run_id
+        except ValueError:
+            return False
+
+
+class TraceAuditor:
+    def __init__(
+        self,
+        source: Any,
+        scorers: List[Callable[[Any], Dict[str, Any]]],
+        name: str,
+        max_workers: int = 4,
+        checkpoint_every: int = 20,
+        audit_dir: str = AUDIT_DIR,
+    ):
+        self.source = source
+        self.scorers = scorers
+        self.max_workers = max_workers
+        self.checkpoint_every = checkpoint_every
+        os.makedirs(audit_dir, exist_ok=True)
+        self.checkpoint_path = os.path.join(audit_dir, f"trace_audit_{name}.checkpoint.json")
+        self.results_path = os.path.join(audit_dir, f"trace_audit_{name}.jsonl")
+
+    def load_checkpoint(self) -> Dict[str, Any]:
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def save_checkpoint(self, checkpoint: Dict[str, Any]):
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(dict(checkpoint, updated_at=time.time()), f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _score(self, run: Any) -> Dict[str, Any]:
+        # A scorer that fails on one odd trace is recorded on its result instead of aborting the audit.
+        scores, errors = {}, {}
+        for scorer in self.scorers:
+            try:
+                feedback = scorer(run)
+                scores[feedback["key"]] = feedback["score"]
+            except Exception as e:
+                name = getattr(scorer, "__name__", repr(scorer))
+                print(f"Scorer {name} failed on run {run.id}: {e}")
+                errors[name] = str(e)
+        result = {"run_id": str(run.id), "scores": scores}
+        if errors:
+            result["errors"] = errors
+        return result
+
+    def run(self, on_result: Optional[Callable[[Dict[str, Any]], None]] = None) -> int:
+        """Audits all runs newer than the checkpoint and returns how many were scored."""
+        checkpoint = self.load_checkpoint()
+        in_flight = deque()
+        audited = 0
+
+        # Sources yield runs oldest first and results are consumed in submission
+        # order, so the checkpoint always points at a prefix that is fully scored.
+        # If the audit stops early, the finally block still checkpoints that
+        # prefix, so a rerun neither rescores nor duplicates written results.
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool, open(self.results_path, "a") as results:
+                def drain_one():
+                    nonlocal audited, checkpoint
+                    future, run_checkpoint = in_flight.popleft()
+                    result = future.result()
+                    results.write(json.dumps(result) + "\n")
+                    checkpoint = run_checkpoint
+                    audited += 1
+                    if audited % self.checkpoint_every == 0:
+                        results.flush()
+                        self.save_checkpoint(checkpoint)
+                    if on_result:
+                        on_result(result)
+
+                for run, run_checkpoint in self.source.iter_new(checkpoint):
+                    in_flight.append((pool.submit(self._score, run), run_checkpoint))
+                    if len(in_flight) >= self.max_workers * 2:
+                        drain_one()
+                while in_flight:
+                    drain_one()
+        finally:
+            # The results file is closed (flushed) by now.
+            if audited:
+                self.save_checkpoint(checkpoint)
+        return audited
@@ -0,0 +1,39 @@
+import os
+import resource
+import sys
+import time
+from typing import Any, Dict, Tuple
+
+# Weight loading for MLX model replicas, with startup statistics.
+# Every replica loads its own copy of the weights; the load time and RSS each
+# process logs (and GET /api/admin/model returns) show what a replica costs
+# when sizing how many fit on one host.
+
+
+def process_rss_bytes() -> int:
+    """Current resident set size where /proc is available, otherwise the peak RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is bytes on macOS and kilobytes on Linux.
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def load_weights(model_path: str) -> Tuple[Any, Any, Dict[str, Any]]:
+    """Loads (model, processor) and returns startup statistics alongside."""
+    import mlx.core as mx
+    from mlx_vlm import load
+
+    start = time.perf_counter()
+    rss_before = process_rss_bytes()
+    model, processor = load(model_path, trust_remote_code=True)
+    # Materialize every parameter so the RSS below includes the weights.
+    mx.eval(model.parameters())
+
+    stats: Dict[str, Any] = {"load_seconds": round(time.perf_counter() - start, 3)}
+    stats["rss_bytes"] = process_rss_bytes()
+    stats["rss_delta_bytes"] = stats["rss_bytes"] - rss_before
+    print(f"Loaded {model_path} in {stats['load_seconds']}s (rss={stats['rss_bytes'] / 1e9:.2f}GB)")
+    return model, processor, stats